@@ -1,11 +1,21 @@
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 from typing import Any, Callable
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
-from api.service import Service
-from config import ROUTE_PREFIX
+from api.service import BacklogFullError, InvalidParamsError, Service, dispatcher, text2img_batcher
+from cache import result_cache
+from comfy import comfy_servers
+from comfy.coordination import coordinator
+from comfy.dedup import singleflight
+from comfy.progress import progress_hub
+from config import ROUTE_PREFIX, TASK_QUEUE_ENABLED
+from database.repository import RecordRepository, TaskQueueRepository
+from metrics import render
+from webhook import webhook_outbox
 
 
 class CustomAPIRouter(APIRouter):
@@ -29,6 +39,8 @@ class CustomAPIRouter(APIRouter):
         return super().patch(path, response_model_exclude_none=response_model_exclude_none, **kwargs)
 
 router = CustomAPIRouter(prefix=ROUTE_PREFIX)
+# served at the root where prometheus scrapes it by default
+metrics_router = APIRouter()
 
 
 class ServiceType(Enum):
@@ -40,10 +52,130 @@ class RequestDTO(BaseModel):
     service_type: ServiceType
     client_task_id: int
     params: dict
+    # only used by the task queue: higher priority lanes are dispatched first, tenants share each lane fairly
+    priority: int = 0
+    tenant_id: str = 'default'
+
+
+class BatchResultDTO(BaseModel):
+    client_task_id: int
+    success: bool
+    comfy_task_id: str | None = None
+    error: str | None = None
 
 @router.post('')
 async def queue_prompt(request_dto: RequestDTO):
     """commit a prompt to the comfy server"""
+    if TASK_QUEUE_ENABLED:
+        result = (await _enqueue([request_dto]))[0]
+        if not result['success']:
+            raise HTTPException(status_code=422, detail=result['error'])
+        return result
     service_func = getattr(Service, request_dto.service_type.value)
-    return await service_func(request_dto.client_task_id, request_dto.params)
-
+    try:
+        return await service_func(request_dto.client_task_id, request_dto.params)
+    except InvalidParamsError as e:
+        raise HTTPException(status_code=422, detail=f'invalid params: {e}')
+
+@router.post('/batch', response_model=list[BatchResultDTO])
+async def queue_prompts(request_dtos: list[RequestDTO]):
+    """commit many prompts at once, every task gets its own result"""
+    if TASK_QUEUE_ENABLED:
+        return await _enqueue(request_dtos)
+    tasks = [(dto.service_type.value, dto.client_task_id, dto.params) for dto in request_dtos]
+    return await Service.batch(tasks)
+
+@router.post('/img2img/{client_task_id}')
+async def queue_img2img_stream(client_task_id: int, request: Request):
+    """
+    commit an img2img prompt whose input image is the raw request body and the params are the query parameters.
+    the body is streamed to the comfy server as it arrives, it's never decoded or held in memory as a whole.
+    """
+    params = dict(request.query_params)
+    content_type = request.headers.get('content-type', 'application/octet-stream')
+    try:
+        return await Service.img2img_stream(client_task_id, params, request.stream(), content_type)
+    except InvalidParamsError as e:
+        raise HTTPException(status_code=422, detail=f'invalid params: {e}')
+
+async def _enqueue(request_dtos: list[RequestDTO]) -> list[dict]:
+    tasks = [
+        (dto.service_type.value, dto.client_task_id, dto.params, dto.priority, dto.tenant_id)
+        for dto in request_dtos
+    ]
+    try:
+        return await Service.enqueue(tasks)
+    except BacklogFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+@router.delete('/tasks/{client_task_id}')
+async def cancel_task(client_task_id: int):
+    """cancel a task which is still waiting in the task queue"""
+    if not await TaskQueueRepository.cancel(client_task_id):
+        raise HTTPException(status_code=404, detail='task is not queued, it is unknown or already dispatched')
+    return {'cancelled': client_task_id}
+
+@router.get('/tasks/{client_task_id}/events')
+async def task_events(client_task_id: int, last_event_id: int = Header(0)):
+    """
+    the progress of a task as server-sent events, from queued to completed or failed.
+    a reconnecting client sends the Last-Event-ID header and gets the events it missed
+    """
+    return StreamingResponse(
+        progress_hub.subscribe(client_task_id, last_event_id),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@router.get('/stats')
+async def stats():
+    """
+    coalescing, result cache, node connection, input upload, file cleanup, progress stream, text2img batching,
+    replica coordination, task queue and webhook statistics
+    """
+    stats = {
+        'dedup': singleflight.stats(),
+        'cache': result_cache.stats(),
+        'nodes': {server.endpoint: server.stats() for server in comfy_servers},
+        'inputs': {server.endpoint: server.inputs.stats() for server in comfy_servers},
+        'cleanup': {server.endpoint: server.cleaner.stats() for server in comfy_servers},
+        'progress': progress_hub.stats(),
+        'batching': text2img_batcher.stats(),
+        'coordination': coordinator.stats()
+    }
+    if TASK_QUEUE_ENABLED:
+        stats['queue'] = await dispatcher.stats()
+    if webhook_outbox.enabled:
+        stats['webhook'] = await webhook_outbox.stats()
+    return stats
+
+@router.get('/timeline')
+async def timeline(since: datetime | None = None, until: datetime | None = None, window: float = 3600):
+    """
+    latency percentiles in seconds of every stage of the tasks accepted between since and until, per workflow and node.
+    until defaults to now and since to window seconds before until
+    """
+    until = until or datetime.now(timezone.utc)
+    since = since or until - timedelta(seconds=window)
+    # timestamps without an offset are taken as utc
+    since, until = (value if value.tzinfo else value.replace(tzinfo=timezone.utc) for value in (since, until))
+    return {
+        'since': since,
+        'until': until,
+        'stages': await RecordRepository.stage_percentiles(since, until)
+    }
+
+@router.delete('/cache/{prompt_hash}')
+async def invalidate_cache(prompt_hash: str):
+    """drop the cached result of a prompt hash"""
+    return {'deleted': await result_cache.invalidate(prompt_hash)}
+
+@router.delete('/cache')
+async def clear_cache():
+    """drop every cached result"""
+    return {'deleted': await result_cache.invalidate()}
+
+@metrics_router.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    """queue depths, in-flight tasks, per-stage latency histograms and error counters in the prometheus text format"""
+    return PlainTextResponse(render(), media_type='text/plain; version=0.0.4')
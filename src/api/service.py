@@ -1,46 +1,568 @@
+import asyncio
 import base64
-import json
+import logging
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import AsyncIterator
 
-from comfy import comfy_servers
-from database import Record
-from workflows.img2img import IMG2IMG_PROMPT_TEMPLATE
-from workflows.text2img import TEXT2IMG_PROMPT_TEMPLATE
+from comfy import comfy_servers, ComfyServer
+from comfy.background import run_in_background
+from comfy.coordination import coordinator
+from comfy.dedup import singleflight
+from comfy.progress import progress_hub
+from comfy.uploads import uploaded_path
+from config import (
+    TASK_QUEUE_ENABLED,
+    TASK_QUEUE_DEPTH,
+    TASK_QUEUE_MAX_BACKLOG,
+    TASK_QUEUE_POLL_INTERVAL,
+    TASK_QUEUE_MAX_ATTEMPTS,
+    TASK_QUEUE_LEASE,
+    TENANT_WEIGHTS,
+    TEXT2IMG_BATCH_ENABLED,
+    TEXT2IMG_BATCH_MAX_SIZE,
+    TEXT2IMG_BATCH_MAX_WAIT
+)
+from database import QueuedTask, Record, RecordStatus
+from database.repository import RecordRepository, TaskQueueRepository
+from metrics import QUEUE_WAIT_SECONDS, STAGE_BUCKETS, STAGE_SECONDS, Histogram
+from s3 import presign_get_url
+from scheduler import create_scheduler, estimate_cost, extract_model_set
+from workflows import Workflow
+from workflows.img2img import IMG2IMG_WORKFLOW, load_image_from_url
+from workflows.text2img import TEXT2IMG_WORKFLOW
 
+logger = logging.getLogger(__name__)
 
-def _schedule_comfy_server():
-    """schedule the comfy server with the least queue remaining"""
-    return min(comfy_servers, key=lambda x: x.queue_remaining)
+_scheduler = create_scheduler()
+
+# no workflow parameter changes a loader node, so the models are fixed per workflow
+_TEXT2IMG_MODEL_SET = extract_model_set(TEXT2IMG_WORKFLOW.graph)
+_IMG2IMG_MODEL_SET = extract_model_set(IMG2IMG_WORKFLOW.graph)
+
+
+def _schedule_comfy_server(cost: float, model_set: frozenset[str] | None = None) -> ComfyServer:
+    """schedule a comfy server for a task of the given estimated cost and required models"""
+    return _scheduler.schedule(comfy_servers, cost, model_set)
+
+
+class BacklogFullError(Exception):
+    """the task queue can't take more tasks, the client should retry later"""
+
+
+class InvalidParamsError(ValueError):
+    """the params of a task don't fit its workflow, e.g. a typed param which can't be converted"""
 
 
 class Service:
     @staticmethod
     async def text2img(client_task_id: int, params: dict) -> Record:
-        comfy_server = _schedule_comfy_server()
-        text = params.get('text')
-        prompt_str = TEXT2IMG_PROMPT_TEMPLATE.substitute(text=text)
-        prompt_json = json.loads(prompt_str)
-        return await comfy_server.queue_prompt(client_task_id, prompt_json)
+        accepted_at = datetime.now(timezone.utc)
+        prompt_json, cost, model_set = Service.plan('text2img', params)
+        comfy_server = _schedule_comfy_server(cost, model_set)
+        if text2img_batcher.enabled:
+            return await text2img_batcher.submit(comfy_server, client_task_id, prompt_json, cost, accepted_at)
+        return await comfy_server.queue_prompt(
+            client_task_id,
+            prompt_json,
+            cost,
+            workflow='text2img',
+            accepted_at=accepted_at
+        )
 
     @staticmethod
     async def img2img(client_task_id: int, params: dict) -> Record:
-        comfy_server = _schedule_comfy_server()
-        text = params.get('text')
-        image_base64 = params.get('image')
+        accepted_at = datetime.now(timezone.utc)
+        _, cost, model_set = Service.plan('img2img', params)
+        comfy_server = _schedule_comfy_server(cost, model_set)
+        prompt_json, input_key = await Service.prepare_img2img(comfy_server, params, cost)
+        return await comfy_server.queue_prompt(
+            client_task_id,
+            prompt_json,
+            cost,
+            input_key,
+            workflow='img2img',
+            accepted_at=accepted_at
+        )
 
-        # upload image to comfyui
-        image_bytes = base64.b64decode(image_base64)
-        resp = await comfy_server.upload_image(image_bytes)
-        image_path = resp['name']
-        if resp['subfolder']:
-            image_path = f"{resp['subfolder']}/{image_path}"
+    @staticmethod
+    async def img2img_stream(
+            client_task_id: int,
+            params: dict,
+            chunks: AsyncIterator[bytes],
+            content_type: str
+    ) -> Record:
+        """img2img whose input image is streamed straight from the request body to the scheduled comfy server"""
+        accepted_at = datetime.now(timezone.utc)
+        _, cost, model_set = Service.plan('img2img', params)
+        comfy_server = _schedule_comfy_server(cost, model_set)
+        try:
+            resp = await comfy_server.upload_image_stream(chunks, content_type)
+        except Exception:
+            comfy_server.release(cost)
+            raise
+        image_path = uploaded_path(resp)
+        prompt_json = IMG2IMG_WORKFLOW.build({**params, 'image': image_path})
+        try:
+            return await comfy_server.queue_prompt(
+                client_task_id,
+                prompt_json,
+                cost,
+                workflow='img2img',
+                accepted_at=accepted_at
+            )
+        finally:
+            # the content isn't known before it's uploaded, so a streamed input isn't kept for other prompts
+            comfy_server.clean_file(is_input=True, image_path=image_path)
+
+    @staticmethod
+    def plan(service_type: str, params: dict) -> tuple[dict | None, float, frozenset[str]]:
+        """plan a task of the service type, raise InvalidParamsError when its params don't build a prompt"""
+        try:
+            return getattr(Service, f'plan_{service_type}')(params)
+        except (TypeError, ValueError) as e:
+            raise InvalidParamsError(str(e)) from e
+
+    @staticmethod
+    def plan_text2img(params: dict) -> tuple[dict, float, frozenset[str]]:
+        """build the prompt, estimate the cost and the models of a text2img task"""
+        prompt_json = TEXT2IMG_WORKFLOW.build(params)
+        return prompt_json, estimate_cost('text2img', prompt_json), _TEXT2IMG_MODEL_SET
+
+    @staticmethod
+    def plan_img2img(params: dict) -> tuple[None, float, frozenset[str]]:
+        """check the params, estimate the cost and the models of an img2img task, the prompt needs the uploaded image"""
+        IMG2IMG_WORKFLOW.build({**params, 'image': None})
+        return None, estimate_cost('img2img'), _IMG2IMG_MODEL_SET
+
+    @staticmethod
+    async def prepare_img2img(comfy_server: ComfyServer, params: dict, cost: float) -> tuple[dict, str | None]:
+        """
+        upload the input image to the scheduled comfy server and build the prompt,
+        return it with the input key to pass to queue_prompt, which releases the upload once the prompt has run.
+        an input image referenced by `image_s3_key` isn't uploaded, the comfy server downloads it from a presigned url
+        and the input key is None.
+        """
+        image_s3_key = params.get('image_s3_key')
+        try:
+            if image_s3_key:
+                url = await presign_get_url(image_s3_key)
+                return load_image_from_url(IMG2IMG_WORKFLOW.build({**params, 'image': None}), url), None
+
+            # upload image to comfyui, unless the same image is already there
+            image_bytes = base64.b64decode(params.get('image'))
+            image_path, input_key = await comfy_server.upload_input(image_bytes)
+        except Exception:
+            comfy_server.release(cost)
+            raise
 
         # create prompt
-        prompt_str = IMG2IMG_PROMPT_TEMPLATE.substitute(text=text, image=image_path)
-        prompt_json = json.loads(prompt_str)
+        prompt_json = IMG2IMG_WORKFLOW.build({**params, 'image': image_path})
+        return prompt_json, input_key
+
+    @staticmethod
+    async def submit(
+            comfy_server: ComfyServer,
+            service_type: str,
+            client_task_id: int,
+            params: dict,
+            prompt_json: dict | None,
+            cost: float,
+            accepted_at: datetime | None = None
+    ) -> Record:
+        """queue a planned task on the comfy server it was scheduled on"""
+        input_key = None
+        if prompt_json is None:
+            prompt_json, input_key = await getattr(Service, f'prepare_{service_type}')(comfy_server, params, cost)
+        if service_type == text2img_batcher.workflow.name and text2img_batcher.enabled:
+            return await text2img_batcher.submit(comfy_server, client_task_id, prompt_json, cost, accepted_at)
+        return await comfy_server.queue_prompt(
+            client_task_id,
+            prompt_json,
+            cost,
+            input_key,
+            workflow=service_type,
+            accepted_at=accepted_at
+        )
+
+    @staticmethod
+    async def enqueue(tasks: list[tuple[str, int, dict, int, str]]) -> list[dict]:
+        """
+        put (service_type, client_task_id, params, priority, tenant_id) tasks in the durable task queue,
+        invalid tasks are rejected right away, the dispatcher queues the others on the comfy servers.
+        """
+        results = [{'client_task_id': task[1], 'success': False} for task in tasks]
+        accepted = {}
+        for i, (service_type, client_task_id, params, priority, tenant_id) in enumerate(tasks):
+            try:
+                _, cost, _ = Service.plan(service_type, params)
+            except Exception as e:
+                results[i]['error'] = f'invalid params: {e}'
+                continue
+            accepted[i] = QueuedTask(
+                client_task_id=client_task_id,
+                service_type=service_type,
+                params=params,
+                priority=priority,
+                tenant_id=tenant_id,
+                virtual_finish=dispatcher.fair_queue.tag(priority, tenant_id, cost)
+            )
+        if accepted and not await TaskQueueRepository.enqueue(list(accepted.values()), TASK_QUEUE_MAX_BACKLOG):
+            raise BacklogFullError(f'more than {TASK_QUEUE_MAX_BACKLOG} tasks are queued')
+        for i in accepted:
+            results[i]['success'] = True
+        dispatcher.wakeup()
+        return results
+
+    @staticmethod
+    async def batch(tasks: list[tuple[str, int, dict]]) -> list[dict]:
+        """
+        queue many (service_type, client_task_id, params) tasks at once.
+        they are scheduled in a single pass, submitted concurrently and recorded with one bulk insert,
+        a failing task doesn't fail the others.
+        """
+        results = [{'client_task_id': client_task_id, 'success': False} for _, client_task_id, _ in tasks]
+        accepted_at = datetime.now(timezone.utc)
+
+        # 1. plan every task, invalid params fail here before anything is scheduled
+        planned = []
+        for i, (service_type, _, params) in enumerate(tasks):
+            try:
+                prompt_json, cost, model_set = Service.plan(service_type, params)
+            except Exception as e:
+                results[i]['error'] = f'invalid params: {e}'
+                continue
+            planned.append((i, prompt_json, cost, model_set))
+
+        # 2. spread them across the comfy servers in one scheduling pass
+        servers = _scheduler.schedule_many(comfy_servers, [(cost, model_set) for _, _, cost, model_set in planned])
+
+        # 3. submit them concurrently, a prompt can finish before the batch is recorded: its post-processing waits
+        writes: list[asyncio.Future] = []
+
+        async def submit(i: int, prompt_json: dict | None, cost: float, comfy_server: ComfyServer) -> Record:
+            service_type, client_task_id, params = tasks[i]
+            input_key = None
+            if prompt_json is None:
+                prompt_json, input_key = await getattr(Service, f'prepare_{service_type}')(comfy_server, params, cost)
+            comfy_task_id = await comfy_server.submit_prompt(prompt_json, cost, input_key)
+            writes.append(singleflight.pending(comfy_task_id))
+            return Record(
+                client_task_id=client_task_id,
+                comfy_task_id=comfy_task_id,
+                status=RecordStatus.QUEUED,
+                comfy_endpoint=comfy_server.endpoint,
+                workflow=service_type,
+                accepted_at=accepted_at,
+                dispatched_at=datetime.now(timezone.utc)
+            )
+
         try:
-            return await comfy_server.queue_prompt(client_task_id, prompt_json)
+            submitted = await asyncio.gather(
+                *(submit(i, prompt_json, cost, server) for (i, prompt_json, cost, _), server in zip(planned, servers)),
+                return_exceptions=True
+            )
+            records = {}
+            for (i, *_), result in zip(planned, submitted):
+                if isinstance(result, Exception):
+                    results[i]['error'] = f'submit error: {result}'
+                else:
+                    records[i] = result
+
+            # 4. record all submitted tasks in a single statement, fall back to one by one to isolate bad rows
+            try:
+                await RecordRepository.bulk_create(list(records.values()))
+            except Exception as e:
+                logger.warning(f'bulk insert of {len(records)} records failed, inserting one by one: {e}')
+                for i, record in list(records.items()):
+                    try:
+                        await RecordRepository.create(record)
+                    except Exception as e:
+                        # too late to take the prompt back, it runs without a record and nothing is delivered
+                        results[i].update(
+                            error=f'record error: {e}, its prompt still runs but its result won\'t be delivered',
+                            comfy_task_id=record.comfy_task_id
+                        )
+                        del records[i]
+            for i, record in records.items():
+                progress_hub.register(record.comfy_task_id, record.client_task_id)
+                results[i].update(success=True, comfy_task_id=record.comfy_task_id)
         finally:
-            # clean up the input file after the prompt is queued
-            await comfy_server.clean_file(is_input=True, image_path=image_path)
+            for write in writes:
+                write.set_result(None)
+        return results
+
+
+class _BatchGroup:
+    """requests waiting to be merged into one prompt"""
+
+    __slots__ = ('entries', 'futures', 'arrivals')
+
+    def __init__(self):
+        self.entries: list[tuple[int, dict, float, datetime | None]] = []
+        self.futures: list[asyncio.Future] = []
+        self.arrivals: list[float] = []
+
+
+class PromptBatcher:
+    """
+    micro-batching of the requests of a workflow before they are queued on their comfy server.
+
+    The requests scheduled on the same comfy server whose prompts only differ in the branch params of the workflow are
+    grouped for at most `max_wait` seconds, or until `max_size` of them are waiting, then queued as one merged prompt:
+    the nodes they have in common appear once and each request has a branch of its own. ComfyUI runs the samplers of
+    the branches one after the other, so this saves the per-prompt overhead, not GPU time.
+    A request alone in its group is queued as usual.
+    """
+
+    def __init__(
+            self,
+            workflow: Workflow,
+            enabled: bool,
+            max_size: int,
+            max_wait: float
+    ):
+        self.workflow = workflow
+        self.enabled = enabled and max_size > 1
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.prompts = 0
+        self.sizes = Counter()  # requests per queued prompt -> prompts
+        self.waits = Histogram(STAGE_BUCKETS)  # seconds each request waited for the others of its group
+        self._groups: dict[tuple[ComfyServer, str], _BatchGroup] = {}
+
+    async def submit(
+            self,
+            comfy_server: ComfyServer,
+            client_task_id: int,
+            prompt: dict,
+            cost: float,
+            accepted_at: datetime | None = None
+    ) -> Record:
+        """queue a request with the compatible ones arriving on the same comfy server within the wait"""
+        key = (comfy_server, self.workflow.batch_key(prompt))
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _BatchGroup()
+            asyncio.get_running_loop().call_later(self.max_wait, self._flush, key, group)
+        future = asyncio.get_running_loop().create_future()
+        group.entries.append((client_task_id, prompt, cost, accepted_at))
+        group.futures.append(future)
+        group.arrivals.append(time.perf_counter())
+        if len(group.entries) >= self.max_size:
+            self._flush(key, group)
+        return await future
+
+    def _flush(self, key: tuple[ComfyServer, str], group: _BatchGroup):
+        if self._groups.get(key) is not group:
+            # already flushed when it was full
+            return
+        del self._groups[key]
+        now = time.perf_counter()
+        for arrival in group.arrivals:
+            self.waits.observe(now - arrival)
+            STAGE_SECONDS.observe(now - arrival, 'batch_wait')
+        run_in_background(self._queue(key[0], group))
+
+    async def _queue(self, comfy_server: ComfyServer, group: _BatchGroup):
+        self.prompts += 1
+        self.sizes[len(group.entries)] += 1
+        try:
+            if len(group.entries) == 1:
+                client_task_id, prompt, cost, accepted_at = group.entries[0]
+                records = [await comfy_server.queue_prompt(
+                    client_task_id,
+                    prompt,
+                    cost,
+                    workflow=self.workflow.name,
+                    accepted_at=accepted_at
+                )]
+            else:
+                records = await comfy_server.queue_batch(group.entries, workflow=self.workflow.name)
+        except Exception as e:
+            for future in group.futures:
+                # a caller cancelled while its group waited must not keep the others from their result
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, record in zip(group.futures, records):
+            if not future.done():
+                future.set_result(record)
+
+    def stats(self) -> dict:
+        requests = sum(size * prompts for size, prompts in self.sizes.items())
+        return {
+            'enabled': self.enabled,
+            'prompts': self.prompts,
+            'requests': requests,
+            'mean_size': requests / self.prompts if self.prompts else 0.0,
+            'sizes': {str(size): prompts for size, prompts in sorted(self.sizes.items())},
+            'wait': self.waits.snapshot()
+        }
+
+
+class FairQueue:
+    """
+    self-clocked weighted fair queuing tags of the queued tasks.
+
+    Within a priority lane, a task is tagged with the tag of its tenant's previous task, or the lane's virtual time
+    when the tenant was idle, plus its cost over the tenant's weight. The dispatcher claims the smallest tags first,
+    so a tenant backfilling thousands of tasks only gets its weighted share while others have tasks queued.
+    """
+
+    def __init__(self, weights: dict[str, float] = TENANT_WEIGHTS):
+        self.weights = weights
+        self._virtual_time: dict[int, float] = {}  # priority -> tag of the latest dispatched task
+        self._last_tag: dict[tuple[int, str], float] = {}  # (priority, tenant_id) -> tag of its latest queued task
+
+    def tag(self, priority: int, tenant_id: str, cost: float) -> float:
+        start = max(self._virtual_time.get(priority, 0.0), self._last_tag.get((priority, tenant_id), 0.0))
+        tag = start + cost / self.weights.get(tenant_id, 1.0)
+        self._last_tag[(priority, tenant_id)] = tag
+        return tag
+
+    def dispatched(self, priority: int, tag: float):
+        self._virtual_time[priority] = max(self._virtual_time.get(priority, 0.0), tag)
+
+    async def restore(self):
+        """pick up the tags of the tasks left in the queue by a previous run"""
+        for priority, tenant_id, min_tag, max_tag in await TaskQueueRepository.fair_queue_state():
+            self._virtual_time[priority] = min(self._virtual_time.get(priority, min_tag), min_tag)
+            self._last_tag[(priority, tenant_id)] = max(self._last_tag.get((priority, tenant_id), max_tag), max_tag)
+
+
+class TaskDispatcher:
+    """
+    feed the comfy servers from the durable task queue, keeping each of them at `depth` in-flight prompts.
+    the rest of the backlog waits in postgres, where it can be reprioritised or cancelled and survives restarts.
+    """
+
+    def __init__(
+            self,
+            depth: int = TASK_QUEUE_DEPTH,
+            poll_interval: float = TASK_QUEUE_POLL_INTERVAL,
+            max_attempts: int = TASK_QUEUE_MAX_ATTEMPTS,
+            lease: float = TASK_QUEUE_LEASE
+    ):
+        self.depth = depth
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.dispatched = 0
+        self.rejected = 0
+        self.retried = 0
+        self.fair_queue = FairQueue()
+        self.waits: dict[int, Histogram] = defaultdict(Histogram)  # priority lane -> seconds from enqueue to dispatch
+        self._wakeup = asyncio.Event()
+
+    def start(self) -> list[asyncio.Task]:
+        """start the dispatch loop when the task queue is enabled"""
+        if not TASK_QUEUE_ENABLED:
+            return []
+        return [asyncio.create_task(self._run())]
+
+    def wakeup(self):
+        """dispatch right away instead of at the next poll, new tasks have been queued"""
+        self._wakeup.set()
+
+    def free_slots(self) -> dict[ComfyServer, int]:
+        """
+        free in-flight slots of every connected comfy server. with replicas, the prompts the others have queued
+        count too, as reported by the replica leading the node
+        """
+        slots = {}
+        for server in comfy_servers:
+            busy = len(server.in_flight)
+            if coordinator.enabled:
+                busy = max(busy, server.task_queue_remaining)
+            free = self.depth - busy
+            if server.connected and free > 0:
+                slots[server] = free
+        return slots
+
+    async def dispatch_once(self) -> int:
+        """claim as many tasks as there are free slots and dispatch them, return the number of tasks done with"""
+        slots = self.free_slots()
+        if not slots:
+            return 0
+        return await TaskQueueRepository.claim(
+            sum(slots.values()),
+            lambda tasks: self._dispatch(tasks, slots),
+            self.max_attempts,
+            self.lease
+        )
+
+    async def _dispatch(self, tasks: list[QueuedTask], slots: dict[ComfyServer, int]) -> list[bool]:
+        """schedule the claimed tasks on the free slots in priority order and submit them concurrently"""
+        finished = [True] * len(tasks)
+        submissions = []
+        for i, task in enumerate(tasks):
+            self.fair_queue.dispatched(task.priority, task.virtual_finish)
+            try:
+                prompt_json, cost, model_set = Service.plan(task.service_type, task.params)
+            except Exception as e:
+                logger.error(f'drop queued task {task.client_task_id}, invalid params: {e}')
+                self.rejected += 1
+                continue
+            comfy_server = _scheduler.schedule([server for server, free in slots.items() if free > 0], cost, model_set)
+            slots[comfy_server] -= 1
+            submissions.append((i, Service.submit(
+                comfy_server,
+                task.service_type,
+                task.client_task_id,
+                task.params,
+                prompt_json,
+                cost,
+                task.created_at
+            )))
+
+        results = await asyncio.gather(*(submission for _, submission in submissions), return_exceptions=True)
+        for (i, _), result in zip(submissions, results):
+            if isinstance(result, Exception):
+                logger.warning(f'dispatch queued task {tasks[i].client_task_id} error: {result}')
+                finished[i] = False
+                self.retried += 1
+            else:
+                self.dispatched += 1
+                task = tasks[i]
+                wait = (datetime.now(timezone.utc) - task.created_at).total_seconds()
+                self.waits[task.priority].observe(wait)
+                QUEUE_WAIT_SECONDS.observe(wait, task.priority)
+        return finished
+
+    async def _run(self):
+        try:
+            await self.fair_queue.restore()
+        except Exception as e:
+            logger.error(f'restore fair queuing tags error: {e}')
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                # keep claiming while there are free slots and queued tasks, failed ones wait for the next poll
+                while await self.dispatch_once():
+                    pass
+            except Exception as e:
+                logger.error(f'dispatch queued tasks error: {e}')
+
+    async def stats(self) -> dict:
+        return {
+            'backlog': await TaskQueueRepository.backlog(),
+            'dispatched': self.dispatched,
+            'rejected': self.rejected,
+            'retried': self.retried,
+            'wait': {str(priority): histogram.snapshot() for priority, histogram in sorted(self.waits.items())}
+        }
 
 
+dispatcher = TaskDispatcher()
+text2img_batcher = PromptBatcher(
+    TEXT2IMG_WORKFLOW,
+    TEXT2IMG_BATCH_ENABLED,
+    TEXT2IMG_BATCH_MAX_SIZE,
+    TEXT2IMG_BATCH_MAX_WAIT
+)
@@ -0,0 +1,92 @@
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from config import RESULT_CACHE_ENABLED, RESULT_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES
+from database import CachedResult
+from database.repository import ResultCacheRepository
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """
+    Cache of finished results keyed by prompt hash, so a repeated deterministic prompt skips the GPU.
+
+    The in-process tier is an LRU with TTL, the postgres tier survives restarts and is shared by every process.
+    """
+
+    def __init__(self, max_entries: int = RESULT_CACHE_MAX_ENTRIES, ttl: int = RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        # hash -> (expires, comfy_task_id, s3_keys)
+        self._entries: OrderedDict[str, tuple[float, str, list[str]]] = OrderedDict()
+
+    def stats(self) -> dict:
+        total = self.memory_hits + self.db_hits + self.misses
+        return {
+            'enabled': RESULT_CACHE_ENABLED,
+            'memory_hits': self.memory_hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.db_hits) / total if total else 0.0,
+            'memory_entries': len(self._entries)
+        }
+
+    async def get(self, prompt_hash: str) -> tuple[str, list[str]] | None:
+        """return the (comfy_task_id, s3_keys) of a cached prompt result, the keys of its output images in order"""
+        if not RESULT_CACHE_ENABLED:
+            return None
+        entry = self._entries.get(prompt_hash)
+        if entry is not None:
+            expires, comfy_task_id, s3_keys = entry
+            if expires > time.time():
+                self._entries.move_to_end(prompt_hash)
+                self.memory_hits += 1
+                return comfy_task_id, s3_keys
+            del self._entries[prompt_hash]
+
+        cached = await ResultCacheRepository.get(prompt_hash)
+        if cached is None:
+            self.misses += 1
+            return None
+        self.db_hits += 1
+        # entries cached before the multi-image outputs only have the first key
+        s3_keys = cached.s3_keys or [cached.s3_key]
+        self._remember(prompt_hash, cached.expires_at.timestamp(), cached.comfy_task_id, s3_keys)
+        return cached.comfy_task_id, s3_keys
+
+    async def put(self, prompt_hash: str, comfy_task_id: str, s3_keys: list[str]):
+        if not RESULT_CACHE_ENABLED:
+            return
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        self._remember(prompt_hash, expires_at.timestamp(), comfy_task_id, s3_keys)
+        await ResultCacheRepository.put(CachedResult(
+            prompt_hash=prompt_hash,
+            comfy_task_id=comfy_task_id,
+            s3_key=s3_keys[0],
+            s3_keys=s3_keys,
+            expires_at=expires_at
+        ))
+        logger.info(f'cached result of prompt {prompt_hash}: {s3_keys}')
+
+    async def invalidate(self, prompt_hash: str | None = None) -> int:
+        """drop the entry of a prompt hash from both tiers, or every entry when no hash is given"""
+        if prompt_hash is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(prompt_hash, None)
+        return await ResultCacheRepository.delete(prompt_hash)
+
+    def _remember(self, prompt_hash: str, expires: float, comfy_task_id: str, s3_keys: list[str]):
+        self._entries[prompt_hash] = (expires, comfy_task_id, s3_keys)
+        self._entries.move_to_end(prompt_hash)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+result_cache = ResultCache()
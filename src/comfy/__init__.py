@@ -2,155 +2,1083 @@ import asyncio
 import json
 import logging
 import os
+import random
+import time
 import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import AsyncIterator
 
 import aiofiles
 import httpx
 import websockets
 
+from cache import result_cache
+from comfy.background import run_in_background
+from comfy.cleanup import FileCleaner
+from comfy.coordination import coordinator
+from comfy.dedup import prompt_hash, singleflight
+from comfy.progress import progress_hub
+from comfy.uploads import InputUploadCache, content_hash, uploaded_path
 from config import (
     CALL_BACK_BASE_URL,
+    CLEANUP_FLUSH_INTERVAL,
     FALLBACK_PATH,
-    COMFY_ENDPOINTS
+    COMFY_ENDPOINTS,
+    COMFY_IMAGE_DELIVERY,
+    COMFY_HTTP_MAX_CONNECTIONS,
+    COMFY_HTTP_MAX_KEEPALIVE,
+    COMFY_HTTP_TIMEOUT,
+    COMFY_RECONNECT_BACKOFF,
+    COMFY_RECONNECT_MAX_BACKOFF,
+    COMFY_WS_PING_INTERVAL,
+    COMFY_WS_PING_TIMEOUT,
+    COMPLETION_QUEUE_SIZE,
+    COMPLETION_WORKERS,
+    COORDINATION_RECORD_WAIT,
+    THROUGHPUT_EWMA_ALPHA
 )
-from database import Record
+from database import Record, RecordImage, RecordStatus
 from database.repository import RecordRepository
+from metrics import STAGE_ERRORS, STAGE_SECONDS, Gauge, register, track
 from s3 import upload_image_to_s3
-from workflows.clean_file import CLEAN_FILE_PROMPT_TEMPLATE
+from webhook import close_webhook_client, open_webhook_client, post_webhook, webhook_outbox
+from workflows import merge_prompts
+from workflows.clean_file import build_clean_prompt
 
 logger = logging.getLogger(__name__)
 
+# binary websocket frames start with two big-endian uint32: the event type and the image format
+_PREVIEW_IMAGE_EVENT = 1
+_FRAME_HEADER_SIZE = 8
+
+
+def _to_websocket_output(prompt: dict) -> tuple[dict, set[str]]:
+    """replace the SaveImage nodes of a prompt with SaveImageWebsocket nodes, return the new prompt and their ids"""
+    prompt = dict(prompt)
+    output_nodes = set()
+    for node_id, node in prompt.items():
+        if node.get('class_type') != 'SaveImage':
+            continue
+        prompt[node_id] = {
+            'inputs': {'images': node['inputs']['images']},
+            'class_type': 'SaveImageWebsocket',
+            '_meta': {'title': 'SaveImageWebsocket'}
+        }
+        output_nodes.add(node_id)
+    return prompt, output_nodes
+
+
+@contextmanager
+def _timed(timings: dict, stage: str):
+    """record the elapsed seconds of a post-processing stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
+
 
 class ComfyServer:
     def __init__(self, endpoint: str):
         self.queue_remaining = 0
         self.endpoint = endpoint
-        self.client_id = uuid.uuid4().hex
+        # with replicas, the prompts of all of them are heard on the websocket of the one leading the node
+        self.client_id = coordinator.client_id(endpoint) if coordinator.enabled else uuid.uuid4().hex
+        self.leading = not coordinator.enabled
         self.callback_base_url = CALL_BACK_BASE_URL
         self.fallback_path = FALLBACK_PATH
+        self.client: httpx.AsyncClient | None = None
+        # finished comfy_task_ids waiting for post-processing, with the (node_id, image) delivered over the websocket,
+        # drained by the completion workers
+        self.completions: asyncio.Queue[tuple[str, list[tuple[str, bytes]] | None]] = asyncio.Queue(
+            maxsize=COMPLETION_QUEUE_SIZE
+        )
+        # websocket delivery: output node ids per comfy_task_id, image frames collected per comfy_task_id and node
+        self._ws_output_nodes: dict[str, set[str]] = {}
+        self._ws_frames: dict[str, dict[str, list[bytes]]] = {}
+        self._executing: tuple[str, str] | None = None
+        # local load accounting for the scheduler, updated as soon as a prompt is queued
+        self.connected = False
+        self.reserved_cost = 0.0
+        self.in_flight: dict[str, float] = {}  # comfy_task_id -> estimated cost
+        self.throughput = 1.0  # learned cost units executed per second
+        self.model_set: frozenset[str] | None = None  # models of the latest prompt scheduled here
+        self._queued_at: dict[str, float] = {}
+        self._timelines: dict[str, dict[str, datetime]] = {}  # comfy_task_id -> timestamps written with its result
+        # batched prompts: comfy_task_id -> client_task_id -> (output node ids of its branch, hash of its own prompt)
+        self._branches: dict[str, dict[int, tuple[set[str], str]]] = {}
+        self._started_at: dict[str, float] = {}
+        # websocket supervision, tasks adopted from a previous run are checked until they have finished
+        self.reconnects = 0
+        self.reconciled = 0
+        self.lost = 0
+        self.missed = 0  # finished while nobody listened, with the images only sent over the websocket
+        self._adopted: set[str] = set()
+        self._reclaim: set[str] = set()  # reconciled tasks another replica may have left half post-processed
+        # img2img inputs uploaded to the comfy server, shared by the prompts loading the same image
+        self.inputs = InputUploadCache()
+        self._task_inputs: dict[str, str] = {}  # comfy_task_id -> content hash of the input it loads
+        self._uploading: dict[str, asyncio.Future] = {}
+        # files to delete from the comfy server, and the cleanup prompts queued there and not finished yet
+        self.cleaner = FileCleaner()
+        self.cleanup_prompts: set[str] = set()
+        self._cleanup_posts = 0  # cleanup prompts posted whose id isn't known yet
+        # comfy_task_id -> image frames of the unknown prompts which finished meanwhile, maybe one of these cleanups
+        self._finished_unknown: dict[str, list[tuple[str, bytes]] | None] = {}
+
+    @property
+    def task_queue_remaining(self) -> int:
+        """prompts queued or running on the comfy server, apart from our own cleanup prompts"""
+        return max(0, self.queue_remaining - len(self.cleanup_prompts))
+
+    @property
+    def pending_cost(self) -> float:
+        """estimated cost of the work scheduled on the comfy server and not finished yet"""
+        return self.reserved_cost + sum(self.in_flight.values())
+
+    def reserve(self, cost: float):
+        """account a task the scheduler has picked this server for, before its prompt is queued"""
+        self.reserved_cost += cost
+
+    def release(self, cost: float):
+        """drop a reservation, the task has been queued or has failed"""
+        self.reserved_cost = max(0.0, self.reserved_cost - cost)
+
+    def _track_queued(self, comfy_task_id: str, cost: float):
+        self.release(cost)
+        self.in_flight[comfy_task_id] = cost
+        self._queued_at[comfy_task_id] = time.monotonic()
+
+    def _track_started(self, comfy_task_id: str):
+        self._started_at[comfy_task_id] = time.monotonic()
+        queued_at = self._queued_at.pop(comfy_task_id, None)
+        if queued_at is not None:
+            STAGE_SECONDS.observe(self._started_at[comfy_task_id] - queued_at, 'comfy_queue')
+
+    def _track_finished(self, comfy_task_id: str, elapsed: float | None = None):
+        """
+        update the learned throughput from the execution time of a finished task,
+        elapsed is the one measured by the replica leading the node when it isn't this one
+        """
+        cost = self.in_flight.pop(comfy_task_id, None)
+        self._queued_at.pop(comfy_task_id, None)
+        started_at = self._started_at.pop(comfy_task_id, None)
+        if elapsed is None:
+            if started_at is None:
+                return
+            elapsed = time.monotonic() - started_at
+            STAGE_SECONDS.observe(elapsed, 'execution')
+        if cost is None or elapsed <= 0:
+            return
+        # clamp the sample, fully cached executions finish instantly and must not skew the estimate
+        rate = min(max(cost / elapsed, self.throughput / 4), self.throughput * 4)
+        self.throughput = THROUGHPUT_EWMA_ALPHA * rate + (1 - THROUGHPUT_EWMA_ALPHA) * self.throughput
+
+    async def open(self):
+        """open the pooled keep-alive http client of the comfy server, adopt the tasks a previous run left unfinished"""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=f'http://{self.endpoint}',
+                limits=httpx.Limits(
+                    max_connections=COMFY_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=COMFY_HTTP_MAX_KEEPALIVE
+                ),
+                timeout=COMFY_HTTP_TIMEOUT
+            )
+            # nothing has been queued by this run yet, so every unfinished record is from a previous one.
+            # with replicas, the one leading the node adopts them when it connects
+            if not coordinator.enabled:
+                await self.adopt()
+
+    async def adopt(self):
+        """check the unfinished tasks of the comfy server found in the records, they weren't queued by this listener"""
+        try:
+            adopted = set(await RecordRepository.unfinished_comfy_task_ids(self.endpoint)) - set(self.in_flight)
+        except Exception as e:
+            logger.error(f'server {self.client_id} load unfinished tasks error: {e}')
+            return
+        self._adopted |= adopted
+        if adopted:
+            logger.info(f'server {self.client_id} adopted {len(adopted)} unfinished tasks')
+
+    async def close(self):
+        """delete the cached input uploads and the pending files, close the pooled http client of the comfy server"""
+        for image_path in self.inputs.clear():
+            self.clean_file(is_input=True, image_path=image_path)
+        await self.flush_cleanup()
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def queue_prompt(
+            self,
+            client_task_id: int,
+            prompt: dict,
+            cost: float = 0.0,
+            input_key: str | None = None,
+            workflow: str | None = None,
+            accepted_at: datetime | None = None
+    ) -> Record:
+        """
+        commit a prompt to the comfy server, cost is the estimate reserved by the scheduler.
+        the reference on the input upload of input_key is released once the prompt has finished or wasn't queued.
+        workflow and accepted_at start the timeline of the record.
+        """
+        key = prompt_hash(prompt)
+        submitted = False
+
+        async def submit() -> tuple[str, str]:
+            nonlocal submitted
+            submitted = True
+            return await self.submit_prompt(prompt, cost, input_key), self.endpoint
+
+        async def record(comfy_task_id: str, comfy_endpoint: str) -> Record:
+            # a coalesced request is recorded on the comfy server its prompt runs on, not the one it was scheduled on
+            record = Record(
+                client_task_id=client_task_id,
+                comfy_task_id=comfy_task_id,
+                status=RecordStatus.QUEUED,
+                comfy_endpoint=comfy_endpoint,
+                workflow=workflow,
+                accepted_at=accepted_at,
+                dispatched_at=datetime.now(timezone.utc)
+            )
+            progress_hub.register(comfy_task_id, client_task_id)
+            return await RecordRepository.create(record)
+
+        try:
+            cached = await result_cache.get(key)
+            if cached is not None:
+                return await self._serve_cached(client_task_id, cached, workflow, accepted_at)
+            return await singleflight.run(key, submit, record)
+        finally:
+            if not submitted:
+                # served from the cache or coalesced into an identical prompt in flight, nothing runs here
+                self.release(cost)
+                if input_key is not None:
+                    self.release_input(input_key)
 
-    async def queue_prompt(self, client_task_id: int, prompt: dict) -> Record:
-        """commit a prompt to the comfy server"""
-        uri = f'http://{self.endpoint}/prompt'
+    async def queue_batch(
+            self,
+            entries: list[tuple[int, dict, float, datetime | None]],
+            workflow: str | None = None
+    ) -> list[Record]:
+        """
+        commit (client_task_id, prompt, cost, accepted_at) prompts of a workflow which only differ in its branch params
+        as one merged prompt, with a branch per request, and record them. each record gets the images of its branch.
+        the prompts which have run before are served from the result cache, the others aren't coalesced
+        """
+        records: list[Record | None] = [None] * len(entries)
+        keys = [prompt_hash(prompt) for _, prompt, _, _ in entries]
+        pending = []
+        for i, ((client_task_id, _, cost, accepted_at), key) in enumerate(zip(entries, keys)):
+            cached = await result_cache.get(key)
+            if cached is None:
+                pending.append(i)
+                continue
+            self.release(cost)
+            records[i] = await self._serve_cached(client_task_id, cached, workflow, accepted_at)
+        if not pending:
+            return records
+
+        prompt, outputs = merge_prompts([entries[i][1] for i in pending])
+        comfy_task_id = await self.submit_prompt(prompt, sum(entries[i][2] for i in pending))
+        self._branches[comfy_task_id] = {
+            entries[i][0]: (output_nodes, keys[i]) for i, output_nodes in zip(pending, outputs)
+        }
+        dispatched_at = datetime.now(timezone.utc)
+        batch = [
+            Record(
+                client_task_id=entries[i][0],
+                comfy_task_id=comfy_task_id,
+                status=RecordStatus.QUEUED,
+                comfy_endpoint=self.endpoint,
+                workflow=workflow,
+                accepted_at=entries[i][3],
+                dispatched_at=dispatched_at,
+                branch_nodes=sorted(output_nodes)
+            )
+            for i, output_nodes in zip(pending, outputs)
+        ]
+        progress_hub.register(comfy_task_id, *(record.client_task_id for record in batch))
+        # the post-processing of the prompt waits for its records
+        await singleflight.attach(comfy_task_id, RecordRepository.bulk_create(batch))
+        for i, record in zip(pending, batch):
+            records[i] = record
+        return records
+
+    async def _serve_cached(
+            self,
+            client_task_id: int,
+            cached: tuple[str, list[str]],
+            workflow: str | None,
+            accepted_at: datetime | None
+    ) -> Record:
+        """the same deterministic prompt has run before, deliver its result without touching comfyui"""
+        comfy_task_id, s3_keys = cached
+        cached_record = Record(
+            client_task_id=client_task_id,
+            comfy_task_id=comfy_task_id,
+            s3_key=s3_keys[0],
+            status=RecordStatus.UPLOADED,
+            workflow=workflow,
+            accepted_at=accepted_at
+        )
+        cached_record = await RecordRepository.create(cached_record)
+        cached_record.s3_keys = s3_keys
+        progress_hub.register(comfy_task_id, client_task_id)
+        progress_hub.finish(comfy_task_id, 'completed', {'s3_key': s3_keys[0], 's3_keys': s3_keys}, client_task_id)
+        run_in_background(self._deliver_cached(cached_record))
+        return cached_record
+
+    async def submit_prompt(self, prompt: dict, cost: float = 0.0, input_key: str | None = None) -> str:
+        """post a prompt to the comfy server without recording it, return the comfy_task_id"""
+        output_nodes = None
+        if COMFY_IMAGE_DELIVERY == 'websocket':
+            prompt, output_nodes = _to_websocket_output(prompt)
         payload = {
             'prompt': prompt,
             'client_id': self.client_id
         }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(uri, json=payload)
+        try:
+            response = await self.client.post('/prompt', json=payload)
             logger.debug(f'queue prompt response: {response.text}')
             comfy_task_id = response.json()['prompt_id']
-            record = Record(client_task_id=client_task_id, comfy_task_id=comfy_task_id)
-            record = await RecordRepository.create(record)
-            return record
+        except Exception:
+            self.release(cost)
+            if input_key is not None:
+                self.release_input(input_key)
+            raise
+        self._track_queued(comfy_task_id, cost)
+        if input_key is not None:
+            self._task_inputs[comfy_task_id] = input_key
+        if output_nodes is not None:
+            self._ws_output_nodes[comfy_task_id] = output_nodes
+        return comfy_task_id
 
     async def listen(self):
-        """listen messages from the comfy server"""
+        """
+        keep a websocket to the comfy server and process its messages. a node which drops the connection or stops
+        answering pings is unschedulable until it's back, the reconnections are retried with a jittered exponential
+        backoff and the tasks which finished meanwhile are reconciled once reconnected
+        """
         uri = f'ws://{self.endpoint}/ws?clientId={self.client_id}'
-        async with websockets.connect(uri) as websocket:
-            logger.info('connected to comfy server')
-            while True:
-                try:
-                    message = await websocket.recv()
-                    json_data = json.loads(message)
-                    if json_data.get("type") == "executing" and json_data.get("data", {}).get("node") is None:
-                        # comfy server has finished the prompt task
-                        try:
-                            comfy_task_id = json_data['data']['prompt_id']
-                            image = await self._retrieve_image(comfy_task_id)
-                            record = await RecordRepository.retrieve_by_comfy_task_id(comfy_task_id)
-                            s3_resp = await upload_image_to_s3(image)
-                            logger.info(f'uploaded image to s3: {s3_resp}')
-                            if not s3_resp['success']:
-                                logger.error(f'upload image to s3 error: {s3_resp}')
-                                await self.store_failure(record, image)
-                                continue
-
-                            record.s3_key = s3_resp['key']
-                            record = await RecordRepository.update(record)
-                            await self.hook(record)
-                        except Exception as e:
-                            logger.error(f'webhook or s3 error: {e}')
-                            await self.store_failure(record, image)
-                        finally:
-                            await self.clean_file(is_input=False, image_path=record.comfy_filepath)
-
-                    elif json_data['type'] == 'status':
-                        # update queue remaining num
-                        self.queue_remaining = json_data['data']['status']['exec_info']['queue_remaining']
-                        logger.info(f'server {self.client_id} remaining: {self.queue_remaining}')
-
-                except websockets.exceptions.ConnectionClosed:
-                    logger.warning('connection closed, reconnecting...')
-                    await asyncio.sleep(5)
-                    await self.listen()
-                except Exception as e:
-                    logger.error(f'server {self.client_id} websocket error: {e}')
-
-    async def _retrieve_image(self, comfy_task_id: str) -> bytes:
-        """retrieve prompt task result(image) from comfyui"""
-        # 1. get the image path from the comfy server
-        history_uri = f'http://{self.endpoint}/history/{comfy_task_id}'
-        async with httpx.AsyncClient() as client:
-            response = await client.get(history_uri)
-            history = response.json()
+        attempt = 0
+        while True:
+            try:
+                # result images may arrive as binary frames, so don't cap the frame size
+                async with websockets.connect(
+                        uri,
+                        max_size=None,
+                        ping_interval=COMFY_WS_PING_INTERVAL,
+                        ping_timeout=COMFY_WS_PING_TIMEOUT
+                ) as websocket:
+                    logger.info(f'connected to comfy server {self.endpoint}')
+                    self.connected = True
+                    attempt = 0
+                    if coordinator.enabled:
+                        # the other replicas have kept queueing prompts while nobody listened
+                        await self.adopt()
+                    coordinator.status_changed(self)
+                    run_in_background(self.reconcile())
+                    await self._receive(websocket)
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                logger.warning(f'server {self.client_id} connection lost: {e!r}')
+            finally:
+                self.connected = False
+                self._executing = None
+            delay = min(COMFY_RECONNECT_MAX_BACKOFF, COMFY_RECONNECT_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1)
+            attempt += 1
+            self.reconnects += 1
+            logger.warning(f'server {self.client_id} reconnecting in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+    async def _receive(self, websocket):
+        """process the messages of one websocket connection until it's closed"""
+        while True:
+            message = await websocket.recv()
+            try:
+                if isinstance(message, bytes):
+                    self._collect_frame(message)
+                else:
+                    await self._handle_message(json.loads(message))
+            except Exception as e:
+                logger.error(f'server {self.client_id} websocket error: {e}')
+
+    async def _handle_message(self, json_data: dict):
+        """update the state of the comfy server and its tasks from a json message"""
+        if json_data.get("type") == "executing" and json_data.get("data", {}).get("node") is None:
+            # comfy server has finished the prompt task, hand it over to the completion workers
+            # so that a slow s3 upload or webhook never delays the next message
+            comfy_task_id = json_data['data']['prompt_id']
+            self._executing = None
+            if comfy_task_id in self.cleanup_prompts:
+                self._drop_cleanup(comfy_task_id)
+                return
+            if comfy_task_id not in self.in_flight and self._cleanup_posts:
+                # on an idle node a cleanup prompt can finish before the response to its post is read,
+                # it's told apart once the id is known
+                self._finished_unknown[comfy_task_id] = self._pop_frames(comfy_task_id)
+                return
+            await self._finish(comfy_task_id, self._pop_frames(comfy_task_id))
+
+        elif json_data['type'] == 'execution_start':
+            if json_data['data']['prompt_id'] in self.cleanup_prompts:
+                return
+            comfy_task_id = json_data['data']['prompt_id']
+            self._track_started(comfy_task_id)
+            started_at = datetime.now(timezone.utc)
+            self._timelines.setdefault(comfy_task_id, {})['started_at'] = started_at
+            RecordRepository.track_status(comfy_task_id, RecordStatus.RUNNING, started_at=started_at)
+            progress_hub.publish(comfy_task_id, 'execution_start', {})
+
+        elif json_data['type'] == 'execution_error':
+            STAGE_ERRORS.inc('execution')
+            data = json_data['data']
+            progress_hub.publish(data['prompt_id'], 'execution_error', {
+                'node': data.get('node_id'),
+                'message': data.get('exception_message')
+            })
+
+        elif json_data['type'] == 'executing':
+            self._executing = (json_data['data']['prompt_id'], json_data['data']['node'])
+            progress_hub.publish(json_data['data']['prompt_id'], 'executing', {'node': json_data['data']['node']})
+
+        elif json_data['type'] == 'progress':
+            data = json_data['data']
+            progress_hub.publish(data['prompt_id'], 'progress', {
+                'node': data.get('node'),
+                'value': data['value'],
+                'max': data['max']
+            })
+
+        elif json_data['type'] == 'execution_cached':
+            progress_hub.publish(json_data['data']['prompt_id'], 'execution_cached', {'nodes': json_data['data']['nodes']})
+
+        elif json_data['type'] == 'status':
+            # update queue remaining num
+            self.queue_remaining = json_data['data']['status']['exec_info']['queue_remaining']
+            logger.info(f'server {self.client_id} remaining: {self.queue_remaining}')
+            coordinator.status_changed(self)
+
+    def _drop_cleanup(self, comfy_task_id: str):
+        self.cleanup_prompts.discard(comfy_task_id)
+        self._started_at.pop(comfy_task_id, None)
+        self._timelines.pop(comfy_task_id, None)
+
+    async def _resolve_unknown(self):
+        """sort out the unknown prompts which finished while cleanup prompts were posted, once their ids are known"""
+        for comfy_task_id in list(self._finished_unknown):
+            if comfy_task_id in self.cleanup_prompts:
+                del self._finished_unknown[comfy_task_id]
+                self._drop_cleanup(comfy_task_id)
+            elif not self._cleanup_posts:
+                await self._finish(comfy_task_id, self._finished_unknown.pop(comfy_task_id))
+
+    async def _finish(self, comfy_task_id: str, frames: list[tuple[str, bytes]] | None = None):
+        """hand a finished prompt task over to the completion workers"""
+        self._track_finished(comfy_task_id)
+        self._adopted.discard(comfy_task_id)
+        self._timelines.setdefault(comfy_task_id, {})['executed_at'] = datetime.now(timezone.utc)
+        progress_hub.publish(comfy_task_id, 'executed', {})
+        if comfy_task_id in self._task_inputs:
+            self.release_input(self._task_inputs.pop(comfy_task_id))
+        if self.completions.full():
+            logger.warning(f'server {self.client_id} completion queue is full, applying backpressure')
+        await self.completions.put((comfy_task_id, frames))
+
+    async def reconcile(self):
+        """
+        catch up with the prompt tasks which finished or were lost while the websocket was down, and with the ones
+        adopted from a previous run of the service, whose messages went to its own websocket
+        """
+        while self.connected:
+            comfy_task_ids = set(self.in_flight) | self._adopted
+            cleanup_prompts = set(self.cleanup_prompts)
+            if not comfy_task_ids and not cleanup_prompts:
+                return
+            try:
+                response = await self.client.get('/queue')
+                queue = response.json()
+                queued = {item[1] for item in queue['queue_running'] + queue['queue_pending']}
+                # a cleanup prompt which isn't queued anymore has finished while the websocket was down
+                self.cleanup_prompts -= cleanup_prompts - queued
+                for comfy_task_id in comfy_task_ids - queued:
+                    await self._reconcile_task(comfy_task_id)
+            except Exception as e:
+                logger.error(f'server {self.client_id} reconcile error: {e}')
+            if not self._adopted:
+                return
+            # nothing tells us when an adopted task finishes, check them again later
+            await asyncio.sleep(COMFY_WS_PING_INTERVAL)
+
+    async def _reconcile_task(self, comfy_task_id: str):
+        """
+        post-process a task which isn't queued on the comfy server anymore, or mark it failed if it was lost or its
+        images were only sent over the websocket while it was down
+        """
+        response = await self.client.get(f'/history/{comfy_task_id}')
+        history = response.json()
+        if comfy_task_id not in self.in_flight and comfy_task_id not in self._adopted:
+            # its message arrived over the new connection meanwhile
+            return
+        if coordinator.enabled:
+            # nobody listened to the node when it finished, a replica which died may have started post-processing it
+            self._reclaim.add(comfy_task_id)
+        self._adopted.discard(comfy_task_id)
+        if comfy_task_id in history and COMFY_IMAGE_DELIVERY == 'websocket':
+            # SaveImageWebsocket keeps nothing on the comfy server, the images went to the websocket which was down
+            logger.error(f'server {self.client_id} task {comfy_task_id} finished while the websocket was down, '
+                         f'its images were only sent over it')
+            self.missed += 1
+            await self._fail(comfy_task_id, 'images sent while the websocket was down')
+            return
+        if comfy_task_id in history:
+            logger.info(f'server {self.client_id} reconciled finished task {comfy_task_id}')
+            self.reconciled += 1
+            await self._finish(comfy_task_id)
+            return
+        # neither queued nor in the history, the comfy server has restarted since
+        logger.warning(f'server {self.client_id} lost task {comfy_task_id}')
+        self.lost += 1
+        await self._fail(comfy_task_id, 'lost by the comfy server')
+
+    async def _fail(self, comfy_task_id: str, error: str):
+        """mark the records of a task which won't produce any image failed"""
+        STAGE_ERRORS.inc('execution')
+        self._track_finished(comfy_task_id)
+        if comfy_task_id in self._task_inputs:
+            self.release_input(self._task_inputs.pop(comfy_task_id))
+        await singleflight.finish(comfy_task_id)
+        timeline = self._timelines.pop(comfy_task_id, {})
+        self._branches.pop(comfy_task_id, None)
+        self._ws_output_nodes.pop(comfy_task_id, None)
+        self._reclaim.discard(comfy_task_id)
+        progress_hub.finish(comfy_task_id, 'failed', {'error': error})
+        await RecordRepository.update_by_comfy_task_id(comfy_task_id, status=RecordStatus.FAILED, **timeline)
+        await coordinator.finished(self, comfy_task_id, RecordStatus.FAILED, None)
+
+    def stats(self) -> dict:
+        return {
+            'connected': self.connected,
+            'leading': self.leading,
+            'in_flight': len(self.in_flight),
+            'reconnects': self.reconnects,
+            'reconciled': self.reconciled,
+            'lost': self.lost,
+            'missed': self.missed
+        }
+
+    def _collect_frame(self, message: bytes):
+        """keep an image frame sent by the node which is executing now"""
+        if self._executing is None or len(message) <= _FRAME_HEADER_SIZE:
+            return
+        if int.from_bytes(message[:4], 'big') != _PREVIEW_IMAGE_EVENT:
+            return
+        comfy_task_id, node_id = self._executing
+        output_nodes = self._ws_output_nodes.get(comfy_task_id)
+        if output_nodes is not None and node_id not in output_nodes:
+            # a sampler preview, not a result image
+            return
+        frames = self._ws_frames.setdefault(comfy_task_id, {})
+        frames.setdefault(node_id, []).append(message[_FRAME_HEADER_SIZE:])
+
+    def _pop_frames(self, comfy_task_id: str) -> list[tuple[str, bytes]] | None:
+        """take the (node_id, image) delivered over the websocket for a finished prompt task, in the order received"""
+        output_nodes = self._ws_output_nodes.pop(comfy_task_id, None)
+        frames = self._ws_frames.pop(comfy_task_id, {})
+        if output_nodes is None:
+            if coordinator.enabled and COMFY_IMAGE_DELIVERY == 'websocket' and frames:
+                # queued by another replica, every image frame of its prompt is a result unless comfyui sends previews
+                return [(node_id, image) for node_id, images in frames.items() for image in images]
+            return None
+        images = [(node_id, image) for node_id, images in frames.items() if node_id in output_nodes for image in images]
+        return images or None
+
+    def start_workers(self) -> list[asyncio.Task]:
+        """start the pool of completion workers and the file cleanup worker of the comfy server"""
+        workers = [asyncio.create_task(self._completion_worker()) for _ in range(COMPLETION_WORKERS)]
+        workers.append(asyncio.create_task(self._cleanup_worker()))
+        return workers
+
+    async def _completion_worker(self):
+        """post-process finished prompt tasks from the completion queue"""
+        while True:
+            comfy_task_id, frames = await self.completions.get()
+            try:
+                await self._process_completion(comfy_task_id, frames)
+            except Exception as e:
+                logger.error(f'server {self.client_id} completion {comfy_task_id} error: {e}')
+            finally:
+                self.completions.task_done()
+
+    async def _process_completion(self, comfy_task_id: str, frames: list[tuple[str, bytes]] | None = None):
+        """
+        retrieve every output image of a finished prompt task, upload them to s3 and callback the clients.
+        the images are downloaded concurrently and each one is uploaded as soon as it's there.
+        the records of a batched prompt each get the images of their branch.
+        with replicas, the task is claimed first and the result is broadcast to the one which queued it
+        """
+        timings = {}
+        records = []
+        images: list[tuple[str, str | None, bytes | None]] = []  # (node_id, comfy path, bytes)
+        # the timestamps of the task so far are written with its result, in the same statement
+        timeline = self._timelines.pop(comfy_task_id, {})
+        branches = self._branches.pop(comfy_task_id, None)
+        key = await singleflight.finish(comfy_task_id)
+        broadcast = None  # the status of the task for the other replicas, uploaded if any record got its images
+        if coordinator.enabled:
+            reclaim = comfy_task_id in self._reclaim
+            self._reclaim.discard(comfy_task_id)
+            claimed = await self._claim(comfy_task_id, reclaim)
+            if claimed is None:
+                return
+            broadcast = RecordStatus.FAILED
+            if branches is None and any(record.branch_nodes for record in claimed):
+                # a batched prompt queued by another replica
+                branches = {record.client_task_id: (set(record.branch_nodes or ()), None) for record in claimed}
+        try:
+            if frames is None:
+                with _timed(timings, 'history'):
+                    images = [(node_id, path, None) for node_id, path in await self._output_images(comfy_task_id)]
+            else:
+                images = [(node_id, None, image) for node_id, image in frames]
+            if not images:
+                raise ValueError('no output image')
+            with _timed(timings, 'images'):
+                results = await asyncio.gather(
+                    *(self._store_image(image_path, image, timeline) for _, image_path, image in images),
+                    return_exceptions=True
+                )
+            RecordRepository.track_status(
+                comfy_task_id,
+                RecordStatus.FETCHED,
+                comfy_filepath=images[0][1],
+                fetched_at=timeline.get('fetched_at')
+            )
+
+            # the records sharing the images, or a branch per record of a batched prompt
+            batched = branches is not None
+            if not batched:
+                branches = {None: (None, key)}
+            owners = {node_id: owner for owner, (output_nodes, _) in branches.items() for node_id in output_nodes or ()}
+            uploaded = []
+            failed = set()
+            for position, ((node_id, image_path, _), result) in enumerate(zip(images, results)):
+                owner = owners.get(node_id)
+                if isinstance(result, Exception):
+                    logger.error(f'retrieve image {position} of {comfy_task_id} error: {result}')
+                    failed.add(owner)
+                    continue
+                image, s3_resp = result
+                if not s3_resp['success']:
+                    logger.error(f'upload image {position} of {comfy_task_id} to s3 error: {s3_resp}')
+                    await self.store_failure(comfy_task_id, image_path or f'{comfy_task_id}_{position}.png', image)
+                    failed.add(owner)
+                    continue
+                uploaded.append(RecordImage(
+                    comfy_task_id=comfy_task_id,
+                    position=position,
+                    node_id=node_id,
+                    client_task_id=owner,
+                    comfy_filepath=image_path,
+                    s3_key=s3_resp['key']
+                ))
+            logger.info(f'uploaded {len(uploaded)}/{len(images)} images of {comfy_task_id} to s3')
+
+            # the clients expect every image of their task, a partial result is a failure
+            completed = {}  # owner -> (comfy path of its first image, s3 keys), for the owners which got them all
+            for owner in branches:
+                owned = [image for image in uploaded if image.client_task_id == owner]
+                if owned and owner not in failed:
+                    completed[owner] = (owned[0].comfy_filepath, [image.s3_key for image in owned])
+            if batched:
+                values = {'status': RecordStatus.FAILED}
+                per_record = {
+                    owner: {'comfy_filepath': comfy_filepath, 's3_key': s3_keys[0], 'status': RecordStatus.UPLOADED}
+                    for owner, (comfy_filepath, s3_keys) in completed.items()
+                }
+            elif completed:
+                comfy_filepath, s3_keys = completed[None]
+                values = {'comfy_filepath': comfy_filepath, 's3_key': s3_keys[0], 'status': RecordStatus.UPLOADED}
+                per_record = {}
+            else:
+                values = {'comfy_filepath': images[0][1], 'status': RecordStatus.FAILED}
+                per_record = {}
+            if completed:
+                timeline['uploaded_at'] = datetime.now(timezone.utc)
+
+            # the path and the key of every record of the task are written at once, with the image rows
+            with _timed(timings, 'db_write'):
+                records = await RecordRepository.update_with_images(
+                    comfy_task_id,
+                    uploaded if completed else [],
+                    per_record,
+                    **values,
+                    **timeline
+                )
+                for owner, (_, s3_keys) in completed.items():
+                    if branches[owner][1] is not None:
+                        await result_cache.put(branches[owner][1], comfy_task_id, s3_keys)
+
+            delivered = []
+            for record in records:
+                owner = record.client_task_id if batched else None
+                if owner in completed:
+                    record.s3_keys = completed[owner][1]
+                    delivered.append(record)
+            if broadcast is not None and completed:
+                broadcast = RecordStatus.UPLOADED
+            for owner in branches:
+                if owner in completed:
+                    s3_keys = completed[owner][1]
+                    progress_hub.finish(comfy_task_id, 'completed', {'s3_key': s3_keys[0], 's3_keys': s3_keys}, owner)
+                else:
+                    progress_hub.finish(comfy_task_id, 'failed', {}, owner)
+        except Exception as e:
+            logger.error(f'post-process task {comfy_task_id} error: {e}')
+            progress_hub.finish(comfy_task_id, 'failed', {})
+            try:
+                await RecordRepository.update_by_comfy_task_id(comfy_task_id, status=RecordStatus.FAILED, **timeline)
+            except Exception as e:
+                logger.error(f'mark task {comfy_task_id} failed error: {e}')
+        else:
+            # the results are stored, the records stay uploaded whatever happens to their webhooks
+            try:
+                with _timed(timings, 'webhook'):
+                    await self.deliver(delivered)
+            except Exception as e:
+                logger.error(f'deliver the webhooks of task {comfy_task_id} error: {e}')
+        finally:
+            for _, image_path, _ in images:
+                if image_path:
+                    self.clean_file(is_input=False, image_path=image_path)
+            stages = ', '.join(f'{stage}={seconds * 1000:.1f}ms' for stage, seconds in timings.items())
+            logger.info(f'task {comfy_task_id} post-processed for {len(records)} records, {len(images)} images: {stages}')
+            if broadcast is not None:
+                execution = None
+                if 'started_at' in timeline and 'executed_at' in timeline:
+                    execution = (timeline['executed_at'] - timeline['started_at']).total_seconds()
+                await coordinator.finished(self, comfy_task_id, broadcast, execution)
+
+    async def _claim(self, comfy_task_id: str, reclaim: bool = False) -> list[Record] | None:
+        """
+        take the post-processing of a finished task for this replica, None if another one has taken it.
+        a prompt queued by another replica can finish before that one has recorded it, its records are waited for
+        """
+        deadline = time.monotonic() + COORDINATION_RECORD_WAIT
+        while (records := await RecordRepository.claim_completion(comfy_task_id, reclaim)) is None:
+            if time.monotonic() > deadline:
+                logger.warning(f'server {self.client_id} finished task {comfy_task_id} was never recorded')
+                return None
+            await asyncio.sleep(0.05)
+        if not records:
+            logger.info(f'server {self.client_id} finished task {comfy_task_id} is post-processed by another replica')
+            return None
+        return records
+
+    async def settle(self, comfy_task_id: str, results: dict[str, list[str] | None], execution: float | None):
+        """
+        a prompt queued here has been post-processed by the replica leading the comfy server: update the load
+        accounting, release its input, fill the result cache and close the progress streams of its records.
+        results holds the s3 keys by client_task_id, None for the failed records, execution the seconds it ran for.
+        without any result, the whole task has failed
+        """
+        if comfy_task_id not in self.in_flight:
+            return
+        self._track_finished(comfy_task_id, execution)
+        if comfy_task_id in self._task_inputs:
+            self.release_input(self._task_inputs.pop(comfy_task_id))
+        self._ws_output_nodes.pop(comfy_task_id, None)
+        key = await singleflight.finish(comfy_task_id)
+        branches = self._branches.pop(comfy_task_id, None) or {None: (None, key)}
+        try:
+            for owner, (_, branch_key) in branches.items():
+                if owner is None:
+                    s3_keys = next((s3_keys for s3_keys in results.values() if s3_keys), None)
+                else:
+                    s3_keys = results.get(str(owner))
+                if s3_keys and branch_key is not None:
+                    await result_cache.put(branch_key, comfy_task_id, s3_keys)
+                if s3_keys and owner is None and key is not None:
+                    # identical requests attached to the prompt here after the leader had written its result
+                    late = await RecordRepository.update_queued(
+                        comfy_task_id,
+                        s3_key=s3_keys[0],
+                        status=RecordStatus.UPLOADED
+                    )
+                    for record in late:
+                        record.s3_keys = s3_keys
+                        results[str(record.client_task_id)] = s3_keys
+                    if late:
+                        await self.deliver(late)
+        except Exception as e:
+            logger.error(f'settle task {comfy_task_id} error: {e}')
+        if not results:
+            progress_hub.finish(comfy_task_id, 'failed', {})
+        for client_task_id, s3_keys in results.items():
+            if s3_keys:
+                data = {'s3_key': s3_keys[0], 's3_keys': s3_keys}
+                progress_hub.finish(comfy_task_id, 'completed', data, int(client_task_id))
+            else:
+                progress_hub.finish(comfy_task_id, 'failed', {}, int(client_task_id))
+
+    async def settled(self, comfy_task_id: str, status: str, execution: float | None):
+        """
+        the leader has broadcast that a prompt has been post-processed, read the results of an uploaded one from
+        its records. a task left unfinished by the leader is settled as failed, nothing else would release it
+        """
+        if comfy_task_id not in self.in_flight:
+            return
+        results = {}
+        if status != RecordStatus.FAILED:
+            try:
+                records = await RecordRepository.retrieve_finished([comfy_task_id])
+            except Exception as e:
+                # caught up with at a next heartbeat
+                logger.error(f'server {self.client_id} read results of {comfy_task_id} error: {e}')
+                return
+            results = {str(record.client_task_id): record.s3_keys for record in records}
+        await self.settle(comfy_task_id, results, execution)
+
+    async def catch_up(self):
+        """settle the prompts queued here which have finished while the broadcasts of the leader were missed"""
+        if not self.in_flight:
+            return
+        try:
+            records = await RecordRepository.retrieve_finished(list(self.in_flight))
+        except Exception as e:
+            logger.error(f'server {self.client_id} catch up error: {e}')
+            return
+        results: dict[str, dict[str, list[str] | None]] = {}
+        for record in records:
+            results.setdefault(record.comfy_task_id, {})[str(record.client_task_id)] = record.s3_keys
+        for comfy_task_id, task_results in results.items():
+            await self.settle(comfy_task_id, task_results, None)
+
+    async def _store_image(self, image_path: str | None, image: bytes | None, timeline: dict) -> tuple[bytes, dict]:
+        """download an output image unless it came over the websocket, then upload it to s3"""
+        if image is None:
+            with track('fetch'):
+                response = await self.client.get('/view', params={'filename': image_path})
+                image = response.content
+        # the last image downloaded sets it
+        timeline['fetched_at'] = datetime.now(timezone.utc)
+        return image, await upload_image_to_s3(image)
+
+    async def _output_images(self, comfy_task_id: str) -> list[tuple[str, str]]:
+        """the (node_id, path on the comfy server) of every image saved by the output nodes of a finished prompt task"""
+        response = await self.client.get(f'/history/{comfy_task_id}')
+        history = response.json()
         output_info = history[comfy_task_id]['outputs']
-        for key in output_info:
-            if 'images' not in output_info[key]:
-                continue
-            image_info = output_info[key]['images'][0]  # note now only retrieve the first image
-            image_path = image_info['filename']
-            if image_info['subfolder']:
-                image_path = f"{image_info['subfolder']}/{image_path}"
-
-            record = await RecordRepository.retrieve_by_comfy_task_id(comfy_task_id)
-            record.comfy_filepath = image_path
-            await RecordRepository.update(record)
-
-            # 2. retrieve the image from the comfy server
-            view_uri = f'http://{self.endpoint}/view'
-            params = {'filename': image_path}
-            async with httpx.AsyncClient() as client:
-                response = await client.get(view_uri, params=params)
-                return response.content
+        images = []
+        for node_id, output in output_info.items():
+            for image_info in output.get('images', ()):
+                image_path = image_info['filename']
+                if image_info['subfolder']:
+                    image_path = f"{image_info['subfolder']}/{image_path}"
+                images.append((node_id, image_path))
+        return images
+
+    async def _deliver_cached(self, record: Record):
+        try:
+            await self.deliver([record])
+        except Exception as e:
+            logger.error(f'webhook of cached result {record.client_task_id} error: {e}')
+
+    async def deliver(self, records: list[Record]):
+        """hand the callbacks of finished records to the webhook outbox, or post them right away without it"""
+        if webhook_outbox.enabled:
+            await webhook_outbox.add(records)
+            return
+        results = await asyncio.gather(*(self.hook(record) for record in records), return_exceptions=True)
+        sent = []
+        for record, result in zip(records, results):
+            if isinstance(result, Exception):
+                logger.error(f'webhook of {record.client_task_id} error: {result!r}')
+            else:
+                sent.append(record.client_task_id)
+        if not sent:
+            return
+        try:
+            await RecordRepository.callbacks_sent(sent)
+        except Exception as e:
+            # the callbacks went through, only their timestamps are missing
+            logger.error(f'record callbacks of {len(sent)} records error: {e}')
 
     async def hook(self, record: Record):
-        """callback to the client server"""
+        """callback to the client server, any 2xx answer is a success whatever its body"""
         uri = f'{self.callback_base_url}/{record.client_task_id}'
-        async with httpx.AsyncClient() as client:
-            response = await client.post(uri, json=record.to_dict())
+        with track('webhook'):
+            response = await post_webhook(uri, record.to_dict())
             logger.debug(f'callback response: {response.text}')
-            return response.json()
+            response.raise_for_status()
 
-    async def clean_file(self, is_input: bool, image_path: str):
-        """clean input or output file from the comfy server"""
-        prompt = CLEAN_FILE_PROMPT_TEMPLATE.substitute(type='input' if is_input else 'output', path=image_path)
-        prompt_json = json.loads(prompt)
-        uri = f'http://{self.endpoint}/prompt'
-        payload = {
-            'prompt': prompt_json,
-            # NOTE ignore client_id for now, in case of tracking the clean file system message
-        }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(uri, json=payload)
-            logger.debug(f'clean file response: {response.text}')
+    def clean_file(self, is_input: bool, image_path: str):
+        """schedule an input or output file to be deleted from the comfy server with the next cleanup prompt"""
+        self.cleaner.add(is_input, image_path)
+
+    async def _cleanup_worker(self):
+        """queue a cleanup prompt for the pending files periodically, or as soon as a full batch is pending"""
+        while True:
+            try:
+                await asyncio.wait_for(self.cleaner.ready.wait(), CLEANUP_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush_cleanup()
+
+    async def flush_cleanup(self):
+        """
+        delete the pending files with one prompt per batch. the prompts are queued with our client_id,
+        so their messages are recognised and they aren't counted as load by the scheduler.
+        while another replica leads the comfy server the files are handed over to it, it deletes them with its own
+        """
+        if not self.leading:
+            await self._hand_over_cleanup()
+            return
+        while batch := self.cleaner.take():
+            payload = {'prompt': build_clean_prompt(batch), 'client_id': self.client_id}
+            self._cleanup_posts += 1
+            try:
+                response = await self.client.post('/prompt', json=payload)
+                logger.debug(f'clean file response: {response.text}')
+                self.cleanup_prompts.add(response.json()['prompt_id'])
+            except Exception as e:
+                logger.error(f'server {self.client_id} clean {len(batch)} files error: {e}')
+                self.cleaner.restore(batch)
+                return
+            finally:
+                self._cleanup_posts -= 1
+                await self._resolve_unknown()
+            self.cleaner.sent(batch)
+
+    async def _hand_over_cleanup(self):
+        if not self.connected:
+            # no leader to take them, they stay pending
+            return
+        while batch := self.cleaner.take():
+            try:
+                await coordinator.clean(self, batch)
+            except Exception as e:
+                logger.error(f'server {self.client_id} hand over {len(batch)} files to clean error: {e}')
+                self.cleaner.restore(batch)
+                return
 
     async def upload_image(self, image: bytes):
         """upload image to the comfy server"""
         file_name = f'{uuid.uuid4()}.png'
-        uri = f'http://{self.endpoint}/upload/image'
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(uri, files={'image': (file_name, image, 'image/jpeg')})
-            logger.debug(f'upload image response: {response.text}')
-            return response.json()
+        response = await self.client.post('/upload/image', files={'image': (file_name, image, 'image/jpeg')})
+        logger.debug(f'upload image response: {response.text}')
+        return response.json()
+
+    async def upload_input(self, image: bytes) -> tuple[str, str]:
+        """
+        upload an img2img input image unless the same bytes are already on the comfy server,
+        return its path there and its content hash, which holds a reference until it's passed to queue_prompt
+        """
+        key = content_hash(image)
+        while True:
+            image_path = self.inputs.acquire(key)
+            if image_path is not None:
+                return image_path, key
+            uploading = self._uploading.get(key)
+            if uploading is None:
+                break
+            # the same image is being uploaded for another request
+            await asyncio.wait([uploading])
+
+        self._uploading[key] = asyncio.get_running_loop().create_future()
+        try:
+            image_path = uploaded_path(await self.upload_image(image))
+            self._clean_inputs(self.inputs.add(key, image_path, len(image)))
+        finally:
+            self._uploading.pop(key).set_result(None)
+        return image_path, key
+
+    def release_input(self, key: str):
+        """drop a reference on an input upload, the evicted inputs nothing references anymore are deleted"""
+        self._clean_inputs(self.inputs.release(key))
+
+    def _clean_inputs(self, image_paths: list[str]):
+        for image_path in image_paths:
+            self.clean_file(is_input=True, image_path=image_path)
 
-    async def store_failure(self, record: Record, image: bytes):
+    async def upload_image_stream(self, chunks: AsyncIterator[bytes], content_type: str = 'image/png') -> dict:
+        """upload an image to the comfy server chunk by chunk, the whole image is never held in memory"""
+        boundary = uuid.uuid4().hex
+        file_name = f'{uuid.uuid4()}.png'
+
+        async def body() -> AsyncIterator[bytes]:
+            yield (
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="image"; filename="{file_name}"\r\n'
+                f'Content-Type: {content_type}\r\n\r\n'
+            ).encode()
+            async for chunk in chunks:
+                yield chunk
+            yield f'\r\n--{boundary}--\r\n'.encode()
+
+        response = await self.client.post(
+            '/upload/image',
+            content=body(),
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        )
+        logger.debug(f'upload image response: {response.text}')
+        return response.json()
+
+    async def store_failure(self, comfy_task_id: str, comfy_filepath: str | None, image: bytes):
         """Store failure prompt result in the fallback path."""
-        file_path = os.path.join(self.fallback_path, record.comfy_filepath)
+        file_path = os.path.join(self.fallback_path, comfy_filepath or f'{comfy_task_id}.png')
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
         async with aiofiles.open(file_path, 'wb') as f:
             await f.write(image)
 
 
-comfy_servers = [ComfyServer(endpoint) for endpoint in COMFY_ENDPOINTS]
\ No newline at end of file
+comfy_servers = [ComfyServer(endpoint) for endpoint in COMFY_ENDPOINTS]
+
+register(Gauge(
+    'comfy_queue_remaining',
+    'prompts queued or running on each comfy node as last reported, cleanups included',
+    ('node',),
+    lambda: (((server.endpoint,), server.queue_remaining) for server in comfy_servers)
+))
+register(Gauge(
+    'comfy_in_flight_tasks',
+    'tasks queued on each comfy node by the service and not finished yet',
+    ('node',),
+    lambda: (((server.endpoint,), len(server.in_flight)) for server in comfy_servers)
+))
+register(Gauge(
+    'comfy_completion_backlog',
+    'finished tasks of each comfy node waiting for a completion worker',
+    ('node',),
+    lambda: (((server.endpoint,), server.completions.qsize()) for server in comfy_servers)
+))
+register(Gauge(
+    'comfy_connected',
+    'whether the websocket to each comfy node is up',
+    ('node',),
+    lambda: (((server.endpoint,), int(server.connected)) for server in comfy_servers)
+))
+register(Gauge(
+    'comfy_leading',
+    'whether this replica leads each comfy node, always with a single replica',
+    ('node',),
+    lambda: (((server.endpoint,), int(server.leading)) for server in comfy_servers)
+))
+
+
+async def open_http_clients():
+    """open the pooled http clients of every comfy server and the shared webhook client"""
+    await open_webhook_client()
+    for comfy_server in comfy_servers:
+        await comfy_server.open()
+
+
+async def close_http_clients():
+    """close every pooled http client"""
+    for comfy_server in comfy_servers:
+        await comfy_server.close()
+    await close_webhook_client()
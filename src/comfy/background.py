@@ -0,0 +1,11 @@
+import asyncio
+
+_tasks: set[asyncio.Task] = set()
+
+
+def run_in_background(coroutine) -> asyncio.Task:
+    """run a coroutine nobody awaits, keeping a reference to its task as the event loop only keeps weak ones"""
+    task = asyncio.create_task(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
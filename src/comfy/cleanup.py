@@ -0,0 +1,42 @@
+import asyncio
+
+from config import CLEANUP_BATCH_SIZE
+
+
+class FileCleaner:
+    """
+    Accumulator of the input and output files to delete from one comfy server.
+
+    The files are handed out in batches of at most `batch_size`, each deleted by a single cleanup prompt.
+    `ready` is set as soon as a full batch is pending, otherwise the batches are flushed periodically.
+    """
+
+    def __init__(self, batch_size: int = CLEANUP_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.ready = asyncio.Event()
+        self.prompts = 0
+        self.files = 0
+        self._pending: list[tuple[str, str]] = []  # (type, path)
+
+    def add(self, is_input: bool, path: str):
+        self._pending.append(('input' if is_input else 'output', path))
+        if len(self._pending) >= self.batch_size:
+            self.ready.set()
+
+    def take(self) -> list[tuple[str, str]]:
+        """the next batch of files to delete"""
+        batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+        if len(self._pending) < self.batch_size:
+            self.ready.clear()
+        return batch
+
+    def restore(self, batch: list[tuple[str, str]]):
+        """put back a batch whose cleanup prompt couldn't be queued, it's retried with the next flush"""
+        self._pending[:0] = batch
+
+    def sent(self, batch: list[tuple[str, str]]):
+        self.prompts += 1
+        self.files += len(batch)
+
+    def stats(self) -> dict:
+        return {'prompts': self.prompts, 'files': self.files, 'pending': len(self._pending)}
@@ -0,0 +1,241 @@
+import asyncio
+import hashlib
+import json
+import logging
+import uuid
+from typing import TYPE_CHECKING
+
+import psycopg
+
+from comfy.background import run_in_background
+from config import COORDINATION_CHANNEL, COORDINATION_ENABLED, COORDINATION_HEARTBEAT
+from database import conninfo
+from database.repository import CoordinationRepository
+from database.write_behind import record_write_behind
+
+if TYPE_CHECKING:
+    from comfy import ComfyServer
+
+logger = logging.getLogger(__name__)
+
+# postgres rejects the NOTIFY payloads of 8000 bytes and more
+_MAX_PAYLOAD = 7000
+
+
+class Coordinator:
+    """
+    Share the comfy servers between several replicas of the service.
+
+    Each node is led by the replica holding its postgres advisory lock. Only the leader keeps a websocket to the node,
+    so every prompt is post-processed once whichever replica has queued it: all of them queue their prompts with the
+    same client id per node, which is the one the leader listens with. The leader broadcasts the queue state of its
+    nodes and the ids of the tasks it has post-processed on a LISTEN/NOTIFY channel, the replicas which queued them
+    read the results from the records and settle their own accounting. They also catch up with the records at every
+    heartbeat, in case a broadcast went missing. The files the other replicas want deleted from a node are handed over
+    to its leader, so every cleanup prompt is one it recognises.
+
+    The locks live as long as the session which took them. A replica which dies releases them and another one takes
+    its nodes over at its next heartbeat, catching up with the tasks left unfinished from the records.
+    """
+
+    def __init__(
+            self,
+            enabled: bool = COORDINATION_ENABLED,
+            channel: str = COORDINATION_CHANNEL,
+            heartbeat: float = COORDINATION_HEARTBEAT
+    ):
+        self.enabled = enabled
+        self.channel = channel
+        self.heartbeat = heartbeat
+        self.replica_id = uuid.uuid4().hex[:12]
+        self.takeovers = 0
+        self.notified = 0
+        self.received = 0
+        self._servers: dict[str, 'ComfyServer'] = {}
+        self._listeners: dict[str, asyncio.Task] = {}  # endpoint -> websocket listener of the nodes led here
+        self._last_status: dict[str, float] = {}  # endpoint -> loop time of the latest status of its leader
+        self._pending_status: set[str] = set()
+        self._lock_conn: psycopg.AsyncConnection | None = None
+
+    @staticmethod
+    def client_id(endpoint: str) -> str:
+        """the client id every replica queues its prompts on a node with"""
+        return uuid.uuid5(uuid.NAMESPACE_URL, f'comfy-node://{endpoint}').hex
+
+    @staticmethod
+    def lock_key(endpoint: str) -> int:
+        """the advisory lock of a node, a signed bigint"""
+        digest = hashlib.sha256(f'comfy-node://{endpoint}'.encode()).digest()
+        return int.from_bytes(digest[:8], 'big', signed=True)
+
+    def start(self, servers: list['ComfyServer']) -> list[asyncio.Task]:
+        """start the leader election and the notification listener when the coordination is enabled"""
+        if not self.enabled:
+            return []
+        if record_write_behind.enabled:
+            # the leader of a node must see the records the other replicas have just written
+            raise RuntimeError('the coordination of replicas needs WRITE_BEHIND_ENABLED=false')
+        self._servers = {server.endpoint: server for server in servers}
+        return [asyncio.create_task(self._elect()), asyncio.create_task(self._follow())]
+
+    async def stop(self):
+        """stop listening to the nodes led here and release their locks"""
+        self._abdicate()
+        if self._lock_conn is not None:
+            await self._lock_conn.close()
+            self._lock_conn = None
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'replica': self.replica_id,
+            'leading': sorted(self._listeners),
+            'takeovers': self.takeovers,
+            'notified': self.notified,
+            'received': self.received
+        }
+
+    async def _elect(self):
+        """take the lock of every node without a leader, broadcast the status of the nodes led here"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if self._lock_conn is None:
+                    self._lock_conn = await psycopg.AsyncConnection.connect(conninfo, autocommit=True)
+                # the locks held here are lost with the session, stop listening as soon as it's gone
+                await self._lock_conn.execute('SELECT 1')
+                for endpoint, server in self._servers.items():
+                    if endpoint in self._listeners:
+                        continue
+                    lock_key = self.lock_key(endpoint)
+                    cursor = await self._lock_conn.execute('SELECT pg_try_advisory_lock(%s)', (lock_key,))
+                    if (await cursor.fetchone())[0]:
+                        self._lead(server)
+                for endpoint in self._listeners:
+                    await self._publish_status(self._servers[endpoint])
+            except Exception as e:
+                logger.error(f'replica {self.replica_id} lost its advisory locks: {e!r}')
+                self._abdicate()
+                if self._lock_conn is not None:
+                    await self._lock_conn.close()
+                    self._lock_conn = None
+            # a node whose leader has stopped broadcasting is unschedulable until another replica takes it over
+            for endpoint, server in self._servers.items():
+                silent = loop.time() - self._last_status.get(endpoint, 0)
+                if endpoint not in self._listeners and silent > 3 * self.heartbeat:
+                    server.connected = False
+            for endpoint, server in self._servers.items():
+                if endpoint not in self._listeners:
+                    await server.catch_up()
+            await asyncio.sleep(self.heartbeat)
+
+    def _lead(self, server: 'ComfyServer'):
+        logger.info(f'replica {self.replica_id} leads comfy server {server.endpoint}')
+        self.takeovers += 1
+        server.leading = True
+        self._listeners[server.endpoint] = asyncio.create_task(self._take_over(server))
+
+    async def _take_over(self, server: 'ComfyServer'):
+        if asyncio.get_running_loop().time() - self._last_status.get(server.endpoint, 0) < 3 * self.heartbeat:
+            # give the previous leader a heartbeat to notice it has lost the lock and close its websocket,
+            # comfyui drops the socket of a client id when an older connection with the same id is closed
+            await asyncio.sleep(self.heartbeat)
+        await server.listen()
+
+    def _abdicate(self):
+        for endpoint, listener in self._listeners.items():
+            listener.cancel()
+            self._servers[endpoint].leading = False
+            logger.warning(f'replica {self.replica_id} stopped leading comfy server {endpoint}')
+        self._listeners.clear()
+
+    def status_changed(self, server: 'ComfyServer'):
+        """broadcast the queue state of a node led here, coalesced with the broadcast not sent yet"""
+        if not self.enabled or server.endpoint in self._pending_status:
+            return
+        self._pending_status.add(server.endpoint)
+        run_in_background(self._publish_status(server))
+
+    async def _publish_status(self, server: 'ComfyServer'):
+        self._pending_status.discard(server.endpoint)
+        try:
+            await self._notify({
+                'type': 'status',
+                'node': server.endpoint,
+                'connected': server.connected,
+                'queue_remaining': server.task_queue_remaining
+            })
+        except Exception as e:
+            logger.error(f'notify status of comfy server {server.endpoint} error: {e}')
+
+    async def finished(self, server: 'ComfyServer', comfy_task_id: str, status: str, execution: float | None):
+        """
+        broadcast that a task has been post-processed, status is uploaded when any of its records got its images and
+        failed otherwise. execution is the seconds the prompt ran for. the results stay in the records, the payload
+        of a notification is limited
+        """
+        if not self.enabled:
+            return
+        try:
+            await self._notify({
+                'type': 'finished',
+                'node': server.endpoint,
+                'comfy_task_id': comfy_task_id,
+                'status': status,
+                'execution': execution
+            })
+        except Exception as e:
+            logger.error(f'notify finished task {comfy_task_id} error: {e}')
+
+    async def clean(self, server: 'ComfyServer', files: list[tuple[str, str]]):
+        """hand (type, path) files to delete from a node over to its leader, in notifications small enough"""
+        chunk, size = [], 0
+        for file in files:
+            file_size = len(json.dumps(file)) + 2
+            if chunk and size + file_size > _MAX_PAYLOAD:
+                await self._notify({'type': 'clean', 'node': server.endpoint, 'files': chunk})
+                chunk, size = [], 0
+            chunk.append(file)
+            size += file_size
+        if chunk:
+            await self._notify({'type': 'clean', 'node': server.endpoint, 'files': chunk})
+
+    async def _notify(self, message: dict):
+        await CoordinationRepository.notify(self.channel, json.dumps({'replica': self.replica_id, **message}))
+        self.notified += 1
+
+    async def _follow(self):
+        """listen to the broadcasts of the leaders, the ones sent while the connection was down are caught up with"""
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as conn:
+                    await conn.execute(f'LISTEN {self.channel}')
+                    for endpoint, server in self._servers.items():
+                        if endpoint not in self._listeners:
+                            await server.catch_up()
+                    async for notify in conn.notifies():
+                        self._receive(json.loads(notify.payload))
+            except Exception as e:
+                logger.error(f'replica {self.replica_id} listen to {self.channel} error: {e!r}')
+            await asyncio.sleep(self.heartbeat)
+
+    def _receive(self, message: dict):
+        server = self._servers.get(message['node'])
+        if server is None or message['replica'] == self.replica_id:
+            return
+        self.received += 1
+        if message['type'] == 'status':
+            if server.endpoint in self._listeners:
+                # sent by the previous leader
+                return
+            self._last_status[server.endpoint] = asyncio.get_running_loop().time()
+            server.queue_remaining = message['queue_remaining']
+            server.connected = message['connected']
+        elif message['type'] == 'finished':
+            run_in_background(server.settled(message['comfy_task_id'], message['status'], message['execution']))
+        elif message['type'] == 'clean' and server.endpoint in self._listeners:
+            for file_type, path in message['files']:
+                server.clean_file(is_input=file_type == 'input', image_path=path)
+
+
+coordinator = Coordinator()
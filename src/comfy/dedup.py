@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Awaitable, Callable
+
+from config import DEDUP_ENABLED
+from database import Record
+
+logger = logging.getLogger(__name__)
+
+
+def prompt_hash(prompt: dict) -> str:
+    """hash of the canonical prompt graph, node titles in _meta don't change the result so they're left out"""
+    canonical = {
+        node_id: {key: value for key, value in node.items() if key != '_meta'}
+        for node_id, node in prompt.items()
+    }
+    data = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class Singleflight:
+    """
+    Coalesce identical prompts while one of them is in flight.
+
+    The first request of a prompt submits it, every identical request arriving before it finishes
+    is attached to the same comfy_task_id and gets its own Record, so the result is delivered to all of them.
+    The prompt runs on the comfy server of the first request, whichever server the others were scheduled on.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._inflight: dict[str, asyncio.Future] = {}  # prompt hash -> future of the (comfy_task_id, comfy_endpoint)
+        self._hashes: dict[str, str] = {}  # comfy_task_id -> prompt hash
+        self._writes: dict[str, list[asyncio.Future]] = {}  # comfy_task_id -> Record inserts of attached requests
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            'enabled': DEDUP_ENABLED,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'inflight': len(self._inflight)
+        }
+
+    async def run(
+            self,
+            key: str,
+            submit: Callable[[], Awaitable[tuple[str, str]]],
+            record: Callable[[str, str], Awaitable[Record]]
+    ) -> Record:
+        """
+        submit the prompt of hash key unless an identical one is in flight, submit returns its comfy_task_id and the
+        endpoint of the comfy server it runs on. then record the request against them
+        """
+        future = self._inflight.get(key) if DEDUP_ENABLED else None
+        if future is not None:
+            self.hits += 1
+            comfy_task_id, comfy_endpoint = await asyncio.shield(future)
+            logger.info(f'coalesced prompt {key[:12]} into comfy task {comfy_task_id}, hit rate: {self.hit_rate:.2%}')
+        else:
+            self.misses += 1
+            future = asyncio.get_running_loop().create_future()
+            if DEDUP_ENABLED:
+                self._inflight[key] = future
+            try:
+                comfy_task_id, comfy_endpoint = await submit()
+            except Exception as e:
+                self._inflight.pop(key, None)
+                future.set_exception(e)
+                future.exception()  # the attached requests get the error, don't warn if there are none
+                raise
+            future.set_result((comfy_task_id, comfy_endpoint))
+            self._hashes[comfy_task_id] = key
+
+        return await self.attach(comfy_task_id, record(comfy_task_id, comfy_endpoint))
+
+    async def attach(self, comfy_task_id: str, write: Awaitable):
+        """write the records of a comfy task, its post-processing waits for them in finish"""
+        write = asyncio.ensure_future(write)
+        self._writes.setdefault(comfy_task_id, []).append(write)
+        return await write
+
+    def pending(self, comfy_task_id: str) -> asyncio.Future:
+        """
+        register a write of the records of a comfy task the caller makes later, e.g. with the other tasks of a batch.
+        its post-processing waits in finish until the caller resolves the future
+        """
+        write = asyncio.get_running_loop().create_future()
+        self._writes.setdefault(comfy_task_id, []).append(write)
+        return write
+
+    async def finish(self, comfy_task_id: str) -> str | None:
+        """
+        forget a finished comfy task and wait until every request attached to it has been recorded,
+        return the prompt hash of the task if it was submitted by this process
+        """
+        key = self._hashes.pop(comfy_task_id, None)
+        if key is not None:
+            self._inflight.pop(key, None)
+        writes = self._writes.pop(comfy_task_id, [])
+        if writes:
+            await asyncio.gather(*writes, return_exceptions=True)
+        return key
+
+
+singleflight = Singleflight()
@@ -0,0 +1,159 @@
+import asyncio
+import json
+from collections import OrderedDict, deque
+from typing import AsyncIterator
+
+from config import PROGRESS_BUFFER_SIZE, PROGRESS_KEEPALIVE, PROGRESS_RETENTION
+
+
+class _Channel:
+    """the latest events of one client task, already encoded as server-sent events"""
+
+    __slots__ = ('events', 'seq', 'changed', 'closed', 'subscribers')
+
+    def __init__(self, size: int):
+        self.events: deque[tuple[int, str]] = deque(maxlen=size)
+        self.seq = 0
+        self.changed = asyncio.Event()
+        self.closed = False
+        self.subscribers = 0
+
+    def publish(self, event: str, data: dict):
+        self.seq += 1
+        self.events.append((self.seq, f'id: {self.seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n'))
+        # wake every subscriber at once, the next ones wait on a fresh event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class ProgressHub:
+    """
+    Fan-out of the progress events of the comfy tasks to the clients subscribed to their client_task_id.
+
+    Publishing is synchronous and never waits on a subscriber: an event is encoded once, appended to the bounded
+    log of the task and every subscriber is woken by a single asyncio.Event. A subscriber reads the log from its own
+    cursor, one that falls more than `buffer_size` events behind skips the oldest ones.
+
+    A prompt can start executing before the service knows which client task it belongs to, the events of the prompts
+    which aren't registered yet are held back and published when they are.
+    """
+
+    early_prompts = 256
+
+    def __init__(
+            self,
+            buffer_size: int = PROGRESS_BUFFER_SIZE,
+            retention: float = PROGRESS_RETENTION,
+            keepalive: float = PROGRESS_KEEPALIVE
+    ):
+        self.buffer_size = buffer_size
+        self.retention = retention
+        self.keepalive = keepalive
+        self.published = 0
+        self._channels: dict[int, _Channel] = {}
+        self._clients: dict[str, set[int]] = {}  # comfy_task_id -> client_task_ids sharing it
+        self._early: OrderedDict[str, list[tuple[str, dict]]] = OrderedDict()
+
+    def _channel(self, client_task_id: int) -> _Channel:
+        channel = self._channels.get(client_task_id)
+        if channel is None:
+            channel = self._channels[client_task_id] = _Channel(self.buffer_size)
+        return channel
+
+    def register(self, comfy_task_id: str, *client_task_ids: int):
+        """map a comfy task back to its client tasks, its events are published from now on"""
+        early = self._early.pop(comfy_task_id, ())
+        for client_task_id in client_task_ids:
+            self._clients.setdefault(comfy_task_id, set()).add(client_task_id)
+            if client_task_id in self._channels and self._channels[client_task_id].closed:
+                # the client task id is reused, start over
+                del self._channels[client_task_id]
+            channel = self._channel(client_task_id)
+            channel.publish('queued', {'client_task_id': client_task_id, 'comfy_task_id': comfy_task_id})
+            for event, data in early:
+                channel.publish(event, {'client_task_id': client_task_id, **data})
+            self.published += 1 + len(early)
+
+    def publish(self, comfy_task_id: str, event: str, data: dict):
+        """publish an event to the client tasks of a comfy task, held back if it isn't registered yet"""
+        if comfy_task_id not in self._clients:
+            # e.g. a prompt of another run of the service, the oldest ones are forgotten
+            early = self._early.setdefault(comfy_task_id, [])
+            if len(early) < self.buffer_size:
+                early.append((event, data))
+            if len(self._early) > self.early_prompts:
+                self._early.popitem(last=False)
+            return
+        for client_task_id in self._clients[comfy_task_id]:
+            self._channels[client_task_id].publish(event, {'client_task_id': client_task_id, **data})
+            self.published += 1
+
+    def finish(self, comfy_task_id: str, event: str, data: dict, client_task_id: int | None = None):
+        """
+        publish the last event of a comfy task, or only of one of its client tasks, e.g. a branch of a batched prompt.
+        the channels are dropped after the retention
+        """
+        loop = asyncio.get_running_loop()
+        if client_task_id is not None:
+            client_task_ids = self._clients.get(comfy_task_id, set())
+            finished = {client_task_id} & client_task_ids
+            client_task_ids -= finished
+            if not client_task_ids:
+                self._clients.pop(comfy_task_id, None)
+                self._early.pop(comfy_task_id, None)
+        else:
+            finished = self._clients.pop(comfy_task_id, ())
+            self._early.pop(comfy_task_id, None)
+        for client_task_id in finished:
+            channel = self._channels[client_task_id]
+            channel.publish(event, {'client_task_id': client_task_id, **data})
+            channel.closed = True
+            self.published += 1
+            loop.call_later(self.retention, self._drop, client_task_id, channel)
+
+    def _drop(self, client_task_id: int, channel: _Channel):
+        if self._channels.get(client_task_id) is channel:
+            del self._channels[client_task_id]
+
+    async def subscribe(self, client_task_id: int, last_event_id: int = 0) -> AsyncIterator[str]:
+        """
+        the server-sent events of a client task after last_event_id, until its last one.
+        a client task which isn't known yet, e.g. still in the task queue, is waited for
+        """
+        channel = self._channel(client_task_id)
+        channel.subscribers += 1
+        # an id from before a restart or a reused client task id means nothing here anymore
+        cursor = last_event_id if last_event_id <= channel.seq else 0
+        try:
+            while True:
+                changed = channel.changed
+                pending = [(seq, message) for seq, message in channel.events if seq > cursor]
+                for seq, message in pending:
+                    cursor = seq
+                    yield message
+                if channel.closed and cursor >= channel.seq:
+                    return
+                if channel.seq > cursor:
+                    # published while the previous events were being sent
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(), self.keepalive)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+        finally:
+            channel.subscribers -= 1
+            if not channel.subscribers and not channel.closed and not channel.seq:
+                # nothing was ever published, don't keep a channel for an unknown task
+                self._drop(client_task_id, channel)
+
+    def stats(self) -> dict:
+        return {
+            'tasks': len(self._clients),
+            'early': len(self._early),
+            'channels': len(self._channels),
+            'subscribers': sum(channel.subscribers for channel in self._channels.values()),
+            'published': self.published
+        }
+
+
+progress_hub = ProgressHub()
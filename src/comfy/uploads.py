@@ -0,0 +1,76 @@
+import hashlib
+from collections import OrderedDict
+
+from config import INPUT_CACHE_MAX_ENTRIES
+
+
+def content_hash(image: bytes) -> str:
+    return hashlib.sha256(image).hexdigest()
+
+
+def uploaded_path(resp: dict) -> str:
+    """the path of an uploaded image on the comfy server, from its /upload/image response"""
+    if resp['subfolder']:
+        return f"{resp['subfolder']}/{resp['name']}"
+    return resp['name']
+
+
+class InputUploadCache:
+    """
+    LRU index of the input images uploaded to one comfy server, from content hash to the uploaded path.
+
+    Every queued prompt holds a reference on the input it loads. Entries over `max_entries` are evicted
+    least recently used first, but only once no prompt references them, their files are deleted then.
+    """
+
+    def __init__(self, max_entries: int = INPUT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._entries: OrderedDict[str, list] = OrderedDict()  # hash -> [path, references, size]
+
+    def acquire(self, key: str) -> str | None:
+        """the path of an input already uploaded, with a new reference on it"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        entry[1] += 1
+        self.hits += 1
+        self.bytes_saved += entry[2]
+        return entry[0]
+
+    def add(self, key: str, path: str, size: int) -> list[str]:
+        """index a new upload with one reference on it, return the paths of the evicted inputs to delete"""
+        self.misses += 1
+        self._entries[key] = [path, 1, size]
+        return self._evict()
+
+    def release(self, key: str) -> list[str]:
+        """drop a reference, return the paths of the evicted inputs to delete"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[1] = max(0, entry[1] - 1)
+        return self._evict()
+
+    def clear(self) -> list[str]:
+        """forget every input nothing references, return their paths to delete"""
+        paths = [path for path, references, _ in self._entries.values() if not references]
+        self._entries = OrderedDict((key, entry) for key, entry in self._entries.items() if entry[1])
+        return paths
+
+    def _evict(self) -> list[str]:
+        evicted = []
+        if len(self._entries) <= self.max_entries:
+            return evicted
+        for key, (path, references, _) in list(self._entries.items()):
+            if len(self._entries) <= self.max_entries:
+                break
+            if not references:
+                del self._entries[key]
+                evicted.append(path)
+        return evicted
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'bytes_saved': self.bytes_saved, 'entries': len(self._entries)}
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 
@@ -11,16 +12,105 @@ AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY", "")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID", "")
 S3_BUCKET = os.getenv("S3_BUCKET", "")
 S3_REGION_NAME = os.getenv("S3_REGION_NAME", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50))
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+S3_MULTIPART_CHUNK_SIZE = int(os.getenv("S3_MULTIPART_CHUNK_SIZE", 8 * 1024 * 1024))
+S3_MULTIPART_CONCURRENCY = int(os.getenv("S3_MULTIPART_CONCURRENCY", 4))
+S3_PRESIGN_EXPIRES = int(os.getenv("S3_PRESIGN_EXPIRES", 3600))  # seconds, input image urls handed to comfyui
 
 RDB_USERNAME = os.getenv("RDB_USERNAME", "root")
 RDB_PASSWORD = os.getenv("RDB_PASSWORD", "123456")
 RDB_HOST = os.getenv("RDB_HOST", "localhost")
 RDB_PORT = os.getenv("RDB_PORT", 5432)
 RDB_NAME = os.getenv("RDB_NAME", "comfy")
+RDB_POOL_SIZE = int(os.getenv("RDB_POOL_SIZE", 10))
+RDB_MAX_OVERFLOW = int(os.getenv("RDB_MAX_OVERFLOW", 20))
+RDB_POOL_TIMEOUT = float(os.getenv("RDB_POOL_TIMEOUT", 30))
+RDB_POOL_RECYCLE = int(os.getenv("RDB_POOL_RECYCLE", 1800))
 
 CALL_BACK_BASE_URL = os.getenv("CALL_BACK_BASE_URL", "")
 FALLBACK_PATH = os.getenv("FALLBACK_PATH", "fallback")
 SERVICE_PORT = os.getenv("SERVICE_PORT", 8000)
 ROUTE_PREFIX = os.getenv("ROUTE_PREFIX", "/api/v1")
 
+COMFY_HTTP_MAX_CONNECTIONS = int(os.getenv("COMFY_HTTP_MAX_CONNECTIONS", 20))
+COMFY_HTTP_MAX_KEEPALIVE = int(os.getenv("COMFY_HTTP_MAX_KEEPALIVE", 10))
+COMFY_HTTP_TIMEOUT = float(os.getenv("COMFY_HTTP_TIMEOUT", 30))
+# websocket liveness and the jittered exponential backoff between two reconnection attempts
+COMFY_WS_PING_INTERVAL = float(os.getenv("COMFY_WS_PING_INTERVAL", 10))
+COMFY_WS_PING_TIMEOUT = float(os.getenv("COMFY_WS_PING_TIMEOUT", 10))
+COMFY_RECONNECT_BACKOFF = float(os.getenv("COMFY_RECONNECT_BACKOFF", 0.5))
+COMFY_RECONNECT_MAX_BACKOFF = float(os.getenv("COMFY_RECONNECT_MAX_BACKOFF", 30))
+WEBHOOK_HTTP_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_HTTP_MAX_CONNECTIONS", 50))
+WEBHOOK_HTTP_MAX_KEEPALIVE = int(os.getenv("WEBHOOK_HTTP_MAX_KEEPALIVE", 20))
+WEBHOOK_HTTP_TIMEOUT = float(os.getenv("WEBHOOK_HTTP_TIMEOUT", 10))
+WEBHOOK_OUTBOX_ENABLED = os.getenv("WEBHOOK_OUTBOX_ENABLED", "true").lower() == "true"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 16))  # concurrent webhook deliveries
+WEBHOOK_HOST_CONCURRENCY = int(os.getenv("WEBHOOK_HOST_CONCURRENCY", 8))  # concurrent deliveries per callback host
+# results per callback, above 1 they are posted together as a list to {CALL_BACK_BASE_URL}/batch
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", 1))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 8))
+WEBHOOK_BACKOFF = float(os.getenv("WEBHOOK_BACKOFF", 1))  # seconds before the first retry, doubled every attempt
+WEBHOOK_MAX_BACKOFF = float(os.getenv("WEBHOOK_MAX_BACKOFF", 300))  # seconds
+WEBHOOK_LEASE = float(os.getenv("WEBHOOK_LEASE", 60))  # seconds before a delivery interrupted by a crash is retried
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", 1))  # seconds
+
+COMPLETION_WORKERS = int(os.getenv("COMPLETION_WORKERS", 4))
+COMPLETION_QUEUE_SIZE = int(os.getenv("COMPLETION_QUEUE_SIZE", 1000))
+INPUT_CACHE_MAX_ENTRIES = int(os.getenv("INPUT_CACHE_MAX_ENTRIES", 256))  # img2img inputs kept on each comfy server
+# files to delete are collected per comfy server and deleted together by one cleanup prompt
+CLEANUP_FLUSH_INTERVAL = float(os.getenv("CLEANUP_FLUSH_INTERVAL", 2))
+CLEANUP_BATCH_SIZE = int(os.getenv("CLEANUP_BATCH_SIZE", 50))
+# progress events streamed to the clients: events kept per task, seconds a finished task stays readable,
+# seconds between two keepalive comments of an idle stream
+PROGRESS_BUFFER_SIZE = int(os.getenv("PROGRESS_BUFFER_SIZE", 64))
+PROGRESS_RETENTION = float(os.getenv("PROGRESS_RETENTION", 60))
+PROGRESS_KEEPALIVE = float(os.getenv("PROGRESS_KEEPALIVE", 15))
+# custom node (and its url input) loading img2img input images referenced by s3 key, e.g. from comfyui-art-venture
+IMG2IMG_URL_LOADER_NODE = os.getenv("IMG2IMG_URL_LOADER_NODE", "LoadImageFromUrl")
+IMG2IMG_URL_LOADER_INPUT = os.getenv("IMG2IMG_URL_LOADER_INPUT", "url")
+# how result images come back from comfyui: "history" (SaveImage + /history + /view) or "websocket" (SaveImageWebsocket).
+# with "websocket" a task which finishes while the websocket is down, or while the service is restarting, has failed
+COMFY_IMAGE_DELIVERY = os.getenv("COMFY_IMAGE_DELIVERY", "history")
+
+SCHEDULER_POLICY = os.getenv("SCHEDULER_POLICY", "affinity")  # "affinity", "cost_aware" or "least_queue"
+WORKFLOW_COSTS = json.loads(os.getenv("WORKFLOW_COSTS", '{"text2img": 1.0, "img2img": 0.4}'))
+THROUGHPUT_EWMA_ALPHA = float(os.getenv("THROUGHPUT_EWMA_ALPHA", 0.2))
+MODEL_SWITCH_PENALTY = float(os.getenv("MODEL_SWITCH_PENALTY", 10))  # seconds, spill over beyond this imbalance
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+# text2img requests scheduled on the same comfy server which only differ in their text and seed are merged into
+# one prompt, at most MAX_SIZE of them, waiting at most MAX_WAIT seconds for the others. only the per-prompt overhead
+# is saved, the samplers of the merged prompt still run one after the other
+TEXT2IMG_BATCH_ENABLED = os.getenv("TEXT2IMG_BATCH_ENABLED", "false").lower() == "true"
+TEXT2IMG_BATCH_MAX_SIZE = int(os.getenv("TEXT2IMG_BATCH_MAX_SIZE", 4))
+TEXT2IMG_BATCH_MAX_WAIT = float(os.getenv("TEXT2IMG_BATCH_MAX_WAIT", 0.03))
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 7 * 24 * 3600))  # seconds
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 10000))  # in-process tier
+
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() == "true"
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 1))  # seconds
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", 500))  # rows, flush early beyond this
+WRITE_BEHIND_JOURNAL = os.getenv("WRITE_BEHIND_JOURNAL", "record_journal.jsonl")
+WRITE_BEHIND_FSYNC = os.getenv("WRITE_BEHIND_FSYNC", "false").lower() == "true"
+
+TASK_QUEUE_ENABLED = os.getenv("TASK_QUEUE_ENABLED", "false").lower() == "true"
+TASK_QUEUE_DEPTH = int(os.getenv("TASK_QUEUE_DEPTH", 2))  # in-flight prompts kept on each comfy server
+TASK_QUEUE_MAX_BACKLOG = int(os.getenv("TASK_QUEUE_MAX_BACKLOG", 10000))  # queued tasks, 429 beyond this
+TASK_QUEUE_POLL_INTERVAL = float(os.getenv("TASK_QUEUE_POLL_INTERVAL", 0.2))  # seconds
+TASK_QUEUE_MAX_ATTEMPTS = int(os.getenv("TASK_QUEUE_MAX_ATTEMPTS", 3))  # dispatch attempts before a task is dropped
+TASK_QUEUE_LEASE = float(os.getenv("TASK_QUEUE_LEASE", 60))  # seconds before a task whose dispatcher crashed is retried
+# relative share of the GPU time per tenant within a priority lane, tenants not listed weigh 1
+TENANT_WEIGHTS = json.loads(os.getenv("TENANT_WEIGHTS", '{}'))
+
+# several replicas of the service sharing the comfy servers: the replica holding the advisory lock of a node listens
+# to it and post-processes all of its tasks, the others follow its queue state over LISTEN/NOTIFY
+COORDINATION_ENABLED = os.getenv("COORDINATION_ENABLED", "false").lower() == "true"
+COORDINATION_CHANNEL = os.getenv("COORDINATION_CHANNEL", "comfy_nodes")
+COORDINATION_HEARTBEAT = float(os.getenv("COORDINATION_HEARTBEAT", 2))  # seconds between two lock checks
+# seconds the leader waits for the records of a prompt another replica has queued
+COORDINATION_RECORD_WAIT = float(os.getenv("COORDINATION_RECORD_WAIT", 5))
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
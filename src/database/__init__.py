@@ -1,5 +1,8 @@
-from sqlalchemy import create_engine, text, Integer, String, Index
-from sqlalchemy.ext.asyncio import create_async_engine
+from datetime import datetime
+
+from sqlalchemy import create_engine, func, text, Integer, String, Index, DateTime, Float
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Mapped, mapped_column
 
@@ -8,30 +11,171 @@ from config import (
     RDB_PASSWORD,
     RDB_HOST,
     RDB_PORT,
-    RDB_NAME
+    RDB_NAME,
+    RDB_POOL_SIZE,
+    RDB_MAX_OVERFLOW,
+    RDB_POOL_TIMEOUT,
+    RDB_POOL_RECYCLE
 )
 
-_url = f'postgresql+psycopg://{RDB_USERNAME}:{RDB_PASSWORD}@{RDB_HOST}:{RDB_PORT}/{RDB_NAME}'
-sql_engine = create_async_engine(_url, pool_pre_ping=True)
+# libpq connection string, for the connections which live outside of the pool, e.g. LISTEN or advisory locks
+conninfo = f'postgresql://{RDB_USERNAME}:{RDB_PASSWORD}@{RDB_HOST}:{RDB_PORT}/{RDB_NAME}'
+_url = conninfo.replace('postgresql://', 'postgresql+psycopg://', 1)
+sql_engine = create_async_engine(
+    _url,
+    pool_pre_ping=True,
+    pool_size=RDB_POOL_SIZE,
+    max_overflow=RDB_MAX_OVERFLOW,
+    pool_timeout=RDB_POOL_TIMEOUT,
+    pool_recycle=RDB_POOL_RECYCLE
+)
+# one sessionmaker for the whole process, objects stay usable after commit so nothing is refreshed
+async_session = async_sessionmaker(sql_engine, expire_on_commit=False)
 
 Base = declarative_base()
 
+
+class RecordStatus:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FETCHED = 'fetched'
+    UPLOADED = 'uploaded'
+    CALLBACK_SENT = 'callback_sent'
+    FAILED = 'failed'
+
+    TERMINAL = (CALLBACK_SENT, FAILED)
+    # the result of the comfy task hasn't been uploaded yet
+    UNFINISHED = (QUEUED, RUNNING, FETCHED)
+
+
 class Record(Base):
     __tablename__ = "records"
-    __table_args__ = (Index("idx_prompt_id", "comfy_task_id"),)
+    __table_args__ = (
+        Index("idx_prompt_id", "comfy_task_id"),
+        Index("idx_records_endpoint_status", "comfy_endpoint", "status"),
+        Index("idx_records_accepted_at", "accepted_at"),
+    )
+    # timestamps of the stages of a task, in order
+    TIMELINE = (
+        'accepted_at',
+        'dispatched_at',
+        'started_at',
+        'executed_at',
+        'fetched_at',
+        'uploaded_at',
+        'callback_at'
+    )
 
     client_task_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     comfy_task_id: Mapped[str] = mapped_column(String, nullable=False)
     comfy_filepath: Mapped[str | None] = mapped_column(String)
     s3_key: Mapped[str | None] = mapped_column(String)
+    status: Mapped[str | None] = mapped_column(String)
+    comfy_endpoint: Mapped[str | None] = mapped_column(String)  # the comfy server the task was queued on
+    workflow: Mapped[str | None] = mapped_column(String)
+    accepted_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))  # the api accepted the task
+    dispatched_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))  # its prompt was queued on comfyui
+    started_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))  # execution_start
+    executed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))  # the prompt has finished
+    fetched_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))  # the image was downloaded
+    uploaded_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))  # the image was uploaded to s3
+    callback_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))  # the webhook succeeded
+    # the output nodes of its branch when its prompt was batched with others, for the replica post-processing it
+    branch_nodes: Mapped[list[str] | None] = mapped_column(JSONB)
+    # s3_key is the first output image, the keys of all of them in order are set with the result for the webhook,
+    # their rows are in record_images
+    s3_keys = None
+    # columns which are only of use to the service, left out of the webhook payload
+    INTERNAL = ('branch_nodes',)
 
     def to_dict(self):
-        return {key: value for key, value in vars(self).items() if not key.startswith("_")}
+        return {
+            key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in vars(self).items() if not key.startswith("_") and key not in self.INTERNAL
+        }
+
+    def to_row(self) -> dict:
+        """every column value, unset ones included"""
+        return {column.name: getattr(self, column.name) for column in self.__table__.columns}
 
     def __repr__(self):
         return (
             f"<Record(client_task_id={self.client_task_id}, comfy_task_id={self.comfy_task_id}, "
-            f"comfy_path={self.comfy_filepath}, s3_key={self.s3_key})>"
+            f"comfy_path={self.comfy_filepath}, s3_key={self.s3_key}, status={self.status})>"
+        )
+
+class RecordImage(Base):
+    """an output image of a comfy task, shared by the records of that task unless it belongs to one branch of it"""
+    __tablename__ = "record_images"
+
+    comfy_task_id: Mapped[str] = mapped_column(String, primary_key=True)
+    position: Mapped[int] = mapped_column(Integer, primary_key=True)  # order of the image in the outputs
+    node_id: Mapped[str | None] = mapped_column(String)  # the output node which saved it
+    client_task_id: Mapped[int | None] = mapped_column(Integer)  # the record it belongs to in a batched prompt
+    comfy_filepath: Mapped[str | None] = mapped_column(String)
+    s3_key: Mapped[str] = mapped_column(String, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return (
+            f"<RecordImage(comfy_task_id={self.comfy_task_id}, position={self.position}, "
+            f"node_id={self.node_id}, s3_key={self.s3_key})>"
+        )
+
+class CachedResult(Base):
+    __tablename__ = "result_cache"
+
+    prompt_hash: Mapped[str] = mapped_column(String, primary_key=True)
+    comfy_task_id: Mapped[str] = mapped_column(String, nullable=False)
+    s3_key: Mapped[str] = mapped_column(String, nullable=False)
+    s3_keys: Mapped[list[str] | None] = mapped_column(JSONB)  # every output image, s3_key is the first one
+    expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return f"<CachedResult(prompt_hash={self.prompt_hash}, s3_key={self.s3_key}, expires_at={self.expires_at})>"
+
+class QueuedTask(Base):
+    """a task accepted by the api and waiting for a free slot on a comfy server"""
+    __tablename__ = "task_queue"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    client_task_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    service_type: Mapped[str] = mapped_column(String, nullable=False)
+    params: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    priority: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    tenant_id: Mapped[str | None] = mapped_column(String)
+    # weighted fair queuing tag, a tenant's tasks are spread out by their cost over the tenant's weight
+    virtual_finish: Mapped[float] = mapped_column(Float, nullable=False, default=0.0)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # a dispatcher is queueing it on comfyui, another one takes it over if it's still there once this has passed
+    leased_until: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return (
+            f"<QueuedTask(id={self.id}, client_task_id={self.client_task_id}, "
+            f"service_type={self.service_type}, priority={self.priority}, tenant_id={self.tenant_id})>"
+        )
+
+# the dispatcher claims the highest priority lane first, then fair-queues tenants within it
+Index("idx_task_queue_fair_order", QueuedTask.priority.desc(), QueuedTask.virtual_finish, QueuedTask.id)
+
+class WebhookDelivery(Base):
+    """a webhook callback waiting to be delivered, rows whose next_attempt_at is null have run out of attempts"""
+    __tablename__ = "webhook_outbox"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    client_task_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    base_url: Mapped[str] = mapped_column(String, nullable=False)
+    payload: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    next_attempt_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return (
+            f"<WebhookDelivery(id={self.id}, client_task_id={self.client_task_id}, "
+            f"attempts={self.attempts}, next_attempt_at={self.next_attempt_at})>"
         )
 
 def init_rdb():
@@ -39,4 +183,24 @@ def init_rdb():
     with engine.begin() as conn:
         # Base.metadata.drop_all(conn)
         conn.execute(text("CREATE SCHEMA IF NOT EXISTS app"))
-        Base.metadata.create_all(conn)
\ No newline at end of file
+        Base.metadata.create_all(conn)
+        # columns and indexes added after the tables were first created
+        conn.execute(text("ALTER TABLE records ADD COLUMN IF NOT EXISTS status VARCHAR"))
+        conn.execute(text("ALTER TABLE records ADD COLUMN IF NOT EXISTS comfy_endpoint VARCHAR"))
+        conn.execute(text("ALTER TABLE records ADD COLUMN IF NOT EXISTS workflow VARCHAR"))
+        conn.execute(text("ALTER TABLE records ADD COLUMN IF NOT EXISTS branch_nodes JSONB"))
+        for column in Record.TIMELINE:
+            conn.execute(text(f"ALTER TABLE records ADD COLUMN IF NOT EXISTS {column} TIMESTAMP WITH TIME ZONE"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_records_accepted_at ON records (accepted_at)"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_records_endpoint_status ON records (comfy_endpoint, status)"
+        ))
+        conn.execute(text("ALTER TABLE record_images ADD COLUMN IF NOT EXISTS client_task_id INTEGER"))
+        conn.execute(text("ALTER TABLE result_cache ADD COLUMN IF NOT EXISTS s3_keys JSONB"))
+        conn.execute(text("ALTER TABLE task_queue ADD COLUMN IF NOT EXISTS tenant_id VARCHAR"))
+        conn.execute(text("ALTER TABLE task_queue ADD COLUMN IF NOT EXISTS virtual_finish FLOAT NOT NULL DEFAULT 0"))
+        conn.execute(text("ALTER TABLE task_queue ADD COLUMN IF NOT EXISTS leased_until TIMESTAMP WITH TIME ZONE"))
+        conn.execute(text("DROP INDEX IF EXISTS idx_task_queue_order"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_task_queue_fair_order ON task_queue (priority DESC, virtual_finish, id)"
+        ))
@@ -1,33 +1,546 @@
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
 
-from database import Record, sql_engine
+from sqlalchemy import case, delete, func, insert, literal, or_, select, union_all, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from database import CachedResult, QueuedTask, Record, RecordImage, RecordStatus, WebhookDelivery, async_session
+from database.write_behind import record_write_behind
+from metrics import track
+
+
+def _case_values(values: dict, per_record: dict[int, dict]) -> dict:
+    """
+    the values of an update of several records where those of per_record are picked by client_task_id, so it stays
+    one statement whatever the number of records. a record without a value of its own gets the common one, or keeps
+    its current one
+    """
+    values = dict(values)
+    for column in {column for record_values in per_record.values() for column in record_values}:
+        whens = {
+            client_task_id: record_values[column]
+            for client_task_id, record_values in per_record.items() if column in record_values
+        }
+        values[column] = case(whens, value=Record.client_task_id, else_=values.get(column, getattr(Record, column)))
+    return values
 
 
 class RecordRepository:
     @staticmethod
     async def create(record: Record) -> Record:
-        async_session = async_sessionmaker(sql_engine)
-        async with async_session() as session:
-            session.add(record)
-            await session.commit()
-            await session.refresh(record)
+        if record_write_behind.enabled:
+            record_write_behind.insert([record.to_row()])
+            return record
+        with track('db_write'):
+            async with async_session() as session:
+                session.add(record)
+                await session.commit()
         return record
 
     @staticmethod
-    async def retrieve_by_comfy_task_id(comfy_task_id: str) -> Record:
-        async_session = async_sessionmaker(sql_engine)
+    async def bulk_create(records: list[Record]) -> list[Record]:
+        """insert all records with a single multi-row INSERT statement"""
+        if not records:
+            return records
+        if record_write_behind.enabled:
+            record_write_behind.insert([record.to_row() for record in records])
+            return records
+        with track('db_write'):
+            async with async_session() as session:
+                await session.execute(insert(Record).values([record.to_row() for record in records]))
+                await session.commit()
+        return records
+
+    @staticmethod
+    async def retrieve_all_by_comfy_task_id(comfy_task_id: str) -> list[Record]:
+        """all records of a comfy task, several requests share one when identical prompts are coalesced"""
         async with async_session() as session:
             stmt = select(Record).where(Record.comfy_task_id == comfy_task_id)
             result = await session.execute(stmt)
-            record = result.scalars().first()
-            return record
+            return list(result.scalars().all())
 
     @staticmethod
-    async def update(record: Record) -> Record:
-        async_session = async_sessionmaker(sql_engine)
+    async def update_by_comfy_task_id(comfy_task_id: str, **values) -> list[Record]:
+        """set values on every record of a comfy task with a single UPDATE ... RETURNING"""
+        if record_write_behind.enabled:
+            rows = record_write_behind.rows_of(comfy_task_id)
+            if rows is None:
+                # queued before a restart, the rows are only in the database
+                rows = [record.to_row() for record in await RecordRepository.retrieve_all_by_comfy_task_id(comfy_task_id)]
+            rows = [{**row, **values} for row in rows]
+            for row in rows:
+                record_write_behind.put(row)
+            return [Record(**row) for row in rows]
+        with track('db_write'):
+            async with async_session() as session:
+                stmt = update(Record).where(Record.comfy_task_id == comfy_task_id).values(**values).returning(Record)
+                result = await session.execute(stmt)
+                records = list(result.scalars().all())
+                await session.commit()
+        return records
+
+    @staticmethod
+    async def unfinished_comfy_task_ids(comfy_endpoint: str) -> list[str]:
+        """the comfy tasks queued on a comfy server whose result hasn't been uploaded yet"""
+        if record_write_behind.enabled:
+            await record_write_behind.flush()
         async with async_session() as session:
-            session.add(record)
+            stmt = select(Record.comfy_task_id).where(
+                Record.comfy_endpoint == comfy_endpoint,
+                Record.status.in_(RecordStatus.UNFINISHED)
+            ).distinct()
+            result = await session.execute(stmt)
+            return list(result.scalars().all())
+
+    @staticmethod
+    async def claim_completion(comfy_task_id: str, reclaim: bool = False) -> list[Record] | None:
+        """
+        take the post-processing of a finished comfy task for this replica, with a single UPDATE ... RETURNING.
+        return its records, an empty list if another replica has taken it or None if it isn't recorded yet.
+        reclaim takes over a task a replica which has died was post-processing
+        """
+        statuses = (RecordStatus.QUEUED, RecordStatus.RUNNING) + ((RecordStatus.FETCHED,) if reclaim else ())
+        with track('db_write'):
+            async with async_session() as session:
+                stmt = (
+                    update(Record)
+                    .where(Record.comfy_task_id == comfy_task_id, Record.status.in_(statuses))
+                    .values(status=RecordStatus.FETCHED)
+                    .returning(Record)
+                )
+                result = await session.execute(stmt)
+                records = list(result.scalars().all())
+                recorded = bool(records) or bool(await session.scalar(
+                    select(func.count()).select_from(Record).where(Record.comfy_task_id == comfy_task_id)
+                ))
+                await session.commit()
+        return records if recorded else None
+
+    @staticmethod
+    async def update_queued(comfy_task_id: str, **values) -> list[Record]:
+        """set values on the records of a comfy task which are still queued, attached after its result was written"""
+        with track('db_write'):
+            async with async_session() as session:
+                stmt = (
+                    update(Record)
+                    .where(Record.comfy_task_id == comfy_task_id, Record.status == RecordStatus.QUEUED)
+                    .values(**values)
+                    .returning(Record)
+                )
+                result = await session.execute(stmt)
+                records = list(result.scalars().all())
+                await session.commit()
+        return records
+
+    @staticmethod
+    async def retrieve_finished(comfy_task_ids: list[str]) -> list[Record]:
+        """
+        the records of these comfy tasks whose result has been uploaded or which have failed, with the s3 keys of every
+        image of the uploaded ones
+        """
+        if not comfy_task_ids:
+            return []
+        async with async_session() as session:
+            stmt = select(Record).where(
+                Record.comfy_task_id.in_(comfy_task_ids),
+                Record.status.not_in(RecordStatus.UNFINISHED)
+            )
+            records = list((await session.execute(stmt)).scalars().all())
+            stmt = select(RecordImage).where(
+                RecordImage.comfy_task_id.in_({record.comfy_task_id for record in records})
+            ).order_by(RecordImage.comfy_task_id, RecordImage.position)
+            images = (await session.execute(stmt)).scalars().all() if records else []
+        s3_keys: dict[tuple[str, int | None], list[str]] = {}  # (comfy_task_id, owner in a batched prompt) -> keys
+        for image in images:
+            s3_keys.setdefault((image.comfy_task_id, image.client_task_id), []).append(image.s3_key)
+        for record in records:
+            if record.status != RecordStatus.FAILED and record.s3_key is not None:
+                record.s3_keys = (
+                    s3_keys.get((record.comfy_task_id, record.client_task_id))
+                    or s3_keys.get((record.comfy_task_id, None))
+                    or [record.s3_key]
+                )
+        return records
+
+    @staticmethod
+    def track_status(comfy_task_id: str, status: str, **values):
+        """
+        record an intermediate state of a comfy task.
+        only kept with the write-behind layer, writing every transition directly would put a transaction on the hot path
+        """
+        if record_write_behind.enabled:
+            record_write_behind.transition(comfy_task_id, status, **values)
+
+    @staticmethod
+    async def callbacks_sent(client_task_ids: list[int]):
+        """record that the webhooks of these records have succeeded, with a single UPDATE"""
+        if not client_task_ids:
+            return
+        now = datetime.now(timezone.utc)
+        if record_write_behind.enabled:
+            # the records whose result has been flushed are only in the database
+            client_task_ids = [
+                client_task_id for client_task_id in client_task_ids
+                if not record_write_behind.transition_record(client_task_id, RecordStatus.CALLBACK_SENT, callback_at=now)
+            ]
+            if not client_task_ids:
+                return
+        with track('db_write'):
+            async with async_session() as session:
+                await session.execute(
+                    update(Record)
+                    .where(Record.client_task_id.in_(client_task_ids))
+                    .values(status=RecordStatus.CALLBACK_SENT, callback_at=now)
+                )
+                await session.commit()
+
+    @staticmethod
+    async def stage_percentiles(since: datetime, until: datetime) -> list[dict]:
+        """
+        latency percentiles of every stage of the records accepted between since and until,
+        per stage, workflow and comfy server
+        """
+        stages = {
+            'queue_wait': (Record.accepted_at, Record.dispatched_at),
+            'comfy_queue': (Record.dispatched_at, Record.started_at),
+            'execution': (Record.started_at, Record.executed_at),
+            'fetch': (Record.executed_at, Record.fetched_at),
+            's3_upload': (Record.fetched_at, Record.uploaded_at),
+            'webhook': (Record.uploaded_at, Record.callback_at),
+            'total': (Record.accepted_at, Record.callback_at)
+        }
+        durations = union_all(*(
+            select(
+                literal(stage).label('stage'),
+                Record.workflow,
+                Record.comfy_endpoint,
+                func.extract('epoch', end - start).label('seconds')
+            ).where(
+                Record.accepted_at >= since,
+                Record.accepted_at < until,
+                start.is_not(None),
+                end.is_not(None)
+            )
+            for stage, (start, end) in stages.items()
+        )).subquery()
+        stmt = select(
+            durations.c.stage,
+            durations.c.workflow,
+            durations.c.comfy_endpoint,
+            func.count(),
+            func.avg(durations.c.seconds),
+            func.percentile_cont(0.5).within_group(durations.c.seconds),
+            func.percentile_cont(0.9).within_group(durations.c.seconds),
+            func.percentile_cont(0.99).within_group(durations.c.seconds),
+            func.max(durations.c.seconds)
+        ).group_by(durations.c.stage, durations.c.workflow, durations.c.comfy_endpoint)
+        async with async_session() as session:
+            result = await session.execute(stmt)
+            rows = result.all()
+        order = list(stages)
+        return sorted(
+            (
+                {
+                    'stage': stage,
+                    'workflow': workflow,
+                    'node': node,
+                    'count': count,
+                    'mean': float(mean),
+                    'p50': p50,
+                    'p90': p90,
+                    'p99': p99,
+                    'max': float(max_)
+                }
+                for stage, workflow, node, count, mean, p50, p90, p99, max_ in rows
+            ),
+            key=lambda x: (order.index(x['stage']), x['workflow'] or '', x['node'] or '')
+        )
+
+    @staticmethod
+    async def update_with_images(
+            comfy_task_id: str,
+            images: list[RecordImage],
+            per_record: dict[int, dict] | None = None,
+            **values
+    ) -> list[Record]:
+        """
+        set values on every record of a comfy task and insert its output images, in a single transaction.
+        per_record holds the values which differ between the records, by client_task_id, e.g. the branches of a
+        batched prompt. the images are written right away also with the write-behind layer, they are a result and
+        not a transition
+        """
+        per_record = per_record or {}
+        rows = [
+            {
+                'comfy_task_id': image.comfy_task_id,
+                'position': image.position,
+                'node_id': image.node_id,
+                'client_task_id': image.client_task_id,
+                'comfy_filepath': image.comfy_filepath,
+                's3_key': image.s3_key
+            }
+            for image in images
+        ]
+        # a task reconciled after a restart may have recorded its images already
+        insert_images = pg_insert(RecordImage).values(rows).on_conflict_do_nothing() if rows else None
+        if record_write_behind.enabled:
+            if insert_images is not None:
+                with track('db_write'):
+                    async with async_session() as session:
+                        await session.execute(insert_images)
+                        await session.commit()
+            rows = record_write_behind.rows_of(comfy_task_id)
+            if rows is None:
+                rows = [record.to_row() for record in await RecordRepository.retrieve_all_by_comfy_task_id(comfy_task_id)]
+            rows = [{**row, **values, **per_record.get(row['client_task_id'], {})} for row in rows]
+            for row in rows:
+                record_write_behind.put(row)
+            return [Record(**row) for row in rows]
+        values = _case_values(values, per_record)
+        with track('db_write'):
+            async with async_session() as session:
+                if insert_images is not None:
+                    await session.execute(insert_images)
+                stmt = update(Record).where(Record.comfy_task_id == comfy_task_id).values(**values).returning(Record)
+                result = await session.execute(stmt)
+                records = list(result.scalars().all())
+                await session.commit()
+        return records
+
+
+class CoordinationRepository:
+    @staticmethod
+    async def notify(channel: str, payload: str):
+        """send a notification to the replicas listening on channel, once the transaction commits"""
+        async with async_session() as session:
+            await session.execute(select(func.pg_notify(channel, payload)))
             await session.commit()
-            await session.refresh(record)
-        return record
+
+
+class ResultCacheRepository:
+    @staticmethod
+    async def get(prompt_hash: str) -> CachedResult | None:
+        """the cached result of a prompt hash, expired entries are deleted on the way"""
+        async with async_session() as session:
+            entry = await session.get(CachedResult, prompt_hash)
+            if entry is not None and entry.expires_at <= datetime.now(timezone.utc):
+                await session.delete(entry)
+                await session.commit()
+                return None
+            return entry
+
+    @staticmethod
+    async def put(entry: CachedResult):
+        async with async_session() as session:
+            stmt = pg_insert(CachedResult).values(
+                prompt_hash=entry.prompt_hash,
+                comfy_task_id=entry.comfy_task_id,
+                s3_key=entry.s3_key,
+                s3_keys=entry.s3_keys,
+                expires_at=entry.expires_at
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[CachedResult.prompt_hash],
+                set_={'comfy_task_id': stmt.excluded.comfy_task_id, 's3_key': stmt.excluded.s3_key,
+                      's3_keys': stmt.excluded.s3_keys, 'expires_at': stmt.excluded.expires_at}
+            )
+            await session.execute(stmt)
+            await session.commit()
+
+    @staticmethod
+    async def delete(prompt_hash: str | None = None) -> int:
+        """delete the entry of a prompt hash, or every entry when no hash is given"""
+        async with async_session() as session:
+            stmt = delete(CachedResult)
+            if prompt_hash is not None:
+                stmt = stmt.where(CachedResult.prompt_hash == prompt_hash)
+            result = await session.execute(stmt)
+            await session.commit()
+            return result.rowcount
+
+
+class TaskQueueRepository:
+    @staticmethod
+    async def enqueue(tasks: list[QueuedTask], max_backlog: int) -> bool:
+        """insert the tasks unless they would push the backlog past max_backlog, return whether they were accepted"""
+        async with async_session() as session:
+            backlog = await session.scalar(select(func.count()).select_from(QueuedTask))
+            if backlog + len(tasks) > max_backlog:
+                return False
+            session.add_all(tasks)
+            await session.commit()
+        return True
+
+    @staticmethod
+    async def claim(
+            limit: int,
+            dispatch: Callable[[list[QueuedTask]], Awaitable[list[bool]]],
+            max_attempts: int,
+            lease: float
+    ) -> int:
+        """
+        lease up to limit pending tasks, taken with SELECT ... FOR UPDATE SKIP LOCKED, and hand them to dispatch,
+        which tells for each task whether it has left the queue (dispatched or rejected).
+        those are deleted, the others are queued again until they have failed max_attempts times.
+        the lease is committed before dispatching, so no row stays locked while the prompts are posted. the tasks of a
+        dispatcher which crashed are taken again once their lease has expired, unless they have been recorded:
+        their prompt was queued, they are deleted without queueing it twice.
+        return the number of deleted tasks.
+        """
+        async with async_session() as session:
+            due = (
+                select(QueuedTask.id)
+                .where(or_(QueuedTask.leased_until.is_(None), QueuedTask.leased_until <= func.now()))
+                .order_by(QueuedTask.priority.desc(), QueuedTask.virtual_finish, QueuedTask.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            )
+            stmt = (
+                update(QueuedTask)
+                .where(QueuedTask.id.in_(due))
+                .values(leased_until=func.now() + func.make_interval(0, 0, 0, 0, 0, 0, lease))
+                .returning(QueuedTask)
+            )
+            tasks = sorted(
+                (await session.scalars(stmt)).all(),
+                key=lambda task: (-task.priority, task.virtual_finish, task.id)
+            )
+            if not tasks:
+                await session.commit()
+                return 0
+            stmt = select(Record.client_task_id).where(Record.client_task_id.in_({task.client_task_id for task in tasks}))
+            recorded = set((await session.scalars(stmt)).all())
+            await session.commit()
+
+        done = [task.id for task in tasks if task.client_task_id in recorded]
+        failed = []
+        pending = [task for task in tasks if task.client_task_id not in recorded]
+        for task, finished in zip(pending, await dispatch(pending) if pending else []):
+            if finished or task.attempts + 1 >= max_attempts:
+                done.append(task.id)
+            else:
+                failed.append(task.id)
+        async with async_session() as session:
+            if done:
+                await session.execute(delete(QueuedTask).where(QueuedTask.id.in_(done)))
+            if failed:
+                stmt = (
+                    update(QueuedTask)
+                    .where(QueuedTask.id.in_(failed))
+                    .values(attempts=QueuedTask.attempts + 1, leased_until=None)
+                )
+                await session.execute(stmt)
+            await session.commit()
+        return len(done)
+
+    @staticmethod
+    async def cancel(client_task_id: int) -> int:
+        """delete the pending tasks of a client task id, the ones being dispatched right now are skipped"""
+        async with async_session() as session:
+            locked = (
+                select(QueuedTask.id)
+                .where(
+                    QueuedTask.client_task_id == client_task_id,
+                    or_(QueuedTask.leased_until.is_(None), QueuedTask.leased_until <= func.now())
+                )
+                .with_for_update(skip_locked=True)
+            )
+            result = await session.execute(delete(QueuedTask).where(QueuedTask.id.in_(locked)))
+            await session.commit()
+            return result.rowcount
+
+    @staticmethod
+    async def backlog() -> int:
+        async with async_session() as session:
+            return await session.scalar(select(func.count()).select_from(QueuedTask))
+
+    @staticmethod
+    async def fair_queue_state() -> list[tuple[int, str | None, float, float]]:
+        """(priority, tenant_id, min virtual_finish, max virtual_finish) of the queued tasks"""
+        async with async_session() as session:
+            stmt = (
+                select(
+                    QueuedTask.priority,
+                    QueuedTask.tenant_id,
+                    func.min(QueuedTask.virtual_finish),
+                    func.max(QueuedTask.virtual_finish)
+                )
+                .group_by(QueuedTask.priority, QueuedTask.tenant_id)
+            )
+            return [tuple(row) for row in (await session.execute(stmt)).all()]
+
+
+class WebhookOutboxRepository:
+    @staticmethod
+    async def add(deliveries: list[WebhookDelivery]):
+        """insert the deliveries with a single multi-row INSERT statement"""
+        if not deliveries:
+            return
+        async with async_session() as session:
+            values = [
+                {'client_task_id': delivery.client_task_id, 'base_url': delivery.base_url, 'payload': delivery.payload}
+                for delivery in deliveries
+            ]
+            await session.execute(insert(WebhookDelivery).values(values))
+            await session.commit()
+
+    @staticmethod
+    async def claim(limit: int, lease: float) -> list[WebhookDelivery]:
+        """
+        take up to limit due deliveries and push their next attempt lease seconds away,
+        a delivery interrupted by a crash is picked up again once its lease has expired
+        """
+        async with async_session() as session:
+            due = (
+                select(WebhookDelivery.id)
+                .where(WebhookDelivery.next_attempt_at <= func.now())
+                .order_by(WebhookDelivery.next_attempt_at)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            )
+            stmt = (
+                update(WebhookDelivery)
+                .where(WebhookDelivery.id.in_(due))
+                .values(next_attempt_at=func.now() + func.make_interval(0, 0, 0, 0, 0, 0, lease))
+                .returning(WebhookDelivery)
+            )
+            deliveries = list((await session.scalars(stmt)).all())
+            await session.commit()
+            return deliveries
+
+    @staticmethod
+    async def delete(ids: list[int]):
+        async with async_session() as session:
+            await session.execute(delete(WebhookDelivery).where(WebhookDelivery.id.in_(ids)))
+            await session.commit()
+
+    @staticmethod
+    async def retry(ids: list[int], backoff: float, max_backoff: float, max_attempts: int):
+        """
+        schedule the next attempt of failed deliveries after a jittered exponential backoff,
+        the ones which have failed max_attempts times are kept with a null next_attempt_at
+        """
+        delay = func.least(max_backoff, backoff * func.power(2, WebhookDelivery.attempts)) * (0.5 + func.random() / 2)
+        next_attempt_at = case(
+            (WebhookDelivery.attempts + 1 >= max_attempts, None),
+            else_=func.now() + func.make_interval(0, 0, 0, 0, 0, 0, delay)
+        )
+        async with async_session() as session:
+            stmt = (
+                update(WebhookDelivery)
+                .where(WebhookDelivery.id.in_(ids))
+                .values(attempts=WebhookDelivery.attempts + 1, next_attempt_at=next_attempt_at)
+            )
+            await session.execute(stmt)
+            await session.commit()
+
+    @staticmethod
+    async def backlog() -> tuple[int, int]:
+        """the number of deliveries still to be attempted and of the ones given up"""
+        async with async_session() as session:
+            stmt = select(
+                func.count(WebhookDelivery.next_attempt_at),
+                func.count().filter(WebhookDelivery.next_attempt_at.is_(None))
+            )
+            pending, dead = (await session.execute(stmt)).one()
+            return pending, dead
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+
+from config import (
+    WRITE_BEHIND_ENABLED,
+    WRITE_BEHIND_FLUSH_INTERVAL,
+    WRITE_BEHIND_MAX_BATCH,
+    WRITE_BEHIND_JOURNAL,
+    WRITE_BEHIND_FSYNC
+)
+from database import Record, RecordStatus, async_session
+from metrics import track
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(row: dict) -> str:
+    return json.dumps(row, default=datetime.isoformat)
+
+
+def _decode(line: str) -> dict:
+    row = json.loads(line)
+    for column in Record.TIMELINE:
+        if row.get(column) is not None:
+            row[column] = datetime.fromisoformat(row[column])
+    return row
+
+
+class RecordWriteBehind:
+    """
+    Buffer record state transitions in memory and flush them as multi-row upserts.
+
+    Rows are flushed every `flush_interval` seconds, or earlier once `max_batch` rows are pending.
+    Every transition is appended to a local journal first, the journal is replayed on startup
+    and truncated to the rows still pending after each flush, so a crash loses no transition.
+    The rows of the records which aren't finished yet are kept until they're flushed with their result.
+    """
+
+    def __init__(
+            self,
+            enabled: bool = WRITE_BEHIND_ENABLED,
+            journal_path: str = WRITE_BEHIND_JOURNAL,
+            flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL,
+            max_batch: int = WRITE_BEHIND_MAX_BATCH,
+            fsync: bool = WRITE_BEHIND_FSYNC
+    ):
+        self.enabled = enabled
+        self.journal_path = journal_path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.fsync = fsync
+        self._pending: dict[int, dict] = {}  # client_task_id -> row waiting for the next flush
+        self._active: dict[int, dict] = {}  # client_task_id -> row of a task which isn't finished yet
+        self._inserts: set[int] = set()  # client_task_ids of the pending rows of new records
+        self._by_comfy_task_id: dict[str, set[int]] = {}
+        self._journal = None
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        """replay the journal left by a previous run and start the periodic flush"""
+        if not self.enabled:
+            return
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        row = _decode(line)
+                    except json.JSONDecodeError:
+                        # the last line may be cut short by a crash
+                        continue
+                    self._pending[row['client_task_id']] = row
+            logger.info(f'replaying {len(self._pending)} journaled records')
+        self._journal = open(self.journal_path, 'a')
+        await self.flush()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """stop the periodic flush and flush what's left"""
+        if not self.enabled:
+            return
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        self._journal.close()
+        self._journal = None
+
+    def insert(self, rows: list[dict]):
+        """
+        buffer new records. a client_task_id already buffered is rejected at once, like the primary key does without
+        the write-behind layer, one only in the database is dropped when flushed and never overwrites it
+        """
+        client_task_ids = [row['client_task_id'] for row in rows]
+        duplicates = {
+            client_task_id for client_task_id in client_task_ids
+            if client_task_id in self._active or client_task_id in self._pending
+        }
+        if duplicates or len(set(client_task_ids)) < len(client_task_ids):
+            raise IntegrityError(
+                'INSERT INTO records',
+                {'client_task_ids': client_task_ids},
+                ValueError(f'duplicate client_task_id {sorted(duplicates) or client_task_ids}')
+            )
+        for row in rows:
+            self._inserts.add(row['client_task_id'])
+            self.put(row)
+
+    def put(self, row: dict):
+        """buffer the latest state of a record"""
+        client_task_id = row['client_task_id']
+        self._pending[client_task_id] = row
+        if row['status'] in RecordStatus.TERMINAL:
+            self._forget(client_task_id)
+        else:
+            self._active[client_task_id] = row
+            self._by_comfy_task_id.setdefault(row['comfy_task_id'], set()).add(client_task_id)
+        self._journal.write(_encode(row) + '\n')
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    def rows_of(self, comfy_task_id: str) -> list[dict] | None:
+        """the buffered rows of an unfinished comfy task, None if they're only in the database"""
+        client_task_ids = self._by_comfy_task_id.get(comfy_task_id)
+        if not client_task_ids:
+            return None
+        return [self._active[client_task_id] for client_task_id in client_task_ids]
+
+    def transition(self, comfy_task_id: str, status: str, **values):
+        """move every buffered record of a comfy task to a new status"""
+        for row in self.rows_of(comfy_task_id) or []:
+            self.put({**row, **values, 'status': status})
+
+    def transition_record(self, client_task_id: int, status: str, **values) -> bool:
+        """move a single buffered record to a new status, False if it's only in the database"""
+        row = self._active.get(client_task_id)
+        if row is None:
+            return False
+        self.put({**row, **values, 'status': status})
+        return True
+
+    async def flush(self):
+        """write every pending row, the new records with a multi-row insert and the others with a multi-row upsert"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            inserts, self._inserts = self._inserts, set()
+            new_rows = [row for client_task_id, row in batch.items() if client_task_id in inserts]
+            rows = [row for client_task_id, row in batch.items() if client_task_id not in inserts]
+            inserted = set()
+            try:
+                with track('db_write'):
+                    async with async_session() as session:
+                        if new_rows:
+                            stmt = pg_insert(Record).values(new_rows).on_conflict_do_nothing(
+                                index_elements=[Record.client_task_id]
+                            ).returning(Record.client_task_id)
+                            inserted = set((await session.execute(stmt)).scalars().all())
+                        if rows:
+                            stmt = pg_insert(Record).values(rows)
+                            stmt = stmt.on_conflict_do_update(
+                                index_elements=[Record.client_task_id],
+                                set_={name: stmt.excluded[name] for name in rows[0] if name != 'client_task_id'}
+                            )
+                            await session.execute(stmt)
+                        await session.commit()
+            except Exception:
+                # keep the rows for the next flush, unless a newer state was buffered meanwhile
+                for client_task_id, row in batch.items():
+                    self._pending.setdefault(client_task_id, row)
+                self._inserts |= inserts
+                raise
+            for row in new_rows:
+                client_task_id = row['client_task_id']
+                if client_task_id not in inserted:
+                    logger.error(f'record {client_task_id} already exists, the duplicate is dropped')
+                    self._pending.pop(client_task_id, None)
+                    self._forget(client_task_id)
+            for client_task_id, row in batch.items():
+                # the result is written, the later transitions go to the database
+                if row['status'] not in RecordStatus.UNFINISHED and self._active.get(client_task_id) is row:
+                    self._forget(client_task_id)
+            logger.debug(f'flushed {len(batch)} records')
+            self._truncate_journal()
+
+    def _truncate_journal(self):
+        """rewrite the journal with the rows which are still pending"""
+        if self._journal is None:
+            return
+        self._journal.close()
+        tmp_path = f'{self.journal_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            for row in self._pending.values():
+                f.write(_encode(row) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        self._journal = open(self.journal_path, 'a')
+
+    def _forget(self, client_task_id: int):
+        row = self._active.pop(client_task_id, None)
+        if row is None:
+            return
+        client_task_ids = self._by_comfy_task_id.get(row['comfy_task_id'])
+        if client_task_ids is not None:
+            client_task_ids.discard(client_task_id)
+            if not client_task_ids:
+                del self._by_comfy_task_id[row['comfy_task_id']]
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'flush records error: {e}')
+
+
+record_write_behind = RecordWriteBehind()
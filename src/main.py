@@ -4,20 +4,34 @@ from contextlib import asynccontextmanager
 import uvicorn
 from fastapi import FastAPI
 
-from api import router
-from comfy import comfy_servers, logger
+from api import metrics_router, router
+from api.service import dispatcher
+from comfy import comfy_servers, logger, open_http_clients, close_http_clients
+from comfy.coordination import coordinator
 from config import SERVICE_PORT
 from database import init_rdb
+from database.write_behind import record_write_behind
+from s3 import open_s3_client, close_s3_client
+from webhook import webhook_outbox
 
 init_rdb()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # the journal of a crashed run is flushed first, the comfy servers adopt the unfinished tasks from the records
+    await record_write_behind.start()
+    await open_http_clients()
+    await open_s3_client()
     tasks = []
     for comfy_server in comfy_servers:
-        task = asyncio.create_task(comfy_server.listen())
-        tasks.append(task)
+        if not coordinator.enabled:
+            # with replicas, only the one leading a node listens to it
+            tasks.append(asyncio.create_task(comfy_server.listen()))
+        tasks.extend(comfy_server.start_workers())
+    tasks.extend(coordinator.start(comfy_servers))
+    tasks.extend(dispatcher.start())
+    tasks.extend(webhook_outbox.start())
 
     yield
 
@@ -28,9 +42,16 @@ async def lifespan(app: FastAPI):
         except asyncio.CancelledError:
             logger.info(f'task {task.get_name()} cancelled')
 
+    await coordinator.stop()
+    await webhook_outbox.stop()
+    await record_write_behind.stop()
+    await close_http_clients()
+    await close_s3_client()
+
 app = FastAPI(lifespan=lifespan)
 
 app.include_router(router)
+app.include_router(metrics_router)
 
 if __name__ == '__main__':
     uvicorn.run("main:app", host="0.0.0.0", port=int(SERVICE_PORT))
\ No newline at end of file
@@ -0,0 +1,180 @@
+"""
+in-process metrics, exposed in the prometheus text format by GET /metrics.
+
+the service runs on a single event loop, so the counters and histograms are plain ints and floats updated without any
+lock, and the gauges are only computed when they're scraped.
+"""
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable
+
+# seconds, from an interactive task picked up right away to a batch task waiting behind a backfill
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# seconds, from a database write to a GPU execution
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _json_bound(bound: float | None) -> float | str | None:
+    return '+Inf' if bound == float('inf') else bound
+
+
+class Histogram:
+    """bucketed histogram, observing a value is a bisect and two increments"""
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one counts the values above every bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        """upper bound of the bucket holding the q quantile, inf when it's above every bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': _json_bound(self.quantile(0.5)),
+            'p99': _json_bound(self.quantile(0.99)),
+            'buckets': {str(bound): count for bound, count in zip(self.buckets + ('+Inf',), self.counts)}
+        }
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """monotonic counter with labels, the samples are kept per tuple of label values"""
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *values, amount: float = 1):
+        self.values[values] = self.values.get(values, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for values, value in self.values.items():
+            yield f'{self.name}{_format_labels(self.labels, values)} {_format_value(value)}'
+
+
+class Gauge:
+    """gauge read from a callback when scraped, which yields (label values, value) pairs"""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...], collect: Callable[[], Iterable[tuple[tuple, float]]]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self) -> Iterable[str]:
+        for values, value in self.collect():
+            yield f'{self.name}{_format_labels(self.labels, values)} {_format_value(value)}'
+
+
+class HistogramFamily:
+    """a bucketed Histogram per tuple of label values"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.children: dict[tuple, Histogram] = {}
+
+    def observe(self, value: float, *values):
+        histogram = self.children.get(values)
+        if histogram is None:
+            histogram = self.children[values] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def samples(self) -> Iterable[str]:
+        for values, histogram in self.children.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                labels = _format_labels(self.labels, values, f'le="{_format_value(bound)}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labels, values)
+            yield f'{self.name}_sum{labels} {_format_value(histogram.sum)}'
+            yield f'{self.name}_count{labels} {histogram.count}'
+
+
+REGISTRY: list[Counter | Gauge | HistogramFamily] = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def render() -> str:
+    """every registered metric in the prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+# the stages of a task, from the comfy queue to the webhook
+STAGE_SECONDS = register(HistogramFamily(
+    'comfy_task_stage_seconds',
+    'seconds spent by tasks in each stage: batch_wait, comfy_queue, execution, fetch, s3_upload, db_write and webhook',
+    ('stage',),
+    STAGE_BUCKETS
+))
+STAGE_ERRORS = register(Counter('comfy_task_stage_errors_total', 'errors of tasks in each stage', ('stage',)))
+# the wait of the tasks in the postgres task queue, before the dispatcher submits them to a node
+QUEUE_WAIT_SECONDS = register(HistogramFamily(
+    'comfy_task_queue_wait_seconds',
+    'seconds from enqueue to dispatch of the tasks of the task queue, per priority lane',
+    ('priority',)
+))
+
+
+@contextmanager
+def track(stage: str):
+    """time a stage into STAGE_SECONDS and count it in STAGE_ERRORS when it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage)
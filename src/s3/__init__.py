@@ -1,24 +1,117 @@
+import asyncio
+import logging
 import uuid
-from io import BytesIO
+from contextlib import AsyncExitStack
 
+from aiobotocore.config import AioConfig
 from aiobotocore.session import get_session
 
-from config import S3_REGION_NAME, S3_BUCKET, AWS_SECRET_ACCESS_KEY, AWS_ACCESS_KEY_ID
+from config import (
+    S3_REGION_NAME,
+    S3_BUCKET,
+    S3_ENDPOINT_URL,
+    S3_MAX_POOL_CONNECTIONS,
+    S3_MULTIPART_THRESHOLD,
+    S3_MULTIPART_CHUNK_SIZE,
+    S3_MULTIPART_CONCURRENCY,
+    S3_PRESIGN_EXPIRES,
+    AWS_SECRET_ACCESS_KEY,
+    AWS_ACCESS_KEY_ID
+)
+from metrics import STAGE_ERRORS, track
+
+logger = logging.getLogger(__name__)
 
 session = get_session()
 
+_exit_stack: AsyncExitStack | None = None
+_client = None
 
 
-async def upload_image_to_s3(image: bytes) -> dict:
-    image_stream = BytesIO(image)
-    key = f'{uuid.uuid4()}.png'
-    async with session.create_client(
+async def open_s3_client():
+    """create the process wide s3 client, it's reused by every upload"""
+    global _exit_stack, _client
+    if _client is not None:
+        return
+    _exit_stack = AsyncExitStack()
+    _client = await _exit_stack.enter_async_context(session.create_client(
         "s3",
         region_name=S3_REGION_NAME,
+        endpoint_url=S3_ENDPOINT_URL,
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        aws_access_key_id=AWS_ACCESS_KEY_ID
-    ) as client:
-        resp = await client.put_object(Bucket=S3_BUCKET, Key=key, Body=image_stream)
-        if resp["ResponseMetadata"]["HTTPStatusCode"] == 200:
-            return {'success': True, 'key': key}
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        config=AioConfig(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+    ))
+
+
+async def close_s3_client():
+    """close the s3 client and its connection pool"""
+    global _exit_stack, _client
+    if _exit_stack is not None:
+        await _exit_stack.aclose()
+    _exit_stack = None
+    _client = None
+
+
+async def upload_image_to_s3(image: bytes) -> dict:
+    with track('s3_upload'):
+        resp = await _upload_image(image)
+    if not resp['success']:
+        STAGE_ERRORS.inc('s3_upload')
+    return resp
+
+
+async def _upload_image(image: bytes) -> dict:
+    key = f'{uuid.uuid4()}.png'
+    if len(image) >= S3_MULTIPART_THRESHOLD:
+        return await _multipart_upload(key, image)
+    resp = await _client.put_object(Bucket=S3_BUCKET, Key=key, Body=image)
+    if resp["ResponseMetadata"]["HTTPStatusCode"] == 200:
+        return {'success': True, 'key': key}
+    return {'success': False, 'key': key}
+
+
+async def _multipart_upload(key: str, image: bytes) -> dict:
+    """upload a large image in parts, several parts are in flight at the same time"""
+    resp = await _client.create_multipart_upload(Bucket=S3_BUCKET, Key=key)
+    upload_id = resp['UploadId']
+    semaphore = asyncio.Semaphore(S3_MULTIPART_CONCURRENCY)
+
+    async def upload_part(part_number: int, offset: int) -> dict:
+        async with semaphore:
+            part = await _client.upload_part(
+                Bucket=S3_BUCKET,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=image[offset:offset + S3_MULTIPART_CHUNK_SIZE]
+            )
+            return {'PartNumber': part_number, 'ETag': part['ETag']}
+
+    try:
+        parts = await asyncio.gather(*(
+            upload_part(i + 1, offset)
+            for i, offset in enumerate(range(0, len(image), S3_MULTIPART_CHUNK_SIZE))
+        ))
+        resp = await _client.complete_multipart_upload(
+            Bucket=S3_BUCKET,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+    except Exception as e:
+        logger.error(f'multipart upload {key} error: {e}')
+        await _client.abort_multipart_upload(Bucket=S3_BUCKET, Key=key, UploadId=upload_id)
         return {'success': False, 'key': key}
+    if resp["ResponseMetadata"]["HTTPStatusCode"] == 200:
+        return {'success': True, 'key': key}
+    return {'success': False, 'key': key}
+
+
+async def presign_get_url(key: str, expires: int = S3_PRESIGN_EXPIRES) -> str:
+    """a url which lets anyone holding it download the object for expires seconds"""
+    return await _client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': S3_BUCKET, 'Key': key},
+        ExpiresIn=expires
+    )
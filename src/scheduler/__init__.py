@@ -0,0 +1,132 @@
+import logging
+from typing import TYPE_CHECKING
+
+from config import SCHEDULER_POLICY, WORKFLOW_COSTS, MODEL_SWITCH_PENALTY
+
+if TYPE_CHECKING:
+    from comfy import ComfyServer
+
+logger = logging.getLogger(__name__)
+
+_BASE_PIXELS = 1024 * 1024
+_LATENT_CLASS_TYPES = ('EmptySD3LatentImage', 'EmptyLatentImage')
+_LOADER_CLASS_TYPES = (
+    'UNETLoader',
+    'DualCLIPLoader',
+    'CLIPLoader',
+    'VAELoader',
+    'CheckpointLoaderSimple',
+    'LoraLoader',
+    'ControlNetLoader'
+)
+
+
+def estimate_cost(workflow: str, prompt: dict | None = None) -> float:
+    """estimate the relative GPU cost of a task from its workflow type and output resolution"""
+    cost = WORKFLOW_COSTS.get(workflow, 1.0)
+    if prompt is None:
+        return cost
+    for node in prompt.values():
+        if node.get('class_type') in _LATENT_CLASS_TYPES:
+            inputs = node['inputs']
+            pixels = inputs.get('width', 1024) * inputs.get('height', 1024)
+            cost *= pixels / _BASE_PIXELS * inputs.get('batch_size', 1)
+    return cost
+
+
+def extract_model_set(prompt: dict) -> frozenset[str]:
+    """the models a prompt needs in VRAM, taken from the inputs of its loader nodes"""
+    models = set()
+    for node in prompt.values():
+        class_type = node.get('class_type')
+        if class_type not in _LOADER_CLASS_TYPES:
+            continue
+        for name, value in node['inputs'].items():
+            if isinstance(value, str):
+                models.add(f'{class_type}.{name}={value}')
+    return frozenset(models)
+
+
+class Scheduler:
+    """base class of the comfy server scheduling policies"""
+
+    def select(self, servers: list['ComfyServer'], cost: float, model_set: frozenset[str] | None) -> 'ComfyServer':
+        raise NotImplementedError
+
+    @staticmethod
+    def candidates(servers: list['ComfyServer']) -> list['ComfyServer']:
+        """the comfy servers whose websocket is up, a node which is down is unschedulable"""
+        candidates = [server for server in servers if server.connected]
+        if not candidates:
+            logger.warning('no connected comfy server, scheduling on any server')
+            candidates = servers
+        return candidates
+
+    def schedule(
+            self,
+            servers: list['ComfyServer'],
+            cost: float,
+            model_set: frozenset[str] | None = None
+    ) -> 'ComfyServer':
+        """pick a comfy server for a task and reserve its cost there right away"""
+        server = self.select(servers, cost, model_set)
+        server.reserve(cost)
+        if model_set is not None:
+            # the models of the latest queued prompt are the ones in VRAM once the queue drains
+            server.model_set = model_set
+        return server
+
+    def schedule_many(
+            self,
+            servers: list['ComfyServer'],
+            tasks: list[tuple[float, frozenset[str] | None]]
+    ) -> list['ComfyServer']:
+        """schedule (cost, model_set) tasks in one pass, each decision sees the reservations of the previous ones"""
+        return [self.schedule(servers, cost, model_set) for cost, model_set in tasks]
+
+
+class LeastQueueScheduler(Scheduler):
+    """pick the connected comfy server with the least queue remaining reported over the websocket"""
+
+    def select(self, servers: list['ComfyServer'], cost: float, model_set: frozenset[str] | None) -> 'ComfyServer':
+        return min(self.candidates(servers), key=lambda x: x.task_queue_remaining)
+
+
+class CostAwareScheduler(Scheduler):
+    """pick the connected comfy server expected to finish the task first"""
+
+    def select(self, servers: list['ComfyServer'], cost: float, model_set: frozenset[str] | None) -> 'ComfyServer':
+        return min(self.candidates(servers), key=lambda x: self.expected_finish(x, cost))
+
+    @staticmethod
+    def expected_finish(server: 'ComfyServer', cost: float) -> float:
+        """seconds until the task would finish on the server, given its pending work and learned throughput"""
+        # prompts queued by someone else are only visible through queue_remaining
+        foreign = max(0, server.task_queue_remaining - len(server.in_flight)) * WORKFLOW_COSTS.get('text2img', 1.0)
+        return (server.pending_cost + foreign + cost) / server.throughput
+
+
+class AffinityScheduler(CostAwareScheduler):
+    """cost aware scheduling which prefers the comfy servers that already have the models of the task loaded"""
+
+    def select(self, servers: list['ComfyServer'], cost: float, model_set: frozenset[str] | None) -> 'ComfyServer':
+        if model_set is None:
+            return super().select(servers, cost, model_set)
+
+        def expected_finish(server: 'ComfyServer') -> float:
+            # a cold node has to swap checkpoints first, so only spill over when the warm ones are that far behind
+            penalty = 0.0 if server.model_set == model_set else MODEL_SWITCH_PENALTY
+            return self.expected_finish(server, cost) + penalty
+
+        return min(self.candidates(servers), key=expected_finish)
+
+
+SCHEDULERS: dict[str, type[Scheduler]] = {
+    'least_queue': LeastQueueScheduler,
+    'cost_aware': CostAwareScheduler,
+    'affinity': AffinityScheduler,
+}
+
+
+def create_scheduler(policy: str = SCHEDULER_POLICY) -> Scheduler:
+    return SCHEDULERS[policy]()
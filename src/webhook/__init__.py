@@ -0,0 +1,218 @@
+import asyncio
+import logging
+from itertools import groupby
+from urllib.parse import urlsplit
+
+import httpx
+
+from config import (
+    CALL_BACK_BASE_URL,
+    WEBHOOK_OUTBOX_ENABLED,
+    WEBHOOK_HTTP_MAX_CONNECTIONS,
+    WEBHOOK_HTTP_MAX_KEEPALIVE,
+    WEBHOOK_HTTP_TIMEOUT,
+    WEBHOOK_WORKERS,
+    WEBHOOK_HOST_CONCURRENCY,
+    WEBHOOK_BATCH_SIZE,
+    WEBHOOK_MAX_ATTEMPTS,
+    WEBHOOK_BACKOFF,
+    WEBHOOK_MAX_BACKOFF,
+    WEBHOOK_LEASE,
+    WEBHOOK_POLL_INTERVAL
+)
+from database import Record, WebhookDelivery
+from database.repository import RecordRepository, WebhookOutboxRepository
+from metrics import track
+
+logger = logging.getLogger(__name__)
+
+_client: httpx.AsyncClient | None = None
+
+
+async def open_webhook_client():
+    """open the pooled http client shared by the callbacks posted right away and by the outbox"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=WEBHOOK_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=WEBHOOK_HTTP_MAX_KEEPALIVE
+            ),
+            timeout=WEBHOOK_HTTP_TIMEOUT
+        )
+
+
+async def close_webhook_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def post_webhook(url: str, payload: dict | list) -> httpx.Response:
+    return await _client.post(url, json=payload)
+
+
+class WebhookOutbox:
+    """
+    Deliver webhook callbacks from the postgres outbox table, so a slow or failing client never holds up a node.
+
+    Up to `workers` deliveries run at once over a pooled client, at most `host_concurrency` of them per callback host.
+    A failed delivery is retried after a jittered exponential backoff until it has been attempted `max_attempts` times.
+    With `batch_size` above 1, results due for the same callback url are posted together to its /batch route.
+    """
+
+    def __init__(
+            self,
+            enabled: bool = WEBHOOK_OUTBOX_ENABLED,
+            workers: int = WEBHOOK_WORKERS,
+            host_concurrency: int = WEBHOOK_HOST_CONCURRENCY,
+            batch_size: int = WEBHOOK_BATCH_SIZE,
+            max_attempts: int = WEBHOOK_MAX_ATTEMPTS,
+            backoff: float = WEBHOOK_BACKOFF,
+            max_backoff: float = WEBHOOK_MAX_BACKOFF,
+            lease: float = WEBHOOK_LEASE,
+            poll_interval: float = WEBHOOK_POLL_INTERVAL
+    ):
+        self.enabled = enabled
+        self.workers = workers
+        self.host_concurrency = host_concurrency
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.delivered = 0
+        self.failed = 0
+        self.calls = 0
+        self._host_semaphores: dict[str, asyncio.Semaphore] = {}
+        self._deliveries: set[asyncio.Task] = set()
+        self._unrecorded: set[int] = set()  # client task ids delivered whose record status couldn't be updated
+        self._wakeup = asyncio.Event()
+
+    def start(self) -> list[asyncio.Task]:
+        """start the delivery loop when the outbox is enabled, the pooled client is opened with the others"""
+        if not self.enabled:
+            return []
+        return [asyncio.create_task(self._run())]
+
+    async def stop(self):
+        """wait for the deliveries in progress"""
+        if self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+        await self._repair()
+
+    async def add(self, records: list[Record]):
+        """put the callbacks of finished records in the outbox"""
+        deliveries = [
+            WebhookDelivery(client_task_id=record.client_task_id, base_url=CALL_BACK_BASE_URL, payload=record.to_dict())
+            for record in records
+        ]
+        await WebhookOutboxRepository.add(deliveries)
+        self._wakeup.set()
+
+    async def stats(self) -> dict:
+        pending, dead = await WebhookOutboxRepository.backlog()
+        return {
+            'enabled': self.enabled,
+            'delivered': self.delivered,
+            'failed_attempts': self.failed,
+            'calls': self.calls,
+            'unrecorded': len(self._unrecorded),
+            'pending': pending,
+            'given_up': dead
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._repair()
+            try:
+                await self._claim()
+            except Exception as e:
+                logger.error(f'claim webhook deliveries error: {e}')
+
+    async def _repair(self):
+        """update the records of the deliveries whose status update failed after they were delivered"""
+        if self._unrecorded:
+            unrecorded, self._unrecorded = list(self._unrecorded), set()
+            await self._callbacks_sent(unrecorded)
+
+    async def _claim(self):
+        """claim due deliveries while there are free workers"""
+        while True:
+            free = self.workers - len(self._deliveries)
+            if free <= 0:
+                return
+            deliveries = await WebhookOutboxRepository.claim(free * self.batch_size, self.lease)
+            if not deliveries:
+                return
+            deliveries.sort(key=lambda x: x.base_url)
+            for base_url, group in groupby(deliveries, key=lambda x: x.base_url):
+                group = list(group)
+                for i in range(0, len(group), self.batch_size):
+                    task = asyncio.create_task(self._deliver(base_url, group[i:i + self.batch_size]))
+                    self._deliveries.add(task)
+                    task.add_done_callback(self._delivery_done)
+
+    def _delivery_done(self, task: asyncio.Task):
+        self._deliveries.discard(task)
+        # a worker is free, claim the deliveries which are waiting for one
+        self._wakeup.set()
+
+    async def _deliver(self, base_url: str, deliveries: list[WebhookDelivery]):
+        """post the callbacks, one result per call or all of them to the batch route"""
+        host = urlsplit(base_url).netloc
+        semaphore = self._host_semaphores.setdefault(host, asyncio.Semaphore(self.host_concurrency))
+        async with semaphore:
+            try:
+                with track('webhook'):
+                    if self.batch_size > 1:
+                        response = await post_webhook(
+                            f'{base_url}/batch',
+                            [delivery.payload for delivery in deliveries]
+                        )
+                    else:
+                        delivery = deliveries[0]
+                        response = await post_webhook(f'{base_url}/{delivery.client_task_id}', delivery.payload)
+                    self.calls += 1
+                    response.raise_for_status()
+                succeeded = True
+            except Exception as e:
+                logger.warning(f'webhook delivery to {host} of {len(deliveries)} results error: {e}')
+                succeeded = False
+
+        ids = [delivery.id for delivery in deliveries]
+        try:
+            if succeeded:
+                await WebhookOutboxRepository.delete(ids)
+            else:
+                await WebhookOutboxRepository.retry(ids, self.backoff, self.max_backoff, self.max_attempts)
+        except Exception as e:
+            # the lease expires and the deliveries are attempted again
+            logger.error(f'update webhook deliveries {ids} error: {e}')
+            return
+        if not succeeded:
+            self.failed += len(deliveries)
+            return
+        self.delivered += len(deliveries)
+        await self._callbacks_sent([delivery.client_task_id for delivery in deliveries])
+
+    async def _callbacks_sent(self, client_task_ids: list[int]):
+        """
+        mark the records of delivered callbacks. their deliveries are gone from the outbox by then,
+        so the ones which can't be updated are kept and updated again by the next sweep
+        """
+        try:
+            await RecordRepository.callbacks_sent(client_task_ids)
+        except Exception as e:
+            logger.error(f'update records {client_task_ids} of delivered webhooks error: {e}')
+            self._unrecorded.update(client_task_ids)
+
+
+webhook_outbox = WebhookOutbox()
@@ -0,0 +1,107 @@
+import hashlib
+import json
+
+
+class Workflow:
+    """
+    A ComfyUI api workflow parsed once at import time.
+
+    `params` maps each parameter name to its type and the (node id, input name) paths it's written to.
+    `build` shares the cached graph and only copies the nodes it changes,
+    so a built prompt must be treated as read-only apart from replacing whole nodes.
+    `branch_params` may differ between prompts merged into one by `merge_prompts`.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            prompt: str,
+            params: dict[str, tuple[type, list[tuple[str, str]]]],
+            branch_params: tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.graph: dict = json.loads(prompt)
+        self.params = params
+        self.branch_params = branch_params
+        for _, paths in params.values():
+            for node_id, input_name in paths:
+                if input_name not in self.graph[node_id]['inputs']:
+                    raise ValueError(f'workflow {name} has no input {node_id}.{input_name}')
+
+    def build(self, params: dict) -> dict:
+        """build a prompt from the cached graph, unknown or None params are ignored"""
+        prompt = dict(self.graph)
+        copied = set()
+        for name, value in params.items():
+            if value is None or name not in self.params:
+                continue
+            type_, paths = self.params[name]
+            value = type_(value)
+            for node_id, input_name in paths:
+                if node_id not in copied:
+                    node = dict(prompt[node_id])
+                    node['inputs'] = dict(node['inputs'])
+                    prompt[node_id] = node
+                    copied.add(node_id)
+                prompt[node_id]['inputs'][input_name] = value
+        return prompt
+
+    def batch_key(self, prompt: dict) -> str | None:
+        """
+        hash of a prompt built from this workflow without its branch params, the prompts of the same key only differ
+        in those and can be merged. None if the workflow has no branch params
+        """
+        if not self.branch_params:
+            return None
+        prompt = dict(prompt)
+        for name in self.branch_params:
+            for node_id, input_name in self.params[name][1]:
+                prompt[node_id] = {**prompt[node_id], 'inputs': {**prompt[node_id]['inputs'], input_name: None}}
+        data = json.dumps(prompt, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _is_link(value) -> bool:
+    """an input taken from another node, [node id, output index] in the api format"""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+
+def _links(node: dict) -> list[str]:
+    """ids of the nodes a node takes inputs from"""
+    return [value[0] for value in node['inputs'].values() if _is_link(value)]
+
+
+def merge_prompts(prompts: list[dict]) -> tuple[dict, list[set[str]]]:
+    """
+    merge prompts with the same nodes into one graph run by a single ComfyUI prompt, return it with the output node ids
+    of each prompt. a node which is the same in every prompt and only takes inputs from such nodes, e.g. the model
+    loaders, is shared and runs once. the others are copied for each prompt as its branch, their ids suffixed with
+    the index of the prompt. the output nodes, which no node takes inputs from, always have one copy per prompt
+    """
+    first = prompts[0]
+    inputs = {link for node in first.values() for link in _links(node)}
+    shared: dict[str, bool] = {}
+
+    def is_shared(node_id: str) -> bool:
+        if node_id not in shared:
+            node = first[node_id]
+            shared[node_id] = (
+                node_id in inputs
+                and all(prompt[node_id] == node for prompt in prompts[1:])
+                and all(is_shared(link) for link in _links(node))
+            )
+        return shared[node_id]
+
+    merged = {node_id: node for node_id, node in first.items() if is_shared(node_id)}
+    outputs = []
+    for i, prompt in enumerate(prompts):
+        for node_id, node in prompt.items():
+            if is_shared(node_id):
+                continue
+            node_inputs = {
+                name: [f'{value[0]}_{i}', value[1]] if _is_link(value) and not is_shared(value[0]) else value
+                for name, value in node['inputs'].items()
+            }
+            merged[f'{node_id}_{i}'] = {**node, 'inputs': node_inputs}
+        outputs.append({f'{node_id}_{i}' for node_id in prompt if node_id not in inputs})
+    return merged, outputs
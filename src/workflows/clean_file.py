@@ -1,10 +1,10 @@
-from string import Template
+from workflows import Workflow
 
 _CLEAN_FILE_PROMPT = """{
   "6": {
     "inputs": {
-      "type": "$type",
-      "path": "$path"
+      "type": "",
+      "path": ""
     },
     "class_type": "Clean input and output file",
     "_meta": {
@@ -13,4 +13,20 @@ _CLEAN_FILE_PROMPT = """{
   }
 }"""
 
-CLEAN_FILE_PROMPT_TEMPLATE = Template(_CLEAN_FILE_PROMPT)
\ No newline at end of file
+CLEAN_FILE_WORKFLOW = Workflow(
+    'clean_file',
+    _CLEAN_FILE_PROMPT,
+    params={
+        'type': (str, [('6', 'type')]),
+        'path': (str, [('6', 'path')]),
+    }
+)
+
+
+def build_clean_prompt(files: list[tuple[str, str]]) -> dict:
+    """one prompt deleting several (type, path) files, with a cleaner node per file as the node takes a single path"""
+    node = CLEAN_FILE_WORKFLOW.graph['6']
+    return {
+        str(node_id): {**node, 'inputs': {'type': type_, 'path': path}}
+        for node_id, (type_, path) in enumerate(files, 1)
+    }
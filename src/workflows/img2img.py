@@ -1,9 +1,10 @@
-from string import Template
+from config import IMG2IMG_URL_LOADER_NODE, IMG2IMG_URL_LOADER_INPUT
+from workflows import Workflow
 
 _IMG2IMG_PROMPT = """{
   "6": {
     "inputs": {
-      "text": "$text",
+      "text": "",
       "clip": [
         "11",
         0
@@ -152,7 +153,7 @@ _IMG2IMG_PROMPT = """{
   },
   "82": {
     "inputs": {
-      "image": "$image",
+      "image": "",
       "upload": "image"
     },
     "class_type": "LoadImage",
@@ -192,4 +193,27 @@ _IMG2IMG_PROMPT = """{
 }
 """
 
-IMG2IMG_PROMPT_TEMPLATE = Template(_IMG2IMG_PROMPT)
\ No newline at end of file
+IMG2IMG_WORKFLOW = Workflow(
+    'img2img',
+    _IMG2IMG_PROMPT,
+    params={
+        'text': (str, [('6', 'text')]),
+        'image': (str, [('82', 'image')]),
+        'seed': (int, [('50', 'noise_seed')]),
+        'steps': (int, [('17', 'steps')]),
+        'denoise': (float, [('17', 'denoise')]),
+    }
+)
+
+_LOAD_IMAGE_NODE_ID = '82'
+
+
+def load_image_from_url(prompt: dict, url: str) -> dict:
+    """replace the LoadImage node of a built prompt with the configured url loader node, the image isn't uploaded"""
+    prompt = dict(prompt)
+    prompt[_LOAD_IMAGE_NODE_ID] = {
+        'inputs': {IMG2IMG_URL_LOADER_INPUT: url},
+        'class_type': IMG2IMG_URL_LOADER_NODE,
+        '_meta': {'title': 'Load Image From URL'}
+    }
+    return prompt
@@ -1,9 +1,9 @@
-from string import Template
+from workflows import Workflow
 
 _TEXT2IMG_PROMPT = """{
   "6": {
     "inputs": {
-      "text": "$text",
+      "text": "",
       "clip": [
         "11",
         0
@@ -193,4 +193,17 @@ _TEXT2IMG_PROMPT = """{
 }
 """
 
-TEXT2IMG_PROMPT_TEMPLATE = Template(_TEXT2IMG_PROMPT)
\ No newline at end of file
+TEXT2IMG_WORKFLOW = Workflow(
+    'text2img',
+    _TEXT2IMG_PROMPT,
+    params={
+        'text': (str, [('6', 'text')]),
+        'seed': (int, [('25', 'noise_seed')]),
+        'steps': (int, [('17', 'steps')]),
+        'guidance': (float, [('26', 'guidance')]),
+        'width': (int, [('27', 'width'), ('30', 'width')]),
+        'height': (int, [('27', 'height'), ('30', 'height')]),
+        'batch_size': (int, [('27', 'batch_size')]),
+    },
+    branch_params=('text', 'seed')
+)
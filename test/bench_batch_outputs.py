@@ -0,0 +1,73 @@
+"""
+generate the same number of images as single-image text2img tasks and as tasks with a batch_size, and check that
+the webhook of each task gets the keys of all its images
+
+needs postgres (configured through the usual RDB_* variables), an s3 (e.g. moto_server) and the stub comfyui:
+    STUB_EXECUTION_SECONDS=0.5 STUB_VIEW_SECONDS=0.05 python stub_comfy.py 8188
+    COMFY_ENDPOINTS=localhost:8188 RESULT_CACHE_ENABLED=false WEBHOOK_OUTBOX_ENABLED=false \\
+        S3_ENDPOINT_URL=http://127.0.0.1:5055 S3_BUCKET=bench python bench_batch_outputs.py
+the webhook is stubbed out in process.
+"""
+import asyncio
+import os
+import time
+
+from bench_helpers import stub_webhook
+
+import comfy  # noqa: E402
+from api.service import Service  # noqa: E402
+from database import init_rdb  # noqa: E402
+from s3 import close_s3_client, open_s3_client  # noqa: E402
+
+images = 32
+payloads: list[dict] = []
+delivered = asyncio.Event()
+expected = 0
+
+
+def on_webhook(record):
+    payloads.append(record.to_dict())
+    if len(payloads) == expected:
+        delivered.set()
+
+
+async def run(batch_size: int):
+    global expected
+    payloads.clear()
+    delivered.clear()
+    expected = images // batch_size
+    base = 10 ** 9 + os.getpid() * 1000 + batch_size * 100
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        Service.text2img(base + i, {'text': f'batch {base + i}', 'batch_size': batch_size}) for i in range(expected)
+    ))
+    await asyncio.wait_for(delivered.wait(), timeout=300)
+    elapsed = time.perf_counter() - start
+    keys = [key for payload in payloads for key in payload['s3_keys']]
+    complete = sum(len(payload['s3_keys']) == batch_size for payload in payloads)
+    print(f'batch size {batch_size}: {len(keys)} images ({len(set(keys))} distinct keys) in {expected} tasks, '
+          f'{complete}/{expected} webhooks with every key, {elapsed:.1f}s, {len(keys) / elapsed:.1f} images/s')
+
+
+async def main():
+    stub_webhook(on_webhook)
+    await open_s3_client()
+    await comfy.open_http_clients()
+    workers = []
+    for server in comfy.comfy_servers:
+        workers.append(asyncio.create_task(server.listen()))
+        workers.extend(server.start_workers())
+    await asyncio.sleep(0.5)
+
+    for batch_size in (1, 4):
+        await run(batch_size)
+
+    for worker in workers:
+        worker.cancel()
+    await comfy.close_http_clients()
+    await close_s3_client()
+
+
+if __name__ == '__main__':
+    init_rdb()
+    asyncio.run(main())
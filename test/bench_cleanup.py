@@ -0,0 +1,85 @@
+"""
+count the cleanup prompts queued on a comfy node for a burst of text2img tasks, one per deleted file as before and
+batched by the per-node file cleaner
+
+needs postgres (configured through the usual RDB_* variables) and the stub comfyui:
+    python stub_comfy.py 8188
+    COMFY_ENDPOINTS=localhost:8188 RESULT_CACHE_ENABLED=false WEBHOOK_OUTBOX_ENABLED=false python bench_cleanup.py
+s3 and the webhook are stubbed out in process. the stub runs every prompt for STUB_EXECUTION_SECONDS, cleanups
+included, so the elapsed times overstate what a cleanup costs on a real node.
+"""
+import asyncio
+import os
+import time
+
+from bench_helpers import stub_s3, stub_webhook
+
+import comfy  # noqa: E402
+from api.service import Service  # noqa: E402
+
+tasks = 40
+delivered = asyncio.Event()
+hooked = 0
+
+
+def on_webhook(record):
+    global hooked
+    hooked += 1
+    if hooked == tasks:
+        delivered.set()
+
+
+async def run(batch_size: int):
+    global hooked
+    hooked = 0
+    delivered.clear()
+    server = comfy.comfy_servers[0]
+    server.cleaner.batch_size = batch_size
+    await server.client.delete('/stub/stats')
+
+    base = 10 ** 9 + os.getpid() * 1000 + batch_size
+    cleanup_slots = 0
+
+    async def watch():
+        nonlocal cleanup_slots
+        while True:
+            cleanup_slots = max(cleanup_slots, server.queue_remaining - server.task_queue_remaining)
+            await asyncio.sleep(0.01)
+
+    watcher = asyncio.create_task(watch())
+    start = time.perf_counter()
+    await asyncio.gather(*(Service.text2img(base + i, {'text': f'cleanup {base + i}'}) for i in range(tasks)))
+    await asyncio.wait_for(delivered.wait(), timeout=120)
+    elapsed = time.perf_counter() - start
+    # wait for the files still pending and the queued cleanups
+    await server.flush_cleanup()
+    while server.cleanup_prompts:
+        await asyncio.sleep(0.05)
+    drained = time.perf_counter() - start
+    watcher.cancel()
+    stats = (await server.client.get('/stub/stats')).json()
+    print(f'batch size {batch_size:>2}: {tasks} tasks delivered in {elapsed:.1f}s, node drained in {drained:.1f}s, '
+          f'{stats["cleaned_files"]} files deleted by {stats["clean_prompts"]} cleanup prompts, '
+          f'up to {cleanup_slots} cleanups queued')
+
+
+async def main():
+    stub_s3()
+    stub_webhook(on_webhook)
+    await comfy.open_http_clients()
+    workers = []
+    for server in comfy.comfy_servers:
+        workers.append(asyncio.create_task(server.listen()))
+        workers.extend(server.start_workers())
+    await asyncio.sleep(0.5)
+
+    for batch_size in (1, 50):
+        await run(batch_size)
+
+    for worker in workers:
+        worker.cancel()
+    await comfy.close_http_clients()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+"""
+count the SQL statements one task costs, from queue_prompt to the webhook, with SQLAlchemy event counters
+
+needs postgres (configured through the usual RDB_* variables) and the stub comfyui:
+    python stub_comfy.py 8188
+    COMFY_ENDPOINTS=localhost:8188 RESULT_CACHE_ENABLED=false WEBHOOK_OUTBOX_ENABLED=false python bench_db_queries.py
+s3 and the webhook are stubbed out in process, so the webhook outbox is disabled.
+"""
+import asyncio
+import os
+from collections import Counter
+
+from bench_helpers import stub_s3, stub_webhook
+
+from sqlalchemy import event  # noqa: E402
+
+import comfy  # noqa: E402
+from api.service import Service  # noqa: E402
+from database import init_rdb, sql_engine  # noqa: E402
+
+tasks = 20
+statements = Counter()
+delivered = asyncio.Event()
+hooked = 0
+
+
+@event.listens_for(sql_engine.sync_engine, 'before_cursor_execute')
+def count(conn, cursor, statement, parameters, context, executemany):
+    statements[statement.split()[0].upper()] += 1
+
+
+def on_webhook(record):
+    global hooked
+    hooked += 1
+    if hooked == tasks:
+        delivered.set()
+
+
+async def main():
+    stub_s3()
+    stub_webhook(on_webhook)
+    await comfy.open_http_clients()
+    workers = []
+    for server in comfy.comfy_servers:
+        workers.append(asyncio.create_task(server.listen()))
+        workers.extend(server.start_workers())
+    await asyncio.sleep(0.5)
+
+    base = 10 ** 9 + os.getpid() * 1000
+    statements.clear()
+    await asyncio.gather(*(Service.text2img(base + i, {'text': f'bench {base + i}'}) for i in range(tasks)))
+    await asyncio.wait_for(delivered.wait(), timeout=120)
+    await asyncio.sleep(0.5)
+
+    total = sum(statements.values())
+    print(f'{tasks} tasks, {total} statements, {total / tasks:.1f} per task: '
+          + ', '.join(f'{name}={n / tasks:.1f}' for name, n in statements.most_common()))
+    for worker in workers:
+        worker.cancel()
+    await comfy.close_http_clients()
+
+
+if __name__ == '__main__':
+    init_rdb()
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+"""
+check the priority lanes and the per-tenant fair queuing of the task queue while a batch tenant saturates the cluster
+
+needs postgres (configured through the usual RDB_* variables) and the stub comfyui:
+    python stub_comfy.py 8188
+    python stub_comfy.py 8189
+    COMFY_ENDPOINTS=localhost:8188,localhost:8189 TASK_QUEUE_ENABLED=true RESULT_CACHE_ENABLED=false \\
+        WEBHOOK_OUTBOX_ENABLED=false python bench_fair_queue.py
+s3 and the webhook are stubbed out in process, so the webhook outbox is disabled.
+"""
+import asyncio
+import os
+import time
+
+from bench_helpers import stub_s3, stub_webhook
+
+from sqlalchemy import delete  # noqa: E402
+
+import comfy  # noqa: E402
+from api.service import Service, dispatcher  # noqa: E402
+from database import QueuedTask, async_session, init_rdb  # noqa: E402
+
+BACKFILL_TASKS = 300  # queued at once by the batch tenant
+SMALL_TASKS = 20  # queued one second later by another batch tenant
+INTERACTIVE_TASKS = 40  # one every INTERACTIVE_INTERVAL seconds
+INTERACTIVE_INTERVAL = 0.25
+INTERACTIVE_PRIORITY = 10
+
+enqueued_at: dict[int, float] = {}
+latencies: dict[str, list[float]] = {'backfill': [], 'small': [], 'interactive': []}
+tenant_of: dict[int, str] = {}
+done = asyncio.Event()
+
+
+def on_webhook(record):
+    tenant = tenant_of[record.client_task_id]
+    latencies[tenant].append(time.perf_counter() - enqueued_at[record.client_task_id])
+    if len(latencies['small']) == SMALL_TASKS and len(latencies['interactive']) == INTERACTIVE_TASKS:
+        done.set()
+
+
+async def enqueue(tenant: str, client_task_ids: range, priority: int = 0):
+    tasks = []
+    for client_task_id in client_task_ids:
+        tenant_of[client_task_id] = tenant
+        enqueued_at[client_task_id] = time.perf_counter()
+        tasks.append(('text2img', client_task_id, {'text': f'{tenant} {client_task_id}'}, priority, tenant))
+    await Service.enqueue(tasks)
+
+
+async def main():
+    stub_s3()
+    stub_webhook(on_webhook)
+    await comfy.open_http_clients()
+    async with async_session() as session:
+        await session.execute(delete(QueuedTask))
+        await session.commit()
+    workers = []
+    for server in comfy.comfy_servers:
+        workers.append(asyncio.create_task(server.listen()))
+        workers.extend(server.start_workers())
+    workers.extend(dispatcher.start())
+    await asyncio.sleep(0.5)
+
+    base = 10 ** 9 + os.getpid() * 1000
+    await enqueue('backfill', range(base, base + BACKFILL_TASKS))
+    await asyncio.sleep(1)
+    await enqueue('small', range(base + 500, base + 500 + SMALL_TASKS))
+    for i in range(INTERACTIVE_TASKS):
+        await enqueue('interactive', range(base + 600 + i, base + 601 + i), INTERACTIVE_PRIORITY)
+        await asyncio.sleep(INTERACTIVE_INTERVAL)
+    await asyncio.wait_for(done.wait(), timeout=300)
+
+    for tenant, values in latencies.items():
+        values = sorted(values)
+        print(f'{tenant:>12}: {len(values)} finished, p50={values[len(values) // 2]:.2f}s '
+              f'p99={values[min(len(values) - 1, len(values) * 99 // 100)]:.2f}s')
+    for lane, wait in (await dispatcher.stats())['wait'].items():
+        print(f'queue wait of lane {lane}: {wait["count"]} tasks, p50<={wait["p50"]}s p99<={wait["p99"]}s')
+
+    for worker in workers:
+        worker.cancel()
+    async with async_session() as session:
+        await session.execute(delete(QueuedTask))
+        await session.commit()
+    await comfy.close_http_clients()
+
+
+if __name__ == '__main__':
+    init_rdb()
+    asyncio.run(main())
@@ -0,0 +1,29 @@
+"""
+the in-process stubs shared by the benchmarks. importing this module puts src on the path, stub_s3 and stub_webhook
+replace the s3 upload and the webhook of the comfy servers, so a benchmark only needs postgres and the stub comfyui
+"""
+import os
+import sys
+import time
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import comfy  # noqa: E402
+from database import Record  # noqa: E402
+
+
+def stub_s3(unique_keys: bool = False):
+    """uploads which always succeed, under a key of their own when the result cache must tell them apart"""
+    async def upload_image_to_s3(image: bytes) -> dict:
+        return {'success': True, 'key': f'bench-{time.perf_counter_ns()}.png' if unique_keys else 'bench.png'}
+
+    comfy.upload_image_to_s3 = upload_image_to_s3
+
+
+def stub_webhook(on_webhook: Callable[[Record], None] = lambda record: None):
+    """webhooks which always succeed, on_webhook is called with the record of each one"""
+    async def hook(self, record: Record):
+        on_webhook(record)
+
+    comfy.ComfyServer.hook = hook
@@ -0,0 +1,50 @@
+"""
+benchmark the http calls made to a comfy server: a new httpx.AsyncClient per call versus one pooled keep-alive client
+
+start the stub first: python stub_comfy.py 8188
+"""
+import asyncio
+import sys
+import time
+
+import httpx
+
+endpoint = 'http://localhost:8188'
+concurrency = 32
+total = 1000
+
+
+async def per_call_client(method: str, path: str, **kwargs):
+    async with httpx.AsyncClient(base_url=endpoint) as client:
+        return await client.request(method, path, **kwargs)
+
+
+async def run(name: str, request):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            if i % 3 == 0:
+                await request('POST', '/prompt', json={'prompt': {}, 'client_id': 'bench'})
+            elif i % 3 == 1:
+                await request('GET', '/history/bench')
+            else:
+                await request('GET', '/view', params={'filename': 'bench.png'})
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+    print(f'{name:>10}: {total} requests in {elapsed:.2f}s, {total / elapsed:.1f} req/s')
+
+
+async def main():
+    await run('per-call', per_call_client)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=endpoint, limits=limits) as client:
+        await run('pooled', client.request)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        endpoint = sys.argv[1]
+    asyncio.run(main())
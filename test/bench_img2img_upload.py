@@ -0,0 +1,101 @@
+"""
+compare the peak memory and the latency of the service for img2img inputs sent as base64 json or as a streamed body
+
+needs postgres (configured through the usual RDB_* variables) and the stub comfyui:
+    python stub_comfy.py 8188
+    COMFY_ENDPOINTS=localhost:8188 RESULT_CACHE_ENABLED=false WEBHOOK_OUTBOX_ENABLED=false python bench_img2img_upload.py
+the service runs in a fresh subprocess for every mode, with s3 stubbed out, and its peak RSS is read from /proc.
+"""
+import asyncio
+import base64
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+PORT = 8011
+IMAGE_SIZE = 8 * 1024 * 1024
+BATCH = 8
+PARAMS = {'text': 'a cat', 'denoise': 0.6}
+
+
+def serve():
+    # s3 is stubbed out, the client only needs a valid endpoint
+    os.environ.setdefault('S3_REGION_NAME', 'us-east-1')
+    import uvicorn
+    from bench_helpers import stub_s3
+
+    stub_s3()
+    from main import app
+    uvicorn.run(app, host='127.0.0.1', port=PORT, log_level='warning')
+
+
+def memory_kb(pid: int, field: str) -> int:
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+async def send(client: httpx.AsyncClient, mode: str, client_task_id: int, image: bytes) -> float:
+    start = time.perf_counter()
+    if mode == 'base64':
+        body = {
+            'service_type': 'img2img',
+            'client_task_id': client_task_id,
+            'params': {**PARAMS, 'image': base64.b64encode(image).decode()}
+        }
+        response = await client.post('/api/v1', json=body)
+    else:
+        response = await client.post(
+            f'/api/v1/img2img/{client_task_id}',
+            params=PARAMS,
+            content=image,
+            headers={'Content-Type': 'image/png'}
+        )
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def run(mode: str):
+    server = subprocess.Popen([sys.executable, __file__, 'serve'])
+    try:
+        async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{PORT}', timeout=120) as client:
+            for _ in range(100):
+                try:
+                    await client.get('/api/v1/stats')
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.2)
+            base = 10 ** 9 + os.getpid() * 100 + (0 if mode == 'base64' else 50)
+            # warm up with a small image so the imports and pools don't count
+            await send(client, mode, base, os.urandom(1024))
+            baseline = memory_kb(server.pid, 'VmRSS')
+
+            images = [os.urandom(IMAGE_SIZE) for _ in range(BATCH)]
+            start = time.perf_counter()
+            latencies = await asyncio.gather(*(send(client, mode, base + 1 + i, image) for i, image in enumerate(images)))
+            elapsed = time.perf_counter() - start
+            peak = memory_kb(server.pid, 'VmHWM')
+        latencies = sorted(latencies)
+        print(f'{mode:>7}: {BATCH} x {IMAGE_SIZE // 1024 // 1024}MB in {elapsed:.2f}s, '
+              f'latency p50={latencies[len(latencies) // 2] * 1000:.0f}ms max={latencies[-1] * 1000:.0f}ms, '
+              f'peak RSS +{(peak - baseline) / 1024:.0f}MB over {baseline / 1024:.0f}MB')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def main():
+    for mode in ('base64', 'stream'):
+        await run(mode)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,83 @@
+"""
+count the img2img input uploads and cleanup prompts when clients reuse the same source images, with and without
+the per-node input upload cache
+
+needs postgres (configured through the usual RDB_* variables) and the stub comfyui:
+    python stub_comfy.py 8188
+    COMFY_ENDPOINTS=localhost:8188 RESULT_CACHE_ENABLED=false WEBHOOK_OUTBOX_ENABLED=false python bench_input_uploads.py
+s3 and the webhook are stubbed out in process.
+"""
+import asyncio
+import base64
+import os
+import random
+import time
+
+from bench_helpers import stub_s3, stub_webhook
+
+import comfy  # noqa: E402
+from api.service import Service  # noqa: E402
+
+tasks = 40
+wave = 4  # tasks sent together, the next ones are sent once they have finished
+source_images = 5
+image_size = 2 * 1024 * 1024
+delivered = asyncio.Event()
+hooked = 0
+
+
+def on_webhook(record):
+    global hooked
+    hooked += 1
+    if hooked % wave == 0:
+        delivered.set()
+
+
+async def run(max_entries: int, sources: list[str]):
+    global hooked
+    hooked = 0
+    server = comfy.comfy_servers[0]
+    server.inputs.max_entries = max_entries
+    await server.client.delete('/stub/stats')
+
+    rng = random.Random(1)
+    base = 10 ** 9 + os.getpid() * 1000 + max_entries
+    start = time.perf_counter()
+    for offset in range(0, tasks, wave):
+        delivered.clear()
+        await asyncio.gather(*(
+            Service.img2img(base + i, {'text': f'variation {base + i}', 'image': rng.choice(sources)})
+            for i in range(offset, offset + wave)
+        ))
+        await asyncio.wait_for(delivered.wait(), timeout=120)
+    elapsed = time.perf_counter() - start
+    # the evicted inputs are deleted with the next cleanup prompt
+    await asyncio.sleep(0.5)
+    await server.flush_cleanup()
+    stats = (await server.client.get('/stub/stats')).json()
+    print(f'cache of {max_entries:>3} inputs: {tasks} tasks in {elapsed:.1f}s, {stats["uploads"]} uploads '
+          f'({stats["upload_bytes"] / 1024 / 1024:.0f}MB), {stats["cleaned_files"]} files deleted by '
+          f'{stats["clean_prompts"]} cleanup prompts, {stats["prompts"]} prompts queued in total')
+
+
+async def main():
+    stub_s3()
+    stub_webhook(on_webhook)
+    await comfy.open_http_clients()
+    workers = []
+    for server in comfy.comfy_servers:
+        workers.append(asyncio.create_task(server.listen()))
+        workers.extend(server.start_workers())
+    await asyncio.sleep(0.5)
+
+    sources = [base64.b64encode(os.urandom(image_size)).decode() for _ in range(source_images)]
+    for max_entries in (0, 256):
+        await run(max_entries, sources)
+
+    for worker in workers:
+        worker.cancel()
+    await comfy.close_http_clients()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
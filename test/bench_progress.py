@@ -0,0 +1,86 @@
+"""
+stream the progress events of a burst of text2img tasks to many subscribers per task, and measure what the fan-out
+costs the listener of the node, with a share of the subscribers reading slowly
+
+needs postgres (configured through the usual RDB_* variables) and the stub comfyui:
+    STUB_EXECUTION_SECONDS=0.2 STUB_PROGRESS_STEPS=20 python stub_comfy.py 8189
+    COMFY_ENDPOINTS=localhost:8189 RESULT_CACHE_ENABLED=false WEBHOOK_OUTBOX_ENABLED=false python bench_progress.py
+s3 and the webhook are stubbed out in process.
+"""
+import asyncio
+import os
+import time
+
+from bench_helpers import stub_s3, stub_webhook
+
+import comfy  # noqa: E402
+from api.service import Service  # noqa: E402
+from comfy.progress import progress_hub  # noqa: E402
+
+tasks = 20
+subscribers = 100  # per task
+slow_every = 10  # one subscriber out of slow_every takes 50ms per event
+
+
+async def subscriber(client_task_id: int, slow: bool) -> tuple[int, bool, float]:
+    """the number of events received, whether the last one was completed and the latency of that one"""
+    events = 0
+    last = ''
+    async for message in progress_hub.subscribe(client_task_id):
+        if message.startswith(':'):
+            continue
+        events += 1
+        last = message.split('\n')[1]
+        if slow:
+            await asyncio.sleep(0.05)
+    return events, last == 'event: completed', time.perf_counter()
+
+
+async def main():
+    stub_s3()
+    stub_webhook()
+    await comfy.open_http_clients()
+    server = comfy.comfy_servers[0]
+
+    # time spent by the listener in handling the messages, the publishing included
+    handling = 0.0
+    handle_message = server._handle_message
+
+    async def timed_handle_message(json_data):
+        nonlocal handling
+        start = time.perf_counter()
+        await handle_message(json_data)
+        handling += time.perf_counter() - start
+
+    server._handle_message = timed_handle_message
+    workers = [asyncio.create_task(server.listen()), *server.start_workers()]
+    while not server.connected:
+        await asyncio.sleep(0.05)
+
+    base = 10 ** 9 + os.getpid() * 1000
+    readers = [
+        asyncio.create_task(subscriber(base + i, j % slow_every == 0))
+        for i in range(tasks) for j in range(subscribers)
+    ]
+    await asyncio.sleep(0.1)
+    start = time.perf_counter()
+    await asyncio.gather(*(Service.text2img(base + i, {'text': f'progress {base + i}'}) for i in range(tasks)))
+    results = await asyncio.wait_for(asyncio.gather(*readers), timeout=120)
+    elapsed = time.perf_counter() - start
+
+    completed = sum(done for _, done, _ in results)
+    events = sum(count for count, _, _ in results)
+    fast = sorted(at for i, (_, _, at) in enumerate(results) if i % slow_every)
+    stats = progress_hub.stats()
+    print(f'{tasks} tasks x {subscribers} subscribers: {completed}/{len(results)} streams completed in {elapsed:.1f}s, '
+          f'{events} events delivered from {stats["published"]} published, '
+          f'listener busy {handling * 1000:.0f}ms in total, '
+          f'last fast subscriber done {(fast[-1] - start):.1f}s after the start')
+
+    for worker in workers:
+        worker.cancel()
+    await comfy.close_http_clients()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
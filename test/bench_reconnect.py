@@ -0,0 +1,94 @@
+"""
+check that no result goes missing while a comfy node keeps dropping the websocket, and that the tasks a previous run
+of the service left unfinished are adopted
+
+needs postgres (configured through the usual RDB_* variables) and a stub comfyui dropping its websockets:
+    STUB_DROP_INTERVAL=1 STUB_EXECUTION_SECONDS=0.2 python stub_comfy.py 8190
+    COMFY_ENDPOINTS=localhost:8190 RESULT_CACHE_ENABLED=false WEBHOOK_OUTBOX_ENABLED=false \\
+        COMFY_RECONNECT_BACKOFF=0.2 COMFY_RECONNECT_MAX_BACKOFF=2 COMFY_WS_PING_INTERVAL=2 python bench_reconnect.py
+s3 and the webhook are stubbed out in process. with COMFY_IMAGE_DELIVERY=websocket the tasks which finish while the
+websocket is down can't be recovered, they're counted as missed.
+"""
+import asyncio
+import os
+import time
+
+from bench_helpers import stub_s3, stub_webhook
+
+import httpx  # noqa: E402
+
+import comfy  # noqa: E402
+from api.service import Service  # noqa: E402
+from config import COMFY_ENDPOINTS  # noqa: E402
+from database import Record, RecordStatus, init_rdb  # noqa: E402
+from database.repository import RecordRepository  # noqa: E402
+from workflows.text2img import TEXT2IMG_WORKFLOW  # noqa: E402
+
+tasks = 60
+previous_run_tasks = 5
+delivered: set[int] = set()
+all_delivered = asyncio.Event()
+
+
+def on_webhook(record):
+    delivered.add(record.client_task_id)
+    if len(delivered) == tasks + previous_run_tasks:
+        all_delivered.set()
+
+
+async def queue_previous_run(base: int):
+    """queue prompts with another client id and record them, as a run of the service stopped right after would"""
+    endpoint = COMFY_ENDPOINTS[0]
+    records = []
+    async with httpx.AsyncClient(base_url=f'http://{endpoint}') as client:
+        for i in range(previous_run_tasks):
+            prompt = TEXT2IMG_WORKFLOW.build({'text': f'previous run {base + i}'})
+            response = await client.post('/prompt', json={'prompt': prompt, 'client_id': 'previous-run'})
+            records.append(Record(
+                client_task_id=base + i,
+                comfy_task_id=response.json()['prompt_id'],
+                status=RecordStatus.QUEUED,
+                comfy_endpoint=endpoint
+            ))
+    await RecordRepository.bulk_create(records)
+
+
+async def main():
+    base = 10 ** 9 + os.getpid() * 1000
+    await queue_previous_run(base + tasks)
+    stub_s3()
+    stub_webhook(on_webhook)
+    await comfy.open_http_clients()
+    server = comfy.comfy_servers[0]
+    adopted = len(server._adopted)
+    await server.client.delete('/stub/stats')
+    workers = [asyncio.create_task(server.listen()), *server.start_workers()]
+    while not server.connected:
+        await asyncio.sleep(0.05)
+
+    start = time.perf_counter()
+    for i in range(tasks):
+        await Service.text2img(base + i, {'text': f'reconnect {base + i}'})
+        await asyncio.sleep(0.1)
+    deadline = time.monotonic() + 120
+    while not all_delivered.is_set() and time.monotonic() < deadline:
+        stats = server.stats()
+        if len(delivered) + stats['missed'] + stats['lost'] >= tasks + previous_run_tasks:
+            break
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - start
+    stub = (await server.client.get('/stub/stats')).json()
+    stats = server.stats()
+    print(f'{len(delivered)}/{tasks + previous_run_tasks} results delivered in {elapsed:.1f}s '
+          f'({adopted} tasks adopted from the previous run), {stub["connections"]} websocket connections, '
+          f'{stats["reconnects"]} reconnects, {stats["reconciled"]} tasks reconciled, {stats["lost"]} lost, '
+          f'{stats["missed"]} missed')
+
+    for worker in workers:
+        worker.cancel()
+    await comfy.close_http_clients()
+
+
+if __name__ == '__main__':
+    init_rdb()
+    asyncio.run(main())
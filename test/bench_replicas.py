@@ -0,0 +1,149 @@
+"""
+run several replicas of the service against the same comfy nodes, send text2img requests to all of them and kill the
+replica leading a node halfway. check that every accepted task gets its webhook, that none is delivered twice, and
+that each prompt has run once on the nodes
+
+needs postgres (configured through the usual RDB_* variables), an s3 (e.g. moto_server), the stub webhook receiver and
+two stub comfyui:
+    STUB_EXECUTION_SECONDS=0.3 python stub_comfy.py 8188
+    STUB_EXECUTION_SECONDS=0.3 python stub_comfy.py 8189
+    python stub_webhook.py 9100
+    COMFY_ENDPOINTS=localhost:8188,localhost:8189 CALL_BACK_BASE_URL=http://localhost:9100/callback \\
+        S3_ENDPOINT_URL=http://127.0.0.1:5055 S3_BUCKET=bench RESULT_CACHE_ENABLED=false WEBHOOK_OUTBOX_ENABLED=true \\
+        WEBHOOK_BACKOFF=0.2 COORDINATION_HEARTBEAT=0.5 python bench_replicas.py
+the replicas are started on ports 8031 and up with COORDINATION_ENABLED=true, their logs go to /tmp/replica_<n>.log.
+the outbox retries the webhooks the stub receiver fails on purpose.
+"""
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import httpx
+
+src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, src)
+
+from config import COMFY_ENDPOINTS, ROUTE_PREFIX  # noqa: E402
+from database import Record, RecordStatus, sql_engine  # noqa: E402
+from sqlalchemy import func, select  # noqa: E402
+
+replicas = 3
+tasks = 120
+concurrency = 12
+webhook = 'http://localhost:9100'
+
+
+def start_replica(n: int) -> subprocess.Popen:
+    env = {**os.environ, 'COORDINATION_ENABLED': 'true', 'SERVICE_PORT': str(8031 + n)}
+    log = open(f'/tmp/replica_{n}.log', 'w')
+    return subprocess.Popen([sys.executable, 'main.py'], cwd=src, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_for_leaders(client: httpx.AsyncClient, ports: list[int], timeout: float = 30) -> dict[str, int]:
+    """the port of the replica leading each node, once every node has one"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        leaders = {}
+        for port in ports:
+            try:
+                stats = (await client.get(f'http://localhost:{port}{ROUTE_PREFIX}/stats')).json()
+            except httpx.HTTPError:
+                continue
+            for endpoint, node in stats['nodes'].items():
+                if node['leading'] and node['connected']:
+                    leaders[endpoint] = port
+        if len(leaders) == len(COMFY_ENDPOINTS):
+            return leaders
+        await asyncio.sleep(0.1)
+    raise TimeoutError('the nodes have no leader')
+
+
+async def main():
+    processes = {8031 + n: start_replica(n) for n in range(replicas)}
+    base = 10 ** 9 + os.getpid() * 1000
+    accepted: list[int] = []
+    refused = 0
+    try:
+        async with httpx.AsyncClient(timeout=30) as client:
+            leaders = await wait_for_leaders(client, list(processes))
+            print(f'{replicas} replicas up, leaders: {leaders}')
+            await client.delete(f'{webhook}/stats')
+            prompts_before = 0
+            for endpoint in COMFY_ENDPOINTS:
+                stub = (await client.get(f'http://{endpoint}/stub/stats')).json()
+                prompts_before += stub['prompts'] - stub['clean_prompts']
+
+            victim = max(set(leaders.values()), key=lambda port: list(leaders.values()).count(port))
+            alive = list(processes)
+            sent = 0
+            killed_at = None
+
+            async def sender():
+                nonlocal sent, refused, killed_at
+                while sent < tasks:
+                    i = sent
+                    sent += 1
+                    if i == tasks // 2 and killed_at is None:
+                        processes[victim].send_signal(signal.SIGKILL)
+                        alive.remove(victim)
+                        killed_at = time.monotonic()
+                        print(f'killed replica {victim} at task {i}')
+                    port = alive[i % len(alive)]
+                    request = {
+                        'service_type': 'text2img',
+                        'client_task_id': base + i,
+                        'params': {'text': f'replica {base + i}'}
+                    }
+                    try:
+                        response = await client.post(f'http://localhost:{port}{ROUTE_PREFIX}', json=request)
+                        response.raise_for_status()
+                        accepted.append(base + i)
+                    except httpx.HTTPError:
+                        refused += 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*(sender() for _ in range(concurrency)))
+            new_leaders = await wait_for_leaders(client, alive)
+            takeover = time.monotonic() - killed_at
+            while True:
+                stats = (await client.get(f'{webhook}/stats')).json()
+                if stats['unique'] >= len(accepted) or time.perf_counter() - start > 120:
+                    break
+                await asyncio.sleep(0.2)
+            elapsed = time.perf_counter() - start
+            await asyncio.sleep(1)
+            stats = (await client.get(f'{webhook}/stats')).json()
+            prompts = -prompts_before
+            for endpoint in COMFY_ENDPOINTS:
+                stub = (await client.get(f'http://{endpoint}/stub/stats')).json()
+                prompts += stub['prompts'] - stub['clean_prompts']
+            coordination = [
+                (await client.get(f'http://localhost:{port}{ROUTE_PREFIX}/stats')).json()['coordination'] for port in alive
+            ]
+        async with sql_engine.connect() as conn:
+            unfinished = await conn.scalar(select(func.count()).select_from(Record).where(
+                Record.client_task_id.in_(accepted),
+                Record.status.in_(RecordStatus.UNFINISHED)
+            ))
+
+        print(f'{len(accepted)} tasks accepted ({refused} refused by the killed replica), '
+              f'{stats["unique"]} delivered in {elapsed:.1f}s, {stats["duplicates"]} duplicate webhooks, '
+              f'{prompts} prompts run on the nodes, {unfinished} records left unfinished')
+        print(f'nodes led by {new_leaders} {takeover:.1f}s after the kill, '
+              f'takeovers {[c["takeovers"] for c in coordination]}, '
+              f'notifications sent {[c["notified"] for c in coordination]} '
+              f'received {[c["received"] for c in coordination]}')
+    finally:
+        for process in processes.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in processes.values():
+            process.wait()
+        await sql_engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+"""
+measure s3 upload throughput of s3.upload_image_to_s3 at different concurrency levels
+
+run against a local S3 stand-in, e.g. moto:
+    moto_server -p 5000
+    S3_ENDPOINT_URL=http://localhost:5000 S3_BUCKET=bench S3_REGION_NAME=us-east-1 \
+        AWS_ACCESS_KEY_ID=test AWS_SECRET_ACCESS_KEY=test python bench_s3_upload.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import s3  # noqa: E402
+from config import S3_BUCKET  # noqa: E402
+
+sizes = {'1MB': 1024 * 1024, '32MB': 32 * 1024 * 1024}
+concurrency_levels = [1, 4, 16, 64]
+total_bytes = 256 * 1024 * 1024
+
+
+async def run(size_name: str, size: int, concurrency: int):
+    image = os.urandom(size)
+    count = max(concurrency, total_bytes // size)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            resp = await s3.upload_image_to_s3(image)
+            assert resp['success'], resp
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(count)))
+    elapsed = time.perf_counter() - start
+    print(f'{size_name:>5} x {count:<4} concurrency={concurrency:<3} '
+          f'{count / elapsed:8.1f} uploads/s {count * size / elapsed / 1024 / 1024:8.1f} MB/s')
+
+
+async def main():
+    await s3.open_s3_client()
+    try:
+        try:
+            await s3._client.create_bucket(Bucket=S3_BUCKET)
+        except Exception:
+            pass
+        for size_name, size in sizes.items():
+            for concurrency in concurrency_levels:
+                await run(size_name, size, concurrency)
+    finally:
+        await s3.close_s3_client()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+"""
+exercise the durable task queue against stub comfyui nodes: queue depth, priorities, cancellation and admission control
+
+needs postgres (configured through the usual RDB_* variables) and the stub comfyui:
+    python stub_comfy.py 8188
+    python stub_comfy.py 8189
+    COMFY_ENDPOINTS=localhost:8188,localhost:8189 TASK_QUEUE_ENABLED=true TASK_QUEUE_MAX_BACKLOG=100 \\
+        RESULT_CACHE_ENABLED=false WEBHOOK_OUTBOX_ENABLED=false python bench_task_queue.py
+s3 and the webhook are stubbed out in process, so the webhook outbox is disabled.
+"""
+import asyncio
+import os
+import time
+
+from bench_helpers import stub_s3, stub_webhook
+
+from sqlalchemy import delete  # noqa: E402
+
+import comfy  # noqa: E402
+from api.service import BacklogFullError, Service, dispatcher  # noqa: E402
+from config import TASK_QUEUE_MAX_BACKLOG  # noqa: E402
+from database import QueuedTask, async_session, init_rdb  # noqa: E402
+from database.repository import TaskQueueRepository  # noqa: E402
+
+low_tasks = 40
+high_tasks = 5
+cancelled_tasks = 5
+finished: list[int] = []
+delivered = asyncio.Event()
+
+
+def on_webhook(record):
+    finished.append(record.client_task_id)
+    if len(finished) == low_tasks + high_tasks - cancelled_tasks:
+        delivered.set()
+
+
+async def sample_depth(depths: dict[str, int]):
+    while True:
+        for server in comfy.comfy_servers:
+            depths[server.endpoint] = max(depths.get(server.endpoint, 0), len(server.in_flight))
+        await asyncio.sleep(0.01)
+
+
+async def main():
+    stub_s3()
+    stub_webhook(on_webhook)
+    await comfy.open_http_clients()
+    async with async_session() as session:
+        await session.execute(delete(QueuedTask))
+        await session.commit()
+
+    base = 10 ** 9 + os.getpid() * 1000
+    low = [('text2img', base + i, {'text': f'low {base + i}'}, 0, 'default') for i in range(low_tasks)]
+    high = [('text2img', base + 500 + i, {'text': f'high {base + i}'}, 10, 'default') for i in range(high_tasks)]
+
+    # the backlog is queued before any comfy server is connected, so nothing is dispatched yet
+    await Service.enqueue(low)
+    await Service.enqueue(high)
+    for _, client_task_id, *_ in low[-cancelled_tasks:]:
+        assert await TaskQueueRepository.cancel(client_task_id) == 1
+    try:
+        overflow = [('text2img', base + 900 + i, {'text': 'overflow'}, 0, 'default') for i in range(TASK_QUEUE_MAX_BACKLOG)]
+        await Service.enqueue(overflow)
+        print('admission control: FAILED, the overflow batch was accepted')
+    except BacklogFullError:
+        print(f'admission control: ok, batch over the backlog limit of {TASK_QUEUE_MAX_BACKLOG} rejected')
+
+    workers = []
+    for server in comfy.comfy_servers:
+        workers.append(asyncio.create_task(server.listen()))
+        workers.extend(server.start_workers())
+    depths = {}
+    workers.append(asyncio.create_task(sample_depth(depths)))
+    start = time.perf_counter()
+    workers.extend(dispatcher.start())
+    await asyncio.wait_for(delivered.wait(), timeout=300)
+
+    high_ids = {client_task_id for _, client_task_id, *_ in high}
+    positions = [position for position, client_task_id in enumerate(finished) if client_task_id in high_ids]
+    cancelled_ids = {client_task_id for _, client_task_id, *_ in low[-cancelled_tasks:]}
+    print(f'{len(finished)} tasks in {time.perf_counter() - start:.1f}s')
+    print(f'max in-flight per node (target {dispatcher.depth}): {depths}')
+    print(f'finish positions of the {high_tasks} high priority tasks queued last: {positions}')
+    print(f'cancelled tasks executed: {len(cancelled_ids & set(finished))}')
+    print(f'dispatcher: {await dispatcher.stats()}')
+    for worker in workers:
+        worker.cancel()
+    await comfy.close_http_clients()
+
+
+if __name__ == '__main__':
+    init_rdb()
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+"""
+concurrent clients each sending text2img requests which only differ in their text, one after the other once the
+webhook of the previous one has arrived. compare the images per second and the latency from the request to the
+webhook with one prompt per request and with the requests merged into batched prompts. the samplers of a merged
+prompt run one after the other, the difference is the per-prompt overhead
+
+needs postgres (configured through the usual RDB_* variables) and the stub comfyui
+    STUB_EXECUTION_SECONDS=0.5 STUB_BATCH_COST=0.25 python stub_comfy.py 8188
+    COMFY_ENDPOINTS=localhost:8188 RESULT_CACHE_ENABLED=false WEBHOOK_OUTBOX_ENABLED=false \\
+        TEXT2IMG_BATCH_MAX_SIZE=4 TEXT2IMG_BATCH_MAX_WAIT=0.03 python bench_text2img_batching.py
+s3 and the webhook are stubbed out in process.
+"""
+import asyncio
+import os
+import time
+
+from bench_helpers import stub_s3, stub_webhook
+
+import comfy  # noqa: E402
+from api.service import Service, text2img_batcher  # noqa: E402
+
+clients = 8
+requests_per_client = 6
+latencies: list[float] = []
+webhooks: dict[int, asyncio.Future] = {}
+
+
+def on_webhook(record):
+    webhooks.pop(record.client_task_id).set_result(None)
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def client(base: int):
+    for i in range(requests_per_client):
+        client_task_id = base + i
+        webhooks[client_task_id] = asyncio.get_running_loop().create_future()
+        sent = time.perf_counter()
+        await Service.text2img(client_task_id, {'text': f'a cat number {client_task_id}'})
+        await asyncio.wait_for(webhooks[client_task_id], timeout=120)
+        latencies.append(time.perf_counter() - sent)
+
+
+async def run(batching: bool):
+    text2img_batcher.enabled = batching
+    latencies.clear()
+    base = 10 ** 9 + os.getpid() * 1000 + batching * 500
+    start = time.perf_counter()
+    await asyncio.gather(*(client(base + i * requests_per_client) for i in range(clients)))
+    elapsed = time.perf_counter() - start
+    tasks = clients * requests_per_client
+    stats = text2img_batcher.stats()
+    batches = f', {stats["mean_size"]:.1f} requests per prompt, batch wait p99 {stats["wait"]["p99"]}s' if batching else ''
+    print(f'batching {"on " if batching else "off"}: {tasks} images in {elapsed:.1f}s, {tasks / elapsed:.2f} images/s, '
+          f'latency p50 {percentile(latencies, 0.5):.2f}s p99 {percentile(latencies, 0.99):.2f}s{batches}')
+    return tasks / elapsed
+
+
+async def main():
+    stub_s3(unique_keys=True)
+    stub_webhook(on_webhook)
+    await comfy.open_http_clients()
+    workers = []
+    for server in comfy.comfy_servers:
+        workers.append(asyncio.create_task(server.listen()))
+        workers.extend(server.start_workers())
+    await asyncio.sleep(0.5)
+
+    unbatched = await run(False)
+    batched = await run(True)
+    print(f'{batched / unbatched:.2f}x images/s with batching')
+    # the last completions record their callbacks after the webhook
+    await asyncio.sleep(1)
+
+    for worker in workers:
+        worker.cancel()
+    await comfy.close_http_clients()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
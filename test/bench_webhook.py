@@ -0,0 +1,60 @@
+"""
+measure the webhook outbox delivery throughput against the stub receiver, one result per call and batched
+
+needs postgres (configured through the usual RDB_* variables) and the stub receiver:
+    STUB_WEBHOOK_LATENCY=0.05 STUB_WEBHOOK_FAILURE_RATE=0.1 python stub_webhook.py 9100
+    CALL_BACK_BASE_URL=http://localhost:9100/callback WEBHOOK_BACKOFF=0.2 python bench_webhook.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import httpx  # noqa: E402
+from sqlalchemy import delete  # noqa: E402
+
+from config import CALL_BACK_BASE_URL  # noqa: E402
+from database import Record, WebhookDelivery, async_session, init_rdb  # noqa: E402
+from webhook import WebhookOutbox, close_webhook_client, open_webhook_client  # noqa: E402
+
+total = 2000
+stats_url = CALL_BACK_BASE_URL.rsplit('/', 1)[0] + '/stats'
+
+
+async def run(batch_size: int):
+    async with async_session() as session:
+        await session.execute(delete(WebhookDelivery))
+        await session.commit()
+    async with httpx.AsyncClient() as client:
+        await client.delete(stats_url)
+        outbox = WebhookOutbox(enabled=True, batch_size=batch_size)
+        records = [Record(client_task_id=i, comfy_task_id=f'bench-{i}', s3_key='bench.png') for i in range(total)]
+        await outbox.add(records)
+
+        await open_webhook_client()
+        start = time.perf_counter()
+        tasks = outbox.start()
+        while True:
+            stats = (await client.get(stats_url)).json()
+            if stats['unique'] >= total:
+                break
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - start
+        for task in tasks:
+            task.cancel()
+        await outbox.stop()
+        await close_webhook_client()
+    print(f'batch size {batch_size:>3}: {total} results in {elapsed:.2f}s, {total / elapsed:.0f} results/s, '
+          f'{stats["calls"]} calls, {stats["failures"]} injected failures retried, {stats["duplicates"]} duplicates')
+
+
+async def main():
+    for batch_size in (1, 20):
+        await run(batch_size)
+
+
+if __name__ == '__main__':
+    init_rdb()
+    asyncio.run(main())
@@ -0,0 +1,31 @@
+"""
+micro-benchmark prompt construction: string.Template substitute + json.loads versus the precompiled workflow registry
+"""
+import json
+import os
+import sys
+import timeit
+from string import Template
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from workflows.text2img import TEXT2IMG_WORKFLOW  # noqa: E402
+
+# the template the workflow was written as before the registry
+template = Template(json.dumps(TEXT2IMG_WORKFLOW.graph, indent=2).replace('"text": ""', '"text": "$text"'))
+params = {'text': 'a cat sitting on a windowsill', 'seed': 42, 'width': 768, 'height': 1024}
+
+
+def substitute():
+    return json.loads(template.substitute(text=params['text']))
+
+
+def build():
+    return TEXT2IMG_WORKFLOW.build(params)
+
+
+if __name__ == '__main__':
+    number = 20000
+    for name, func in (('substitute', substitute), ('build', build)):
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print(f'{name:>10}: {number / seconds:10.0f} prompts/s')
@@ -0,0 +1,7 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# a script sending requests to a running service, not a test
+collect_ignore = ['stress_test.py']
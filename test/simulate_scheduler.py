@@ -0,0 +1,122 @@
+"""
+simulate the scheduling policies with fake comfy nodes and compare the task completion latency
+
+no comfyui, database or s3 needed:
+    python simulate_scheduler.py
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import scheduler as scheduler_module  # noqa: E402
+from comfy import ComfyServer  # noqa: E402
+from scheduler import create_scheduler, estimate_cost, extract_model_set  # noqa: E402
+from workflows.img2img import IMG2IMG_WORKFLOW  # noqa: E402
+from workflows.text2img import TEXT2IMG_WORKFLOW  # noqa: E402
+
+SECONDS_PER_COST = 0.05  # execution seconds of one cost unit on a node of speed 1
+STATUS_LAG = 0.05  # seconds before a queue change is reported over the websocket
+LOAD_PENALTY = 0.5  # seconds to swap the models in VRAM when a prompt needs other models than the previous one
+NODE_SPEEDS = [1.0, 1.0, 0.5]
+RESOLUTIONS = [(512, 512), (1024, 1024), (1024, 1024), (1536, 1536)]
+WORKFLOWS = {'text2img': TEXT2IMG_WORKFLOW, 'img2img': IMG2IMG_WORKFLOW}
+
+scheduler_module.MODEL_SWITCH_PENALTY = LOAD_PENALTY
+
+
+class FakeNode(ComfyServer):
+    """a comfy server which executes prompts locally by sleeping, switching models costs LOAD_PENALTY"""
+
+    def __init__(self, name: str, speed: float):
+        super().__init__(name)
+        self.speed = speed
+        self.connected = True
+        self.jobs: asyncio.Queue = asyncio.Queue()
+        self.running = 0
+        self.loaded_models: frozenset[str] | None = None
+        self.model_switches = 0
+
+    async def queue_prompt(self, client_task_id: int, prompt: dict, cost: float = 0.0) -> asyncio.Future:
+        comfy_task_id = uuid.uuid4().hex
+        self._track_queued(comfy_task_id, cost)
+        done = asyncio.get_running_loop().create_future()
+        await self.jobs.put((comfy_task_id, cost, extract_model_set(prompt), done))
+        self._report_status()
+        return done
+
+    def _report_status(self):
+        remaining = self.jobs.qsize() + self.running
+        asyncio.get_running_loop().call_later(STATUS_LAG, setattr, self, 'queue_remaining', remaining)
+
+    async def run(self):
+        while True:
+            comfy_task_id, cost, models, done = await self.jobs.get()
+            self.running = 1
+            self._track_started(comfy_task_id)
+            if models != self.loaded_models:
+                self.loaded_models = models
+                self.model_switches += 1
+                await asyncio.sleep(LOAD_PENALTY)
+            await asyncio.sleep(cost * SECONDS_PER_COST / self.speed)
+            self._track_finished(comfy_task_id)
+            self.running = 0
+            self._report_status()
+            done.set_result(time.perf_counter())
+
+
+def make_trace(seed: int, bursts: int = 12, burst_size: int = 20) -> list[tuple[float, str, dict]]:
+    """bursty arrivals of mixed workflows and resolutions: (arrival offset, workflow, latent inputs)"""
+    rng = random.Random(seed)
+    trace = []
+    offset = 0.0
+    for _ in range(bursts):
+        for _ in range(burst_size):
+            workflow = 'text2img' if rng.random() < 0.7 else 'img2img'
+            width, height = rng.choice(RESOLUTIONS)
+            trace.append((offset + rng.random() * 0.02, workflow, {'width': width, 'height': height}))
+        offset += rng.expovariate(1 / 0.6)
+    return trace
+
+
+async def simulate(policy: str, trace: list) -> list[float]:
+    scheduler = create_scheduler(policy)
+    nodes = [FakeNode(f'node-{i}', speed) for i, speed in enumerate(NODE_SPEEDS)]
+    runners = [asyncio.create_task(node.run()) for node in nodes]
+    start = time.perf_counter()
+
+    async def submit(offset: float, workflow: str, latent: dict) -> float:
+        await asyncio.sleep(offset)
+        submitted = time.perf_counter()
+        prompt = WORKFLOWS[workflow].build(latent)
+        cost = estimate_cost(workflow, prompt)
+        node = scheduler.schedule(nodes, cost, extract_model_set(prompt))
+        done = await node.queue_prompt(0, prompt, cost)
+        return await done - submitted
+
+    latencies = await asyncio.gather(*(submit(*item) for item in trace))
+    for runner in runners:
+        runner.cancel()
+    print(f'{policy:>12}: {len(trace)} tasks in {time.perf_counter() - start:.1f}s, '
+          f'p50={percentile(latencies, 50) * 1000:.0f}ms p99={percentile(latencies, 99) * 1000:.0f}ms '
+          f'model switches={sum(node.model_switches for node in nodes)}')
+    return latencies
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def main():
+    trace = make_trace(seed=7)
+    for policy in ('least_queue', 'cost_aware', 'affinity'):
+        await simulate(policy, trace)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,211 @@
+"""
+a stub of the ComfyUI backend api used for local benchmarks and load tests, no GPU needed
+
+run several instances to simulate a cluster, e.g.
+    python stub_comfy.py 8188
+    python stub_comfy.py 8189
+STUB_DROP_INTERVAL drops every websocket after about that many seconds, the messages sent while a client is
+disconnected are lost like with ComfyUI. POST /stub/drop drops them right away.
+STUB_PROGRESS_STEPS sampler progress messages are sent during each execution.
+the batch_size of the latent image nodes sets the number of images each output node saves. every image after the
+first of a latent batch adds STUB_BATCH_COST of the execution time, like a batch on a GPU, while each sampler node
+of a prompt, e.g. the branches of a merged prompt, costs a full execution since ComfyUI runs them one after the
+other. STUB_VIEW_SECONDS delays every image download. STUB_PROMPT_RESPONSE_SECONDS delays the answer to a queued
+prompt, so that a short prompt finishes before its id is known to the client, as on a busy api node.
+"""
+import asyncio
+import os
+import random
+import sys
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response
+
+EXECUTION_SECONDS = float(os.getenv("STUB_EXECUTION_SECONDS", 0.5))
+IMAGE_SIZE = int(os.getenv("STUB_IMAGE_SIZE", 512 * 1024))
+DROP_INTERVAL = float(os.getenv("STUB_DROP_INTERVAL", 0))
+PROGRESS_STEPS = int(os.getenv("STUB_PROGRESS_STEPS", 10))
+# share of the execution time each image after the first of a batch adds, a GPU runs a batch mostly in parallel
+BATCH_COST = float(os.getenv("STUB_BATCH_COST", 0.25))
+VIEW_SECONDS = float(os.getenv("STUB_VIEW_SECONDS", 0))
+PROMPT_RESPONSE_SECONDS = float(os.getenv("STUB_PROMPT_RESPONSE_SECONDS", 0))
+SAMPLERS = ('KSampler', 'KSamplerAdvanced', 'SamplerCustomAdvanced')
+
+app = FastAPI()
+
+sockets: dict[str, WebSocket] = {}
+queue: asyncio.Queue = asyncio.Queue()
+history: dict[str, dict] = {}
+running: list[str] = []
+image = os.urandom(IMAGE_SIZE)
+stats = {'connections': 0, 'prompts': 0, 'clean_prompts': 0, 'cleaned_files': 0, 'uploads': 0, 'upload_bytes': 0}
+
+
+async def send(client_id: str | None, message: dict):
+    websocket = sockets.get(client_id) if client_id else None
+    if websocket is None:
+        return
+    try:
+        await websocket.send_json(message)
+    except Exception:
+        sockets.pop(client_id, None)
+
+
+async def send_bytes(client_id: str | None, data: bytes):
+    websocket = sockets.get(client_id) if client_id else None
+    if websocket is None:
+        return
+    try:
+        await websocket.send_bytes(data)
+    except Exception:
+        sockets.pop(client_id, None)
+
+
+async def broadcast_status():
+    remaining = queue.qsize() + len(running)
+    message = {'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': remaining}}}}
+    for client_id in list(sockets):
+        await send(client_id, message)
+
+
+async def worker():
+    """execute queued prompts one at a time, like a single-GPU ComfyUI node"""
+    while True:
+        prompt_id, prompt, client_id = await queue.get()
+        running.append(prompt_id)
+        await send(client_id, {'type': 'execution_start', 'data': {'prompt_id': prompt_id}})
+        batch = max((node['inputs']['batch_size'] for node in prompt.values()
+                     if isinstance(node.get('inputs', {}).get('batch_size'), int)), default=1)
+        # the sampler nodes run one after the other, only the images of a latent batch share the gpu
+        samplers = [node_id for node_id, node in prompt.items() if node.get('class_type') in SAMPLERS]
+        execution_seconds = EXECUTION_SECONDS * max(1, len(samplers)) * (1 + BATCH_COST * (batch - 1))
+        # the sampler steps, sent as progress messages of the first sampler node
+        sampler = samplers[0] if samplers else None
+        if sampler is not None and PROGRESS_STEPS:
+            await send(client_id, {'type': 'executing', 'data': {'node': sampler, 'prompt_id': prompt_id}})
+            for step in range(1, PROGRESS_STEPS + 1):
+                await asyncio.sleep(execution_seconds / PROGRESS_STEPS)
+                message = {'value': step, 'max': PROGRESS_STEPS, 'node': sampler, 'prompt_id': prompt_id}
+                await send(client_id, {'type': 'progress', 'data': message})
+        else:
+            await asyncio.sleep(execution_seconds)
+        outputs = {}
+        for node_id, node in prompt.items():
+            if node.get('class_type') == 'SaveImage':
+                outputs[node_id] = {'images': [
+                    {'filename': f'ComfyUI_{prompt_id}_{i:05}_.png', 'subfolder': '', 'type': 'output'} for i in range(batch)
+                ]}
+            elif node.get('class_type') == 'SaveImageWebsocket':
+                # event type 1 (preview image) and image format 2 (png), then the image bytes
+                await send(client_id, {'type': 'executing', 'data': {'node': node_id, 'prompt_id': prompt_id}})
+                for _ in range(batch):
+                    await send_bytes(client_id, (1).to_bytes(4, 'big') + (2).to_bytes(4, 'big') + image)
+        history[prompt_id] = {'prompt': prompt, 'outputs': outputs, 'status': {'completed': True}}
+        running.remove(prompt_id)
+        await send(client_id, {'type': 'executing', 'data': {'node': None, 'prompt_id': prompt_id}})
+        await broadcast_status()
+
+
+@app.on_event('startup')
+async def startup():
+    asyncio.create_task(worker())
+
+
+@app.websocket('/ws')
+async def websocket_endpoint(websocket: WebSocket, clientId: str = ''):
+    await websocket.accept()
+    client_id = clientId or uuid.uuid4().hex
+    sockets[client_id] = websocket
+    await broadcast_status()
+    stats['connections'] += 1
+    receiver = asyncio.create_task(websocket.receive_text())
+    try:
+        while True:
+            timeout = DROP_INTERVAL * random.uniform(0.5, 1.5) if DROP_INTERVAL else None
+            done, _ = await asyncio.wait([receiver], timeout=timeout)
+            if not done:
+                # drop the connection on purpose
+                break
+            receiver.result()
+            receiver = asyncio.create_task(websocket.receive_text())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        if sockets.get(client_id) is websocket:
+            sockets.pop(client_id)
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+
+@app.post('/prompt')
+async def prompt(request: Request):
+    body = await request.json()
+    prompt_id = str(uuid.uuid4())
+    stats['prompts'] += 1
+    cleaners = [node for node in body['prompt'].values() if node.get('class_type') == 'Clean input and output file']
+    if cleaners:
+        stats['clean_prompts'] += 1
+        stats['cleaned_files'] += len(cleaners)
+    await queue.put((prompt_id, body['prompt'], body.get('client_id')))
+    await broadcast_status()
+    if PROMPT_RESPONSE_SECONDS:
+        await asyncio.sleep(PROMPT_RESPONSE_SECONDS)
+    return {'prompt_id': prompt_id, 'number': queue.qsize(), 'node_errors': {}}
+
+
+@app.get('/history/{prompt_id}')
+async def get_history(prompt_id: str):
+    if prompt_id not in history:
+        return {}
+    return {prompt_id: history[prompt_id]}
+
+
+@app.get('/queue')
+async def get_queue():
+    return {
+        'queue_running': [[0, prompt_id] for prompt_id in running],
+        'queue_pending': [[0, item[0]] for item in queue._queue]
+    }
+
+
+@app.get('/view')
+async def view(filename: str):
+    if VIEW_SECONDS:
+        await asyncio.sleep(VIEW_SECONDS)
+    return Response(content=image, media_type='image/png')
+
+
+@app.post('/upload/image')
+async def upload_image(image: UploadFile):
+    data = await image.read()
+    stats['uploads'] += 1
+    stats['upload_bytes'] += len(data)
+    return {'name': image.filename, 'subfolder': '', 'type': 'input'}
+
+
+@app.post('/stub/drop')
+async def drop():
+    for client_id, websocket in list(sockets.items()):
+        sockets.pop(client_id, None)
+        await websocket.close()
+
+
+@app.get('/stub/stats')
+async def get_stats():
+    return stats
+
+
+@app.delete('/stub/stats')
+async def reset_stats():
+    for key in stats:
+        stats[key] = 0
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8188
+    uvicorn.run(app, host='0.0.0.0', port=port, log_level='warning')
@@ -0,0 +1,63 @@
+"""
+a stub webhook receiver for load tests, with configurable latency and failure rate
+
+    STUB_WEBHOOK_LATENCY=0.05 STUB_WEBHOOK_FAILURE_RATE=0.1 python stub_webhook.py 9100
+and run the service with CALL_BACK_BASE_URL=http://localhost:9100/callback
+"""
+import asyncio
+import os
+import random
+import sys
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+LATENCY = float(os.getenv("STUB_WEBHOOK_LATENCY", 0.05))
+FAILURE_RATE = float(os.getenv("STUB_WEBHOOK_FAILURE_RATE", 0.0))
+
+app = FastAPI()
+
+received: set[int] = set()
+stats = {'calls': 0, 'failures': 0, 'results': 0, 'duplicates': 0}
+
+
+async def receive(results: list[dict]) -> JSONResponse:
+    stats['calls'] += 1
+    await asyncio.sleep(LATENCY)
+    if random.random() < FAILURE_RATE:
+        stats['failures'] += 1
+        return JSONResponse({'error': 'injected failure'}, status_code=503)
+    for result in results:
+        stats['results'] += 1
+        if result['client_task_id'] in received:
+            stats['duplicates'] += 1
+        received.add(result['client_task_id'])
+    return JSONResponse({'received': len(results)})
+
+
+@app.post('/callback/batch')
+async def callback_batch(data: list[dict]):
+    return await receive(data)
+
+
+@app.post('/callback/{client_task_id}')
+async def callback(client_task_id: int, data: dict):
+    return await receive([data])
+
+
+@app.get('/stats')
+async def get_stats():
+    return {**stats, 'unique': len(received)}
+
+
+@app.delete('/stats')
+async def reset_stats():
+    received.clear()
+    for key in stats:
+        stats[key] = 0
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9100
+    uvicorn.run(app, host='0.0.0.0', port=port, log_level='warning')
@@ -0,0 +1,28 @@
+"""unit tests of the http routes"""
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import api
+from api import router
+from api.service import InvalidParamsError, Service
+
+
+def test_a_param_of_the_wrong_type_is_invalid():
+    with pytest.raises(InvalidParamsError):
+        Service.plan('text2img', {'text': 'a cat', 'steps': 'abc'})
+
+
+def test_the_single_prompt_route_rejects_invalid_params(monkeypatch):
+    monkeypatch.setattr(api, 'TASK_QUEUE_ENABLED', False)
+    app = FastAPI()
+    app.include_router(router)
+
+    response = TestClient(app).post(router.prefix, json={
+        'service_type': 'text2img',
+        'client_task_id': 1,
+        'params': {'text': 'a cat', 'steps': 'abc'}
+    })
+
+    assert response.status_code == 422
+    assert response.json()['detail'].startswith('invalid params: ')
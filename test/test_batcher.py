@@ -0,0 +1,50 @@
+"""unit tests of the text2img micro-batching, against a stub comfy server"""
+import asyncio
+
+from api.service import PromptBatcher
+from workflows.text2img import TEXT2IMG_WORKFLOW
+
+
+class StubServer:
+    """queues the batches after a delay, so a caller can give up while its group is queued"""
+
+    def __init__(self, error: Exception | None = None):
+        self.error = error
+        self.batches = []
+
+    async def queue_batch(self, entries, workflow=None):
+        await asyncio.sleep(0.05)
+        if self.error is not None:
+            raise self.error
+        self.batches.append(entries)
+        return [f'record {client_task_id}' for client_task_id, *_ in entries]
+
+
+def prompt(i: int) -> dict:
+    return TEXT2IMG_WORKFLOW.build({'text': f'a cat {i}', 'seed': i})
+
+
+async def submit_group(server: StubServer) -> list:
+    batcher = PromptBatcher(TEXT2IMG_WORKFLOW, True, 3, 1)
+    submissions = [asyncio.create_task(batcher.submit(server, i, prompt(i), 1.0)) for i in range(3)]
+    await asyncio.sleep(0.01)
+    # the group is full and being queued, the first caller goes away
+    submissions[0].cancel()
+    results = await asyncio.wait_for(asyncio.gather(*submissions, return_exceptions=True), 1)
+    assert isinstance(results[0], asyncio.CancelledError)
+    return results[1:]
+
+
+def test_a_cancelled_caller_does_not_block_its_group():
+    server = StubServer()
+    results = asyncio.run(submit_group(server))
+
+    assert results == ['record 1', 'record 2']
+    assert [[entry[0] for entry in batch] for batch in server.batches] == [[0, 1, 2]]
+
+
+def test_a_cancelled_caller_does_not_block_the_error_of_its_group():
+    error = RuntimeError('comfy is down')
+    results = asyncio.run(submit_group(StubServer(error)))
+
+    assert results == [error, error]
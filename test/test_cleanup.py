@@ -0,0 +1,88 @@
+"""unit tests of the deletion of the files left on the comfy servers"""
+import asyncio
+
+from comfy import ComfyServer
+from comfy.cleanup import FileCleaner
+
+
+class StubResponse:
+    text = ''
+
+    def __init__(self, prompt_id: str):
+        self.prompt_id = prompt_id
+
+    def json(self) -> dict:
+        return {'prompt_id': self.prompt_id}
+
+
+class StubClient:
+    """answers a queued prompt once `answer` is set"""
+
+    def __init__(self, prompt_id: str):
+        self.prompt_id = prompt_id
+        self.answer = asyncio.Event()
+
+    async def post(self, url, json=None):
+        await self.answer.wait()
+        return StubResponse(self.prompt_id)
+
+
+def finished(comfy_task_id: str) -> dict:
+    return {'type': 'executing', 'data': {'node': None, 'prompt_id': comfy_task_id}}
+
+
+def test_a_cleanup_finished_before_its_post_is_answered_does_not_block_the_messages():
+    async def run():
+        server = ComfyServer('localhost:8188')
+        server.client = StubClient('cleanup')
+        server.clean_file(is_input=False, image_path='a.png')
+        flush = asyncio.create_task(server.flush_cleanup())
+        await asyncio.sleep(0)
+
+        # the cleanup and a prompt of another client finish while the post is pending, neither blocks the listener
+        await asyncio.wait_for(server._handle_message(finished('cleanup')), 0.1)
+        await asyncio.wait_for(server._handle_message(finished('foreign')), 0.1)
+        await asyncio.wait_for(server._handle_message({
+            'type': 'status',
+            'data': {'status': {'exec_info': {'queue_remaining': 3}}}
+        }), 0.1)
+        assert server.queue_remaining == 3
+        assert server.completions.empty()
+
+        server.client.answer.set()
+        await flush
+        return server
+
+    server = asyncio.run(run())
+    # the cleanup is recognised and dropped, the other prompt is handed to the completion workers
+    assert server.cleanup_prompts == set()
+    assert server.completions.get_nowait()[0] == 'foreign'
+    assert server.completions.empty()
+    assert server.cleaner.stats() == {'prompts': 1, 'files': 1, 'pending': 0}
+
+
+def test_the_files_are_handed_out_in_batches():
+    cleaner = FileCleaner(batch_size=3)
+    for i in range(4):
+        cleaner.add(is_input=i % 2 == 0, path=f'{i}.png')
+        assert cleaner.ready.is_set() == (i >= 2)
+
+    assert cleaner.take() == [('input', '0.png'), ('output', '1.png'), ('input', '2.png')]
+    assert not cleaner.ready.is_set()
+    assert cleaner.take() == [('output', '3.png')]
+    assert cleaner.take() == []
+
+
+def test_a_batch_which_could_not_be_queued_is_retried_first():
+    cleaner = FileCleaner(batch_size=2)
+    for i in range(3):
+        cleaner.add(is_input=False, path=f'{i}.png')
+    batch = cleaner.take()
+    cleaner.add(is_input=False, path='3.png')
+
+    cleaner.restore(batch)
+
+    assert cleaner.stats()['pending'] == 4
+    assert cleaner.take() == batch
+    cleaner.sent(batch)
+    assert cleaner.stats() == {'prompts': 1, 'files': 2, 'pending': 2}
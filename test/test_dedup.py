@@ -0,0 +1,117 @@
+"""unit tests of the coalescing of identical prompts"""
+import asyncio
+
+import pytest
+
+from comfy.dedup import Singleflight, prompt_hash
+from workflows.text2img import TEXT2IMG_WORKFLOW
+
+
+class Submissions:
+    """submits prompts to a fake comfy server once `done` is set, and records the requests"""
+
+    def __init__(self, error: Exception | None = None):
+        self.error = error
+        self.done = asyncio.Event()
+        self.submitted = 0
+
+    async def submit(self, endpoint: str) -> tuple[str, str]:
+        self.submitted += 1
+        await self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return f'prompt-{self.submitted}', endpoint
+
+    async def record(self, comfy_task_id: str, comfy_endpoint: str) -> tuple[str, str]:
+        return comfy_task_id, comfy_endpoint
+
+
+def test_prompt_hash_ignores_the_node_titles():
+    prompt = TEXT2IMG_WORKFLOW.build({'text': 'a cat'})
+    renamed = {node_id: {**node, '_meta': {'title': 'renamed'}} for node_id, node in prompt.items()}
+
+    assert prompt_hash(prompt) == prompt_hash(renamed)
+    assert prompt_hash(prompt) != prompt_hash(TEXT2IMG_WORKFLOW.build({'text': 'a dog'}))
+
+
+def test_identical_prompts_in_flight_are_submitted_once():
+    async def run():
+        singleflight = Singleflight()
+        submissions = Submissions()
+        requests = [
+            asyncio.create_task(singleflight.run('key', lambda endpoint=endpoint: submissions.submit(endpoint), submissions.record))
+            for endpoint in ('node-a', 'node-b', 'node-a')
+        ]
+        await asyncio.sleep(0)
+        submissions.done.set()
+        results = await asyncio.gather(*requests)
+        return singleflight, submissions, results
+
+    singleflight, submissions, results = asyncio.run(run())
+
+    assert submissions.submitted == 1
+    # every request is recorded on the node the prompt runs on, whichever node it was scheduled on
+    assert results == [('prompt-1', 'node-a')] * 3
+    assert (singleflight.hits, singleflight.misses) == (2, 1)
+
+
+def test_a_finished_prompt_is_submitted_again():
+    async def run():
+        singleflight = Singleflight()
+        submissions = Submissions()
+        submissions.done.set()
+        first = await singleflight.run('key', lambda: submissions.submit('node-a'), submissions.record)
+        assert await singleflight.finish(first[0]) == 'key'
+        second = await singleflight.run('key', lambda: submissions.submit('node-a'), submissions.record)
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert first == ('prompt-1', 'node-a')
+    assert second == ('prompt-2', 'node-a')
+
+
+def test_the_attached_requests_get_the_submission_error():
+    async def run():
+        singleflight = Singleflight()
+        submissions = Submissions(ConnectionError('node down'))
+        requests = [
+            asyncio.create_task(singleflight.run('key', lambda: submissions.submit('node-a'), submissions.record))
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+        submissions.done.set()
+        return singleflight, await asyncio.gather(*requests, return_exceptions=True)
+
+    singleflight, results = asyncio.run(run())
+
+    assert [type(result) for result in results] == [ConnectionError] * 3
+    assert singleflight.stats()['inflight'] == 0
+
+
+def test_finish_waits_for_the_pending_writes():
+    async def run():
+        singleflight = Singleflight()
+        write = singleflight.pending('prompt-1')
+        finish = asyncio.create_task(singleflight.finish('prompt-1'))
+        await asyncio.sleep(0.01)
+        assert not finish.done()
+        write.set_result(None)
+        # a prompt submitted by another process has no hash here
+        assert await asyncio.wait_for(finish, 1) is None
+
+    asyncio.run(run())
+
+
+def test_finish_waits_for_a_write_which_fails():
+    async def run():
+        singleflight = Singleflight()
+
+        async def write():
+            raise ValueError('insert failed')
+
+        with pytest.raises(ValueError):
+            await singleflight.attach('prompt-1', write())
+        await asyncio.wait_for(singleflight.finish('prompt-1'), 1)
+
+    asyncio.run(run())
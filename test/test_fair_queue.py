@@ -0,0 +1,56 @@
+"""unit tests of the weighted fair queuing tags of the task queue"""
+import asyncio
+
+from api import service
+from api.service import FairQueue
+
+
+def dispatch_order(fair_queue: FairQueue, tasks: list[tuple[str, float]], priority: int = 0) -> list[str]:
+    """the tenants of (tenant_id, cost) tasks in the order the dispatcher claims them, smallest tag first"""
+    tags = [(fair_queue.tag(priority, tenant_id, cost), i, tenant_id) for i, (tenant_id, cost) in enumerate(tasks)]
+    return [tenant_id for _, _, tenant_id in sorted(tags)]
+
+
+def test_a_backfill_does_not_starve_the_other_tenants():
+    fair_queue = FairQueue({})
+    tasks = [('batch', 1.0)] * 100 + [('small', 1.0)] * 3
+
+    order = dispatch_order(fair_queue, tasks)
+
+    # queued last, the small tenant still gets every other slot
+    assert order[:6] == ['batch', 'small'] * 3
+
+
+def test_the_weights_share_the_slots():
+    fair_queue = FairQueue({'gold': 3.0})
+    tasks = [('gold', 1.0)] * 30 + [('free', 1.0)] * 30
+
+    order = dispatch_order(fair_queue, tasks)[:20]
+
+    assert order.count('gold') == 15
+    assert order.count('free') == 5
+
+
+def test_an_idle_tenant_starts_at_the_virtual_time():
+    fair_queue = FairQueue({})
+    for _ in range(10):
+        fair_queue.dispatched(0, fair_queue.tag(0, 'busy', 1.0))
+
+    # no credit is banked while idle, the newcomer goes right after the task dispatched last
+    assert fair_queue.tag(0, 'newcomer', 1.0) == 11.0
+    # the priority lanes are independent
+    assert fair_queue.tag(10, 'newcomer', 1.0) == 1.0
+
+
+def test_restore_picks_up_the_tags_left_in_the_queue(monkeypatch):
+    async def fair_queue_state():
+        return [(0, 'batch', 5.0, 40.0), (0, 'small', 6.0, 7.0)]
+
+    monkeypatch.setattr(service.TaskQueueRepository, 'fair_queue_state', fair_queue_state)
+    fair_queue = FairQueue({})
+    asyncio.run(fair_queue.restore())
+
+    # the tenants keep queueing after their own tasks, an idle one from the oldest tag still queued
+    assert fair_queue.tag(0, 'batch', 1.0) == 41.0
+    assert fair_queue.tag(0, 'small', 1.0) == 8.0
+    assert fair_queue.tag(0, 'other', 1.0) == 6.0
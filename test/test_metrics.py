@@ -0,0 +1,49 @@
+"""unit tests of the in-process metrics and of their prometheus text format"""
+import metrics
+from metrics import Counter, Gauge, Histogram, HistogramFamily
+
+
+def test_histogram_quantiles_are_bucket_bounds():
+    histogram = Histogram((1, 5, 10))
+    for value in (0.5, 1, 2, 3, 4, 20):
+        histogram.observe(value)
+
+    assert histogram.counts == [2, 3, 0, 1]
+    assert histogram.quantile(0.5) == 5
+    assert histogram.quantile(0.99) == float('inf')
+    assert Histogram().quantile(0.5) is None
+
+
+def test_histogram_snapshot_is_json():
+    histogram = Histogram((1,))
+    histogram.observe(2)
+
+    assert histogram.snapshot() == {'count': 1, 'sum': 2.0, 'p50': '+Inf', 'p99': '+Inf', 'buckets': {'1': 0, '+Inf': 1}}
+
+
+def test_render_is_the_prometheus_text_format(monkeypatch):
+    monkeypatch.setattr(metrics, 'REGISTRY', [])
+    stages = metrics.register(HistogramFamily('stage_seconds', 'stage time', ('stage',), (0.1, 1)))
+    errors = metrics.register(Counter('stage_errors_total', 'stage errors', ('stage',)))
+    metrics.register(Gauge('queue_depth', 'queued tasks', ('node',), lambda: [(('a',), 3), (('b',), 0.5)]))
+    for value in (0.05, 0.5, 2.0):
+        stages.observe(value, 'fetch')
+    errors.inc('fetch')
+    errors.inc('fetch', amount=2)
+
+    assert metrics.render().splitlines() == [
+        '# HELP stage_seconds stage time',
+        '# TYPE stage_seconds histogram',
+        'stage_seconds_bucket{stage="fetch",le="0.1"} 1',
+        'stage_seconds_bucket{stage="fetch",le="1"} 2',
+        'stage_seconds_bucket{stage="fetch",le="+Inf"} 3',
+        'stage_seconds_sum{stage="fetch"} 2.55',
+        'stage_seconds_count{stage="fetch"} 3',
+        '# HELP stage_errors_total stage errors',
+        '# TYPE stage_errors_total counter',
+        'stage_errors_total{stage="fetch"} 3',
+        '# HELP queue_depth queued tasks',
+        '# TYPE queue_depth gauge',
+        'queue_depth{node="a"} 3',
+        'queue_depth{node="b"} 0.5'
+    ]
@@ -0,0 +1,91 @@
+"""unit tests of the fan-out of the progress events"""
+import asyncio
+
+from comfy.progress import ProgressHub
+
+
+def event_ids(messages: list[str]) -> list[int]:
+    return [int(message.split('\n')[0][len('id: '):]) for message in messages if message.startswith('id: ')]
+
+
+def event_names(messages: list[str]) -> list[str]:
+    return [message.split('\n')[1][len('event: '):] for message in messages if message.startswith('id: ')]
+
+
+async def read(hub: ProgressHub, client_task_id: int, last_event_id: int = 0) -> list[str]:
+    return [message async for message in hub.subscribe(client_task_id, last_event_id)]
+
+
+def run_task(hub: ProgressHub, steps: int = 3):
+    """a comfy task of client task 1 which makes progress and completes"""
+    hub.register('prompt-1', 1)
+    hub.publish('prompt-1', 'execution_start', {})
+    for step in range(1, steps + 1):
+        hub.publish('prompt-1', 'progress', {'value': step, 'max': steps})
+    hub.finish('prompt-1', 'completed', {'s3_key': 'a.png'})
+
+
+def test_a_reconnection_replays_the_events_after_last_event_id():
+    async def run():
+        hub = ProgressHub(buffer_size=64, retention=60, keepalive=1)
+        run_task(hub)
+        return await read(hub, 1), await read(hub, 1, last_event_id=4)
+
+    everything, missed = asyncio.run(run())
+
+    assert event_names(everything) == ['queued', 'execution_start', 'progress', 'progress', 'progress', 'completed']
+    assert event_ids(missed) == [5, 6]
+    assert event_names(missed) == ['progress', 'completed']
+
+
+def test_an_unknown_last_event_id_replays_everything():
+    async def run():
+        hub = ProgressHub(buffer_size=64, retention=60, keepalive=1)
+        run_task(hub)
+        # e.g. sent to the service before a restart
+        return await read(hub, 1, last_event_id=100)
+
+    assert event_ids(asyncio.run(run())) == [1, 2, 3, 4, 5, 6]
+
+
+def test_a_slow_subscriber_skips_the_oldest_events():
+    async def run():
+        hub = ProgressHub(buffer_size=3, retention=60, keepalive=1)
+        run_task(hub, steps=10)
+        return await read(hub, 1)
+
+    messages = asyncio.run(run())
+
+    assert event_ids(messages) == [11, 12, 13]
+    assert event_names(messages)[-1] == 'completed'
+
+
+def test_a_subscriber_waits_for_a_task_not_registered_yet():
+    async def run():
+        hub = ProgressHub(buffer_size=64, retention=60, keepalive=1)
+        subscriber = asyncio.create_task(read(hub, 1))
+        await asyncio.sleep(0)
+        # the prompt starts before its client task is known
+        hub.publish('prompt-1', 'execution_start', {})
+        hub.register('prompt-1', 1)
+        hub.finish('prompt-1', 'failed', {})
+        return await asyncio.wait_for(subscriber, 1)
+
+    assert event_names(asyncio.run(run())) == ['queued', 'execution_start', 'failed']
+
+
+def test_a_batched_prompt_finishes_each_branch_on_its_own():
+    async def run():
+        hub = ProgressHub(buffer_size=64, retention=60, keepalive=1)
+        hub.register('prompt-1', 1, 2)
+        hub.finish('prompt-1', 'completed', {'s3_key': 'a.png'}, 1)
+        first = await read(hub, 1)
+        assert hub.stats()['tasks'] == 1
+        hub.finish('prompt-1', 'failed', {}, 2)
+        return first, await read(hub, 2), hub.stats()
+
+    first, second, stats = asyncio.run(run())
+
+    assert event_names(first) == ['queued', 'completed']
+    assert event_names(second) == ['queued', 'failed']
+    assert stats['tasks'] == 0
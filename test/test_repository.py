@@ -0,0 +1,36 @@
+"""unit tests of the statements built by the repositories, run with python -m pytest test"""
+from sqlalchemy import update
+from sqlalchemy.dialects import postgresql
+
+from database import Record
+from database.repository import _case_values
+
+
+def compile_update(values: dict) -> str:
+    stmt = update(Record).where(Record.comfy_task_id == 'prompt').values(**values)
+    return str(stmt.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+
+def test_case_values_picks_each_record_value():
+    values = {'status': 'uploaded'}
+    per_record = {1: {'s3_key': 'a.png'}, 2: {'s3_key': 'b.png'}}
+    sql = compile_update(_case_values(values, per_record))
+
+    assert "status='uploaded'" in sql
+    assert "s3_key=CASE records.client_task_id WHEN 1 THEN 'a.png' WHEN 2 THEN 'b.png' ELSE records.s3_key END" in sql
+    assert values == {'status': 'uploaded'}
+
+
+def test_case_values_falls_back_to_the_common_value():
+    values = {'status': 'uploaded', 'comfy_filepath': 'shared.png'}
+    per_record = {1: {'comfy_filepath': 'a.png', 'status': 'failed'}, 2: {}}
+    sql = compile_update(_case_values(values, per_record))
+
+    assert "comfy_filepath=CASE records.client_task_id WHEN 1 THEN 'a.png' ELSE 'shared.png' END" in sql
+    assert "status=CASE records.client_task_id WHEN 1 THEN 'failed' ELSE 'uploaded' END" in sql
+
+
+def test_case_values_without_per_record_values():
+    values = {'status': 'uploaded'}
+
+    assert _case_values(values, {}) == values
@@ -0,0 +1,97 @@
+"""unit tests of the scheduling policies and of the cost and model estimates they use"""
+from comfy import ComfyServer
+from scheduler import (
+    MODEL_SWITCH_PENALTY,
+    AffinityScheduler,
+    CostAwareScheduler,
+    estimate_cost,
+    extract_model_set
+)
+from workflows.text2img import TEXT2IMG_WORKFLOW
+
+FLUX = frozenset({'UNETLoader.unet_name=flux1-dev.safetensors'})
+SDXL = frozenset({'CheckpointLoaderSimple.ckpt_name=sdxl.safetensors'})
+
+
+def server(endpoint: str, pending: float = 0.0, throughput: float = 1.0, model_set: frozenset | None = None):
+    node = ComfyServer(endpoint)
+    node.connected = True
+    node.reserved_cost = pending
+    node.throughput = throughput
+    node.model_set = model_set
+    return node
+
+
+def test_extract_model_set_reads_the_loader_nodes():
+    prompt = {
+        '1': {'class_type': 'UNETLoader', 'inputs': {'unet_name': 'flux1-dev.safetensors', 'weight_dtype': 'default'}},
+        '2': {'class_type': 'LoraLoader', 'inputs': {'lora_name': 'style.safetensors', 'model': ['1', 0]}},
+        '3': {'class_type': 'CLIPTextEncode', 'inputs': {'text': 'a cat', 'clip': ['2', 1]}}
+    }
+
+    assert extract_model_set(prompt) == {
+        'UNETLoader.unet_name=flux1-dev.safetensors',
+        'UNETLoader.weight_dtype=default',
+        'LoraLoader.lora_name=style.safetensors'
+    }
+
+
+def test_extract_model_set_ignores_the_prompt_text():
+    a = extract_model_set(TEXT2IMG_WORKFLOW.build({'text': 'a cat'}))
+
+    assert a == extract_model_set(TEXT2IMG_WORKFLOW.build({'text': 'a dog', 'seed': 2}))
+    assert {model.split('.')[0] for model in a} == {'UNETLoader', 'DualCLIPLoader', 'VAELoader'}
+
+
+def test_estimate_cost_scales_with_the_resolution():
+    cost = estimate_cost('text2img', TEXT2IMG_WORKFLOW.build({'width': 1024, 'height': 1024}))
+
+    assert estimate_cost('text2img', TEXT2IMG_WORKFLOW.build({'width': 512, 'height': 512})) == cost / 4
+    assert estimate_cost('img2img') < estimate_cost('text2img')
+
+
+def test_cost_aware_picks_the_server_finishing_first():
+    busy = server('a', pending=3.0)
+    fast = server('b', pending=1.0, throughput=2.0)
+
+    assert CostAwareScheduler().select([busy, fast], 1.0, None) is fast
+    # the slow one finishes first once the fast one has enough work
+    fast.reserved_cost = 8.0
+    assert CostAwareScheduler().select([busy, fast], 1.0, None) is busy
+
+
+def test_cost_aware_skips_the_disconnected_servers():
+    down = server('a')
+    down.connected = False
+    up = server('b', pending=10.0)
+
+    assert CostAwareScheduler().select([down, up], 1.0, None) is up
+
+
+def test_schedule_many_spreads_the_reservations():
+    servers = [server('a'), server('b')]
+    picked = CostAwareScheduler().schedule_many(servers, [(1.0, None)] * 4)
+
+    assert [node.endpoint for node in picked].count('a') == 2
+    assert [node.reserved_cost for node in servers] == [2.0, 2.0]
+
+
+def test_affinity_prefers_the_warm_server_within_the_penalty():
+    warm = server('a', pending=MODEL_SWITCH_PENALTY / 2, model_set=FLUX)
+    cold = server('b', model_set=SDXL)
+
+    assert AffinityScheduler().select([warm, cold], 1.0, FLUX) is warm
+
+
+def test_affinity_spills_over_beyond_the_penalty():
+    warm = server('a', pending=MODEL_SWITCH_PENALTY * 2, model_set=FLUX)
+    cold = server('b', model_set=SDXL)
+
+    assert AffinityScheduler().select([warm, cold], 1.0, FLUX) is cold
+
+
+def test_affinity_schedule_records_the_models_loaded():
+    cold = server('a', model_set=SDXL)
+    AffinityScheduler().schedule([cold], 1.0, FLUX)
+
+    assert cold.model_set == FLUX
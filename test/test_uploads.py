@@ -0,0 +1,43 @@
+"""unit tests of the index of the input images uploaded to a comfy server"""
+from comfy.uploads import InputUploadCache, uploaded_path
+
+
+def test_uploaded_path_joins_the_subfolder():
+    assert uploaded_path({'name': 'a.png', 'subfolder': ''}) == 'a.png'
+    assert uploaded_path({'name': 'a.png', 'subfolder': 'inputs'}) == 'inputs/a.png'
+
+
+def test_the_least_recently_used_inputs_are_evicted():
+    cache = InputUploadCache(max_entries=2)
+    assert cache.add('a', 'a.png', 10) == []
+    assert cache.add('b', 'b.png', 10) == []
+    cache.release('a')
+    cache.release('b')
+
+    # a is used again, b is the least recently used one
+    assert cache.acquire('a') == 'a.png'
+    cache.release('a')
+    assert cache.add('c', 'c.png', 10) == ['b.png']
+    assert cache.acquire('b') is None
+    assert cache.stats() == {'hits': 1, 'misses': 3, 'bytes_saved': 10, 'entries': 2}
+
+
+def test_a_referenced_input_is_evicted_once_released():
+    cache = InputUploadCache(max_entries=1)
+    cache.add('a', 'a.png', 10)
+
+    # a queued prompt still loads a
+    assert cache.add('b', 'b.png', 10) == []
+    assert cache.stats()['entries'] == 2
+    assert cache.release('a') == ['a.png']
+    assert cache.acquire('a') is None
+
+
+def test_clear_keeps_the_referenced_inputs():
+    cache = InputUploadCache(max_entries=10)
+    cache.add('a', 'a.png', 10)
+    cache.add('b', 'b.png', 10)
+    cache.release('a')
+
+    assert cache.clear() == ['a.png']
+    assert cache.acquire('b') == 'b.png'
@@ -0,0 +1,54 @@
+"""unit tests of the delivery of the webhook callbacks from the outbox"""
+import asyncio
+
+import webhook
+from database import WebhookDelivery
+from webhook import WebhookOutbox
+
+
+class StubResponse:
+    def raise_for_status(self):
+        pass
+
+
+class Outbox:
+    """the outbox and records tables, the first `failures` updates of the records fail"""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.deleted = []
+        self.sent = []
+
+    async def post_webhook(self, url: str, payload: dict) -> StubResponse:
+        return StubResponse()
+
+    async def delete(self, ids: list[int]):
+        self.deleted.extend(ids)
+
+    async def callbacks_sent(self, client_task_ids: list[int]):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('database down')
+        self.sent.extend(client_task_ids)
+
+
+def test_a_failed_status_update_is_repaired_by_the_next_sweep(monkeypatch):
+    outbox = Outbox(failures=1)
+    monkeypatch.setattr(webhook, 'post_webhook', outbox.post_webhook)
+    monkeypatch.setattr(webhook.WebhookOutboxRepository, 'delete', outbox.delete)
+    monkeypatch.setattr(webhook.RecordRepository, 'callbacks_sent', outbox.callbacks_sent)
+
+    async def run():
+        webhook_outbox = WebhookOutbox(enabled=True, batch_size=1)
+        delivery = WebhookDelivery(id=7, client_task_id=42, base_url='http://client', payload={})
+        await webhook_outbox._deliver('http://client', [delivery])
+        # delivered once, the delivery is gone from the outbox and isn't attempted again
+        assert outbox.deleted == [7]
+        assert outbox.sent == []
+        assert webhook_outbox.delivered == 1
+        await webhook_outbox._repair()
+        return webhook_outbox
+
+    webhook_outbox = asyncio.run(run())
+    assert outbox.sent == [42]
+    assert webhook_outbox._unrecorded == set()
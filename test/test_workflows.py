@@ -0,0 +1,82 @@
+"""unit tests of the prompt building and merging, run with python -m pytest test"""
+import copy
+
+from workflows import Workflow, merge_prompts
+from workflows.img2img import IMG2IMG_WORKFLOW
+from workflows.text2img import TEXT2IMG_WORKFLOW
+
+SHARED = {'10', '11', '12', '16', '17', '27', '30'}  # the loaders, the scheduler and the empty latent
+BRANCH = {'6', '8', '9', '13', '22', '26'}  # from the text encoder to the SaveImage
+
+
+def text2img(**params) -> dict:
+    return TEXT2IMG_WORKFLOW.build({'seed': 1, **params})
+
+
+def test_merge_shares_the_common_nodes():
+    prompts = [text2img(text=f'a cat {i}') for i in range(3)]
+    merged, outputs = merge_prompts(prompts)
+
+    assert outputs == [{'9_0'}, {'9_1'}, {'9_2'}]
+    # the seed is the same in every prompt, its noise is shared too
+    assert set(merged) == SHARED | {'25'} | {f'{node_id}_{i}' for node_id in BRANCH for i in range(3)}
+    for i in range(3):
+        assert merged[f'6_{i}']['inputs']['text'] == f'a cat {i}'
+        assert merged[f'6_{i}']['inputs']['clip'] == ['11', 0]
+        sampler = merged[f'13_{i}']['inputs']
+        assert sampler['guider'] == [f'22_{i}', 0]
+        assert sampler['noise'] == ['25', 0]
+        assert sampler['latent_image'] == ['27', 0]
+        assert merged[f'9_{i}']['inputs']['images'] == [f'8_{i}', 0]
+
+
+def test_merge_branches_the_differing_seeds():
+    merged, _ = merge_prompts([text2img(text='a cat', seed=1), text2img(text='a cat', seed=2)])
+
+    assert '25' not in merged
+    assert merged['25_0']['inputs']['noise_seed'] == 1
+    assert merged['25_1']['inputs']['noise_seed'] == 2
+    assert merged['13_1']['inputs']['noise'] == ['25_1', 0]
+    # the conditioning is the same, only the sampler and what follows it is branched
+    assert {'6', '22', '26'} <= set(merged)
+    assert merged['13_0']['inputs']['guider'] == ['22', 0]
+    assert merged['8_0']['inputs']['samples'] == ['13_0', 0]
+
+
+def test_merge_copies_the_outputs_of_identical_prompts():
+    merged, outputs = merge_prompts([text2img(text='a cat'), text2img(text='a cat')])
+
+    assert outputs == [{'9_0'}, {'9_1'}]
+    assert set(merged) == SHARED | {'25'} | (BRANCH - {'9'}) | {'9_0', '9_1'}
+    assert merged['9_0']['inputs']['images'] == ['8', 0]
+
+
+def test_merge_leaves_the_prompts_unchanged():
+    prompts = [text2img(text='a cat'), text2img(text='a dog', seed=2)]
+    before = copy.deepcopy(prompts)
+    merge_prompts(prompts)
+
+    assert prompts == before
+    assert TEXT2IMG_WORKFLOW.graph['6']['inputs']['text'] == ''
+
+
+def test_batch_key_ignores_the_branch_params():
+    key = TEXT2IMG_WORKFLOW.batch_key(text2img(text='a cat'))
+
+    assert key == TEXT2IMG_WORKFLOW.batch_key(text2img(text='a dog', seed=2))
+    assert key != TEXT2IMG_WORKFLOW.batch_key(text2img(text='a cat', steps=30))
+    assert key != TEXT2IMG_WORKFLOW.batch_key(text2img(text='a cat', width=512))
+
+
+def test_batch_key_leaves_the_prompt_unchanged():
+    prompt = text2img(text='a cat')
+    before = copy.deepcopy(prompt)
+    TEXT2IMG_WORKFLOW.batch_key(prompt)
+
+    assert prompt == before
+
+
+def test_batch_key_without_branch_params():
+    assert IMG2IMG_WORKFLOW.batch_key(IMG2IMG_WORKFLOW.build({})) is None
+    workflow = Workflow('test', '{"1": {"inputs": {"text": ""}, "class_type": "Text"}}', {'text': (str, [('1', 'text')])})
+    assert workflow.batch_key(workflow.build({'text': 'a cat'})) is None